@@ -1,7 +1,9 @@
 from .factors import *
 from .qjm_data_classes import *
+from .kernel import battle_kernel, resolve_environment, encode_environment, gather_environment
 from .formation import Formation
 from .vehicle import Vehicle
 from .weapon import Weapon
 from .equipment_database import EquipmentDatabase
+from .savefile import SaveReader, SaveWriter
 from .wargame import Wargame
\ No newline at end of file
@@ -1,51 +1,358 @@
+import os
+import pickle
+import hashlib
 import logging
+import threading
+from contextlib import nullcontext
 from glob import glob
-from .weapon import Weapon
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from .weapon import Weapon, YAML_LOADER
 from .vehicle import Vehicle
 
+logger = logging.getLogger(__name__)
+
+# Bump when the Weapon or Vehicle calculations change to discard old caches
+CACHE_VERSION = 3
+# Factor tables the cached OLI values are calculated from
+CACHE_TABLES = ['./database/tables/RF.csv', './database/tables/PTS.csv',
+                './database/tables/RFE.csv', './database/tables/ASE.csv']
+# Cold builds with at least this many files are parsed across a process pool
+MIN_POOL_FILES = 32
+
+
+def parse_yaml(raw):
+    """Parses the raw contents of a yaml file.
+
+    Returns:
+        tuple: (data, error) where error is None if the file was parsed
+    """
+    try:
+        return yaml.load(raw, Loader=YAML_LOADER), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _file_hash(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _tables_hash():
+    sha = hashlib.sha256()
+    for table in CACHE_TABLES:
+        with open(table, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
 
 class EquipmentDatabase:
-    def __init__(self, weapon_dir, vehicle_dir):
+    def __init__(self, weapon_dir, vehicle_dir, cache_file=None):
+        """
+        Load all weapons and vehicles from their yaml files.
+
+        Args:
+            weapon_dir (str): Directory of the weapon yaml files
+            vehicle_dir (str): Directory of the vehicle yaml files
+            cache_file (str, optional): Compiled cache of the parsed and
+                calculated equipment. Only files that changed since the cache
+                was written are parsed again.
+        """
         self.weapon_dir = weapon_dir
         self.vehicle_dir = vehicle_dir
+        self.cache_file = cache_file
         self.weapons = {}
         self.vehicles = {}
+        # Names of the vehicles mounting each weapon, by weapon name
+        self.weapon_users = {}
 
+        self._cache = self._read_cache()
+        self._cache_dirty = False
+        self._changed_weapons = set()
+        # Names defined by more than one file, by table, as last warned about
+        self._duplicates = {'weapon': {}, 'vehicle': {}}
+        self._lock = threading.Lock()
+        self._watcher = None
         self.load_weapons()
         self.load_vehicles()
+        self._write_cache()
+
+    def _read_cache(self):
+        """Reads the cache file, discarding it if it is stale or unreadable."""
+        tables = _tables_hash()
+        empty = {'version': CACHE_VERSION, 'tables': tables, 'files': {}}
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return empty
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            logger.warning(f'Ignoring unreadable equipment cache {self.cache_file}: {str(e)}')
+            return empty
+        if cache.get('version') != CACHE_VERSION or cache.get('tables') != tables:
+            logger.info(f'Equipment cache {self.cache_file} is out of date, rebuilding')
+            return empty
+        return cache
+
+    def _write_cache(self):
+        if self.cache_file is None or not self._cache_dirty:
+            return
+        # Drop entries of files that no longer exist
+        files = self._cache['files']
+        for file in [f for f in files if not os.path.exists(f)]:
+            del files[file]
+        tmp = self.cache_file + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(self._cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.cache_file)
+            self._cache_dirty = False
+            logger.info(f'Wrote equipment cache {self.cache_file}')
+        except Exception as e:
+            logger.error(f'Failed to write equipment cache {self.cache_file}: {str(e)}')
+
+    def _scan(self, files):
+        """Returns the cache entries of files, parsing only files that changed.
+
+        A file whose modification time or size changed is hashed, and only
+        parsed again if its contents changed. Entries of parsed files have no
+        'object' until the equipment has been calculated.
+        """
+        cached = self._cache['files']
+        entries = {}
+        stale = []
+        for file in files:
+            try:
+                st = os.stat(file)
+                entry = cached.get(file)
+                if entry is not None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                    entries[file] = entry
+                    continue
+                with open(file, 'rb') as f:
+                    raw = f.read()
+            except OSError as e:
+                logger.error(f'Failed to read {file}: {str(e)}')
+                continue
+            sha = _file_hash(raw)
+            self._cache_dirty = True
+            if entry is not None and entry['sha'] == sha:
+                entry.update(mtime=st.st_mtime_ns, size=st.st_size)
+                entries[file] = entry
+            else:
+                stale.append((file, {'mtime': st.st_mtime_ns, 'size': st.st_size, 'sha': sha}, raw))
+
+        if len(stale) >= MIN_POOL_FILES and (os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor() as pool:
+                parsed = list(pool.map(parse_yaml, [raw for _, _, raw in stale], chunksize=8))
+        else:
+            parsed = [parse_yaml(raw) for _, _, raw in stale]
+        for (file, entry, _), (data, error) in zip(stale, parsed):
+            if error is not None:
+                logger.error(f'Failed to parse {file}: {error}')
+                cached.pop(file, None)
+                continue
+            entry.update(data=data, object=None)
+            cached[file] = entry
+            entries[file] = entry
+        return entries
+
+    @staticmethod
+    def _store(table, names, file, equipment, changed):
+        """Adds calculated equipment to table, updating the existing object of
+        the same name in place so references to it see the new values."""
+        old_name = names.get(file)
+        if old_name is not None and old_name != equipment.name:
+            # The file was renamed to other equipment
+            table.pop(old_name, None)
+            changed.add(old_name)
+        current = table.get(equipment.name)
+        if current is not None and current is not equipment:
+            if current.__dict__ == equipment.__dict__:
+                # Only formatting or comments changed
+                names[file] = current.name
+                return current
+            # Readers on other threads may use the object meanwhile, so
+            # replace its attributes without ever leaving them missing
+            stale = current.__dict__.keys() - equipment.__dict__.keys()
+            current.__dict__.update(equipment.__dict__)
+            for key in stale:
+                current.__dict__.pop(key, None)
+            equipment = current
+        table[equipment.name] = equipment
+        names[file] = equipment.name
+        changed.add(equipment.name)
+        return equipment
+
+    @staticmethod
+    def _remove_missing(table, names, entries, changed):
+        """Removes the equipment of files that are gone or no longer readable."""
+        for file in [f for f in names if f not in entries]:
+            name = names.pop(file)
+            table.pop(name, None)
+            changed.add(name)
+
+    def _warn_duplicates(self, kind, names):
+        """Warns once about every name that more than one file defines. Only
+        the equipment loaded last under such a name is used."""
+        files = {}
+        for file, name in names.items():
+            files.setdefault(name, []).append(file)
+        duplicates = {name: sorted(f) for name, f in files.items() if len(f) > 1}
+        if duplicates == self._duplicates[kind]:
+            return
+        for name, paths in duplicates.items():
+            if self._duplicates[kind].get(name) != paths:
+                logger.warning(f'{kind.capitalize()} {name} is defined by {len(paths)} files, '
+                               f'only one of them is used: {", ".join(paths)}')
+        self._duplicates[kind] = duplicates
 
     def load_weapons(self):
-        # Load all weapon YAML files from the weapon directory
-        logging.info('Loading weapons from {}'.format(self.weapon_dir))
+        """Loads the weapon yaml files that changed since they were last loaded.
+
+        Returns:
+            set: Names of the weapons that were added, changed or removed
+        """
+        logger.info('Loading weapons from {}'.format(self.weapon_dir))
         weapon_files = glob(f'{self.weapon_dir}/**/*.yaml', recursive=True) \
                     + glob(f'{self.weapon_dir}/**/*.yml', recursive=True)
+        entries = self._scan(weapon_files)
+        names = self._cache.setdefault('weapon_names', {})
+        changed = set()
+        self._remove_missing(self.weapons, names, entries, changed)
         for file in weapon_files:
-            try:
-                weapon = Weapon(file)
+            entry = entries.get(file)
+            if entry is None:
+                continue
+            weapon = entry['object']
+            if weapon is None:
+                try:
+                    weapon = Weapon(file, data=entry['data'])
+                except Exception as e:
+                    logger.error(f'Failed to load weapon from {file}: {str(e)}')
+                    continue
+                entry['object'] = self._store(self.weapons, names, file, weapon, changed)
+            elif self.weapons.get(weapon.name) is not weapon:
+                # Loaded from the cache
                 self.weapons[weapon.name] = weapon
-                logging.info(f'Weapon {weapon.name} loaded @ {weapon.q_OLI:,.2f}')
-            except Exception as e:
-                logging.error(f'Failed to load weapon from {file}: {str(e)}')
+                names[file] = weapon.name
+            else:
+                continue
+            logger.info(f'Weapon {weapon.name} loaded @ {weapon.q_OLI:,.2f}')
+        self._warn_duplicates('weapon', names)
+        if changed:
+            self._cache_dirty = True
+        self._changed_weapons = changed
+        return changed
 
     def load_vehicles(self):
-        # Load all vehicle YAML files from the vehicle directory
-        logging.info('Loading vehicles from {}'.format(self.vehicle_dir))
+        """Loads the vehicle yaml files that changed since they were last
+        loaded, and recalculates the vehicles mounting a changed weapon.
+
+        Returns:
+            set: Names of the vehicles that were added, changed or removed
+        """
+        logger.info('Loading vehicles from {}'.format(self.vehicle_dir))
         vehicle_files = glob(f'{self.vehicle_dir}/**/*.yaml', recursive=True) \
                     + glob(f'{self.vehicle_dir}/**/*.yml', recursive=True)
+        entries = self._scan(vehicle_files)
+        names = self._cache.setdefault('vehicle_names', {})
+        changed = set()
+        self._remove_missing(self.vehicles, names, entries, changed)
         for file in vehicle_files:
-            try:
-                vehicle = Vehicle(file, list(self.weapons.values()))
+            entry = entries.get(file)
+            if entry is None:
+                continue
+            vehicle = entry['object']
+            if vehicle is None or not self._changed_weapons.isdisjoint(vehicle.weapon_names):
+                try:
+                    vehicle = Vehicle(file, self.weapons, data=entry['data'])
+                except Exception as e:
+                    logger.error(f'Failed to load vehicle from {file}: {str(e)}')
+                    continue
+                entry['object'] = self._store(self.vehicles, names, file, vehicle, changed)
+            elif self.vehicles.get(vehicle.name) is not vehicle:
+                # Loaded from the cache
                 self.vehicles[vehicle.name] = vehicle
-                logging.info(f'Vehicle {vehicle.name} loaded @ {vehicle.q_OLI:,.2f}')
-            except Exception as e:
-                logging.error(f'Failed to load vehicle from {file}: {str(e)}')
+                names[file] = vehicle.name
+            else:
+                continue
+            logger.info(f'Vehicle {vehicle.name} loaded @ {vehicle.q_OLI:,.2f}')
+        self._warn_duplicates('vehicle', names)
+        if changed:
+            self._cache_dirty = True
+
+        self.weapon_users = {}
+        for vehicle in self.vehicles.values():
+            for weapon_name in vehicle.weapon_names:
+                self.weapon_users.setdefault(weapon_name, set()).add(vehicle.name)
+        return changed
+
+    def reload(self):
+        """Reloads the equipment files that changed on disk.
+
+        Only changed files are parsed again, and only the vehicles that mount
+        a changed weapon are recalculated. Existing equipment objects are
+        updated in place, so the objects referenced by formation elements
+        pick up the new values.
+
+        Returns:
+            set: Names of the weapons and vehicles that were added, changed or removed
+        """
+        with self._lock:
+            changed = self.load_weapons() | self.load_vehicles()
+            self._write_cache()
+        if changed:
+            logger.info(f'Reloaded equipment: {", ".join(sorted(changed))}')
+        return changed
+
+    def watch(self, interval=2.0, callback=None, lock=None):
+        """Polls the equipment files in a background thread and reloads them
+        when they change.
+
+        Args:
+            interval (float): Seconds between polls
+            callback (callable, optional): Called with the set of changed
+                equipment names after every reload that changed something
+            lock (optional): Lock held around each reload and its callback,
+                for the owner of the objects using the equipment
+
+        Returns:
+            threading.Thread: The watching thread
+        """
+        if self._watcher is not None:
+            return self._watcher
+        self._stop_watching = threading.Event()
+
+        def poll():
+            while not self._stop_watching.wait(interval):
+                try:
+                    with lock if lock is not None else nullcontext():
+                        changed = self.reload()
+                        if changed and callback is not None:
+                            callback(changed)
+                except Exception as e:
+                    logger.error(f'Failed to reload equipment: {str(e)}')
+
+        self._watcher = threading.Thread(target=poll, name='equipment-watch', daemon=True)
+        self._watcher.start()
+        logger.info(f'Watching {self.weapon_dir} and {self.vehicle_dir} for changes')
+        return self._watcher
+
+    def stop_watching(self):
+        """Stops the thread started by watch()."""
+        if self._watcher is None:
+            return
+        self._stop_watching.set()
+        self._watcher.join()
+        self._watcher = None
 
     def get_weapon(self, name):
         # Retrieve a weapon by its name
         if name in self.weapons:
             return self.weapons[name]
         else:
-            # logging.debug(f'Weapon {name} not found in database.')
+            # logger.debug(f'Weapon {name} not found in database.')
             return None
 
     def get_vehicle(self, name):
@@ -53,15 +360,26 @@ class EquipmentDatabase:
         if name in self.vehicles:
             return self.vehicles[name]
         else:
-            # logging.debug(f'Vehicle {name} not found in database.')
+            # logger.debug(f'Vehicle {name} not found in database.')
             return None
 
+    def get_dependent_vehicles(self, weapon_name):
+        """Returns the vehicles that mount a weapon.
+
+        Args:
+            weapon_name (str): Name of the weapon
+
+        Returns:
+            list: Vehicle objects whose OLI depends on the weapon
+        """
+        return [self.vehicles[v] for v in sorted(self.weapon_users.get(weapon_name, ()))
+                if v in self.vehicles]
+
     def initialize(self):
         # Initialize and load all equipment
-        logging.info('Initializing EquipmentDatabase...')
-        self.load_weapons()
-        self.load_vehicles()
-        logging.info('EquipmentDatabase initialized.')
+        logger.info('Initializing EquipmentDatabase...')
+        self.reload()
+        logger.info('EquipmentDatabase initialized.')
 
     def __repr__(self):
         return f"EquipmentDatabase({len(self.weapons)} Weapons & {len(self.vehicles)} Vehicles)"
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+# Number of events kept in memory before the oldest are dropped
+DEFAULT_CAPACITY = 10_000
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(module)s/%(funcName)s - %(message)s'
+
+
+class EventBuffer(logging.Handler):
+    """Logging handler that keeps the most recent records as structured events
+    in an in-memory ring buffer until they are drained.
+
+    Every event is a dictionary with the time, level, logger name, function and
+    message of the record, plus any fields passed to the logging call as
+    extra={'fields': {...}}. flush is the no-op of logging.Handler, so
+    logging.shutdown keeps the events; drain empties the buffer.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, level=logging.NOTSET):
+        super().__init__(level)
+        self.events = deque(maxlen=capacity)
+        self.dropped = 0
+        self._events_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            event = {'time': record.created,
+                     'level': record.levelname,
+                     'logger': record.name,
+                     'function': record.funcName,
+                     'message': record.getMessage()}
+            fields = getattr(record, 'fields', None)
+            if fields:
+                event.update(fields)
+        except Exception:
+            self.handleError(record)
+            return
+        with self._events_lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+
+    def records(self, level=logging.NOTSET):
+        """Returns a copy of the buffered events at or above a level."""
+        with self._events_lock:
+            events = list(self.events)
+        if level == logging.NOTSET:
+            return events
+        return [e for e in events if logging.getLevelName(e['level']) >= level]
+
+    def drain(self, file=None):
+        """Empties the buffer.
+
+        Args:
+            file (str, optional): Appends the events to this file as JSON lines
+
+        Returns:
+            list: The events that were buffered, oldest first
+        """
+        with self._events_lock:
+            events = list(self.events)
+            self.events.clear()
+            self.dropped = 0
+        if file is not None and events:
+            with open(file, 'a') as f:
+                for event in events:
+                    f.write(json.dumps(event, default=str) + '\n')
+        return events
+
+
+# Buffer of the engine events, attached to the root logger by configure_logging
+EVENTS = EventBuffer()
+# Log file handler installed by configure_logging
+_file_handler = None
+
+
+def configure_logging(level=logging.INFO, capacity=DEFAULT_CAPACITY, filename=None):
+    """Configures logging for an application using the engine.
+
+    The engine never configures logging itself. Records at or above level go
+    to the EVENTS ring buffer and, if filename is given, to that file. Calling
+    it again installs no second handler: the same file keeps its handler, and
+    another file replaces it.
+
+    Args:
+        level (int): Lowest level that is recorded
+        capacity (int): Number of events kept in the EVENTS buffer
+        filename (str, optional): Log file, truncated when logging is configured
+
+    Returns:
+        EventBuffer: The EVENTS buffer
+    """
+    global _file_handler
+    root = logging.getLogger()
+    root.setLevel(level)
+    with EVENTS._events_lock:
+        if EVENTS.events.maxlen != capacity:
+            EVENTS.events = deque(EVENTS.events, maxlen=capacity)
+    if EVENTS not in root.handlers:
+        root.addHandler(EVENTS)
+    if filename is not None:
+        installed = _file_handler is not None and _file_handler in root.handlers
+        if not installed or _file_handler.baseFilename != os.path.abspath(filename):
+            if installed:
+                root.removeHandler(_file_handler)
+                _file_handler.close()
+            _file_handler = logging.FileHandler(filename, mode='w')
+            _file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            root.addHandler(_file_handler)
+    return EVENTS
@@ -1,6 +1,11 @@
 import csv
 import bisect
 
+import numpy as np
+
+# Defense types in the row order of the advance rate table
+DEFENSE_TYPES = ('Hasty Defense', 'Prepared Defense', 'Fortified Defense')
+
 
 class LookupTable:
     """Base class for lookup tables."""
@@ -29,6 +34,11 @@ class StandardLookupTable(LookupTable):
                 self.name.append(row[0])
                 self.data[row[0]] = {self.headers[i]: float(row[i+1]) for i
                                      in range(len(self.headers))}
+        # Dense copy of the table for lookups by integer row and column codes
+        self.rows = {name: i for i, name in enumerate(self.name)}
+        self.columns = {header: i for i, header in enumerate(self.headers)}
+        self.values = np.array([[self.data[name][h] for h in self.headers] for name in self.name],
+                               dtype=float).reshape(len(self.name), len(self.headers))
 
     def get(self, key, column=None):
         """Fetches the data associated with the given key and optionally a
@@ -41,6 +51,16 @@ class StandardLookupTable(LookupTable):
         """Returns the list of column headers."""
         return self.headers
 
+    def code(self, key):
+        """Returns the integer code of a row label, its row in values."""
+        if key not in self.rows:
+            raise ValueError(f'{key!r} is not a row of {self.__class__.__name__} {self.name}')
+        return self.rows[key]
+
+    def compile(self, columns):
+        """Returns the values of the given columns as a (rows, columns) array."""
+        return self.values[:, [self.columns[c] for c in columns]]
+
 
 class InterpolatingLookupTable(LookupTable):
     """Interpolating lookup table for numerical data that allows interpolation
@@ -53,9 +73,17 @@ class InterpolatingLookupTable(LookupTable):
             for row in reader:
                 self.name.append(float(row[0]))
                 self.data.append(float(row[1]))
+        self.keys = np.array(self.name, dtype=float)
+        self.values = np.array(self.data, dtype=float)
 
     def interpolate(self, key):
-        """Interpolates to find the value associated with a numerical key."""
+        """Interpolates to find the value associated with a numerical key.
+
+        Values outside the table are clamped to its first and last values. If
+        key is an array, an array of the same shape is returned.
+        """
+        if np.ndim(key) > 0:
+            return self.interpolate_array(key)
         pos = bisect.bisect_left(self.name, key)
         if pos == 0:
             return self.data[0]
@@ -65,6 +93,17 @@ class InterpolatingLookupTable(LookupTable):
         x1, y1 = self.name[pos], self.data[pos]
         return y0 + (y1 - y0) * (key - x0) / (x1 - x0)
 
+    def interpolate_array(self, keys):
+        """Interpolates every element of an array of keys at once."""
+        keys = np.asarray(keys, dtype=float)
+        pos = np.searchsorted(self.keys, keys, side='left')
+        inner = np.clip(pos, 1, len(self.keys) - 1)
+        x0, x1 = self.keys[inner - 1], self.keys[inner]
+        y0, y1 = self.values[inner - 1], self.values[inner]
+        out = y0 + (y1 - y0) * (keys - x0) / (x1 - x0)
+        out = np.where(pos == 0, self.values[0], out)
+        return np.where(pos == len(self.keys), self.values[-1], out)
+
 class AdvanceRateTable():
     """Lookup table for advance rates.
         This is unique due to the semi-3d nature of the data"""
@@ -91,40 +130,52 @@ class AdvanceRateTable():
                     self.prepared.append(values)
                 elif defense_type == 'Fortified Defense':
                     self.fortified.append(values)
+        # Rates as a (defense types, power ratios, unit types) array
+        self.ratios = np.array(self.power_ratios, dtype=float)
+        self.values = np.array([self.hasty, self.prepared, self.fortified], dtype=float)
+        self.columns = {header: i for i, header in enumerate(self.headers)}
 
     def get_advance_rate(self, power_ratio, defense_type, unit_type=None):
-        """Get the advance rate for given parameters using interpolation"""
-        # Select correct defense array
-        if defense_type == 'Hasty Defense':
-            values = self.hasty
-        elif defense_type == 'Prepared Defense':
-            values = self.prepared
-        elif defense_type == 'Fortified Defense':
-            values = self.fortified
-        else:
-            raise ValueError("Invalid defense type")
+        """Get the advance rate for given parameters using interpolation
 
-        # If unit_type is None, return a dictionary with all unit types
+        If unit_type is None, returns a dictionary of the rates of all unit
+        types. If power_ratio is an array, arrays of the same shape are
+        returned.
+        """
+        if defense_type not in DEFENSE_TYPES:
+            raise ValueError("Invalid defense type")
+        rates = self.rates(power_ratio, DEFENSE_TYPES.index(defense_type))
         if unit_type is None:
-            return {unit: self.get_advance_rate(power_ratio, defense_type, unit)
-                    for unit in self.headers}
-        # Get unit type index
-        unit_index = self.headers.index(unit_type)
-        
-        # Find interpolation position
-        pos = bisect.bisect_left(self.power_ratios, power_ratio)
-        
-        # Handle edge cases
-        if pos == 0:
-            return values[0][unit_index]
-        if pos == len(self.power_ratios):
-            return values[-1][unit_index]
-            
-        # Interpolate
-        x0, x1 = self.power_ratios[pos-1], self.power_ratios[pos]
-        y0, y1 = values[pos-1][unit_index], values[pos][unit_index]
-        
-        return y0 + (y1 - y0) * (power_ratio - x0) / (x1 - x0)
+            return {unit: self._value(rates[..., i]) for i, unit in enumerate(self.headers)}
+        if unit_type not in self.columns:
+            raise ValueError(f"Invalid unit type {unit_type}")
+        return self._value(rates[..., self.columns[unit_type]])
+
+    @staticmethod
+    def _value(rate):
+        return float(rate) if np.ndim(rate) == 0 else rate
+
+    def rates(self, power_ratio, defense_type):
+        """Interpolates the advance rates of every unit type at once.
+
+        Args:
+            power_ratio (array): Power ratios
+            defense_type (array): Index into DEFENSE_TYPES, broadcast against
+                power_ratio
+
+        Returns:
+            array: Rates of shape power_ratio.shape + (unit types,) in headers order
+        """
+        power_ratio = np.asarray(power_ratio, dtype=float)
+        defense_type = np.broadcast_to(np.asarray(defense_type, dtype=int), power_ratio.shape)
+        pos = np.searchsorted(self.ratios, power_ratio, side='left')
+        inner = np.clip(pos, 1, len(self.ratios) - 1)
+        x0, x1 = self.ratios[inner - 1][..., None], self.ratios[inner][..., None]
+        y0 = self.values[defense_type, inner - 1]
+        y1 = self.values[defense_type, inner]
+        rates = y0 + (y1 - y0) * (power_ratio[..., None] - x0) / (x1 - x0)
+        rates = np.where((pos == 0)[..., None], self.values[defense_type, 0], rates)
+        return np.where((pos == len(self.ratios))[..., None], self.values[defense_type, -1], rates)
 
 # Create the needed data tables
 TERRAIN_FACTORS = StandardLookupTable('./database/tables/TerrainFactors.csv')
@@ -3,6 +3,9 @@ import logging
 from random import random
 from uuid import uuid1
 
+logger = logging.getLogger(__name__)
+
+
 class Formation():
     def __init__(self, file, weapon_dict, color=None):
         with open(file) as f:
@@ -27,11 +30,11 @@ class Formation():
             if key in weapon_dict:
                 self.equipment.update({weapon_dict[key]: [equip[key], equip[key], 0, 0]})
             else:
-                logging.warning('Formation.py: {} not found in database!'.format(key))
+                logger.warning('Formation.py: {} not found in database!'.format(key))
         self.calc_personnel()
 
 
-        logging.info(f'Loaded Formation: {self.name} w/ {self.personnel:,.0f} personnel @ {self.get_OLI():,.0f}')
+        logger.info(f'Loaded Formation: {self.name} w/ {self.personnel:,.0f} personnel @ {self.get_OLI():,.0f}')
 
     def __repr__(self,):
         return ('Formation({} [{}])'.format(self.name, self.faction))
@@ -74,10 +77,11 @@ class Formation():
             elif equip.category == 'aircraft':
                 OLI['Wy'] += equip.q_OLI * self.equipment[equip][1]
             else:
-                logging.warning('Unknown category: {}'.format(equip.category))
+                logger.warning('Unknown category: {}'.format(equip.category))
         return OLI
     
-    def inflict_losses(self, C, C_Arm, C_Arty, isAttacker):
+    def inflict_losses(self, C, C_Arm, C_Arty, isAttacker, rng=None):
+        # rng is an optional numpy.random.Generator used instead of the random module
         # base rates:
         CF_APC = 1.0
         CF_InfantryWeaps = 1.5
@@ -155,14 +159,15 @@ class Formation():
                 CR = C_Vehicles
                 RR = RF_Vehicles
             
-            self.casualty(e, CR, RR)
+            self.casualty(e, CR, RR, rng)
 
 
-    def casualty(self, e, CR, RR):
+    def casualty(self, e, CR, RR, rng=None):
         # inflict casualties according to a rate
+        draw = random if rng is None else rng.random
         for x in range(self.equipment[e][1]):
-            rollC = random()
-            rollR = random()
+            rollC = draw()
+            rollR = draw()
             if rollC < CR:
                 # roll was lower than casualty rate, reduce count by one
                 self.equipment[e][1] -= 1
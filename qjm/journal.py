@@ -0,0 +1,82 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Append-only journal of the changes made to a simulation since its last
+    checkpoint.
+
+    The journal is a file of JSON records, one per line. The first record
+    names the checkpoint the journal applies to, so a journal left behind by
+    an older checkpoint is never replayed on a newer one. Every record is
+    flushed to disk before append returns, and a record cut short by a crash
+    is dropped when the journal is opened again.
+    """
+    def __init__(self, filename, checkpoint_id, records=0):
+        self.filename = filename
+        self.checkpoint_id = checkpoint_id
+        self.records = records
+        self._file = open(filename, 'a', encoding='utf-8')
+
+    @classmethod
+    def create(cls, filename, checkpoint_id):
+        """Starts an empty journal for a checkpoint, replacing any old one."""
+        tmp = filename + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'type': 'checkpoint', 'checkpoint_id': checkpoint_id}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+        return cls(filename, checkpoint_id)
+
+    @classmethod
+    def open(cls, filename, checkpoint_id):
+        """Opens the journal of a checkpoint to replay and extend it.
+
+        Returns:
+            tuple: (journal, records) with the records to replay in order, or
+                (None, []) if there is no journal for the checkpoint
+        """
+        if checkpoint_id is None or not os.path.exists(filename):
+            return None, []
+        records = []
+        good = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f'Dropping incomplete record at the end of {filename}')
+                    break
+                if not line.endswith(b'\n'):
+                    logger.warning(f'Dropping incomplete record at the end of {filename}')
+                    break
+                records.append(record)
+                good += len(line)
+        if not records or records[0].get('type') != 'checkpoint' \
+                or records[0].get('checkpoint_id') != checkpoint_id:
+            logger.warning(f'Ignoring journal {filename} of another checkpoint')
+            return None, []
+        if good != os.path.getsize(filename):
+            with open(filename, 'r+b') as f:
+                f.truncate(good)
+        return cls(filename, checkpoint_id, len(records) - 1), records[1:]
+
+    def append(self, record):
+        """Writes a record and flushes it to disk."""
+        self._file.write(json.dumps(record, default=str) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records += 1
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return self.records
+
+    def __repr__(self):
+        return f'Journal({self.filename}, {self.records} records)'
@@ -0,0 +1,352 @@
+from functools import lru_cache
+
+import numpy as np
+
+from .factors import (
+    TERRAIN_FACTORS,
+    WEATHER_FACTORS,
+    SEASON_FACTORS,
+    POSTURE_FACTORS,
+    SURPRISE_FACTORS,
+    AIR_SUPERIORITY_FACTORS,
+    OPPOSITION_FACTORS,
+    STRENGTH_SIZE_FACTORS,
+    STRENGTH_SIZE_ARMOUR_FACTORS,
+    ADVANCE_RATE,
+    ADVANCE_TERRAIN,
+    ADVANCE_MINES,
+    ADVANCE_RIVER_FORDABLE,
+    ADVANCE_RIVER_UNFORDABLE,
+    SHORELINE_FACTORS,
+    DEFENSE_TYPES)
+
+# Era factors
+ERA_SURPRISE_FACTOR = 1.33  # 1.33 post 1966
+J_FACTOR = 15  # 20 for WW2, 15 for 1970s
+
+# Unit types that use the cavalry or armoured terrain advance factor
+_ADVANCE_CAVALRY = np.array([h in ['Armored', 'HorseCavalry'] for h in ADVANCE_RATE.headers])
+
+# Environment factors compiled once from the factor tables, as
+# (env key, column) pairs in the order they appear in the env dict
+TERRAIN_COLUMNS = (('rm', 'Mobility (r_m)'), ('rud', 'Defense Position (r_u)'),
+                   ('rn', 'Infantry Weapons (r_n)'), ('rwg', 'Artillery (r_wg)'),
+                   ('rwy', 'Air (r_wy)'), ('rwi', 'Tanks (r_wt)'), ('rc', 'Casualty (r_c)'))
+WEATHER_COLUMNS = (('hm', 'Mobility (h_m)'), ('hua', 'Attack (h_ua)'), ('hwg', 'Artillery (h_wg)'),
+                   ('hwy', 'Air (h_wy)'), ('hwi', 'Tanks (h_wt)'), ('hc', 'Casualties (h_c)'))
+SEASON_COLUMNS = (('zua', 'Attack (z_u)'), ('zwg', 'Artillery (z_wg)'), ('zwy', 'Air (z_wy)'))
+POSTURE_COLUMNS = (('usd', 'Strength (u_s)'), ('uvd', 'Vulnerability (u_v)'),
+                   ('uca', 'Attack Casualties (u_ca)'), ('ucd', 'Defense Casualties (u_cd)'))
+# Surprise factors, before the reduction for days since surprise
+SURPRISE_COLUMNS = (('Msur', 'Mobility Characteristics (Msur)'), ('Vsura', 'Vulnerability (Vsur)'),
+                    ('Vsurd', 'Surprised Vulnerability (Vsurd)'),
+                    ('su_c', 'Surprised Vulnerability (Vsurd)'),
+                    ('su_ct', 'Surprised Vulnerability (Vsurd)'))
+AIR_COLUMNS = ('Mobility (m_yd)', 'Mobility (m_yw)', 'Artillery (w_yg)', 'Air (w_yy)',
+               'Vulnerability (v_y)')
+ADVANCE_TERRAIN_COLUMNS = (('adv_inf', 'Infantry Force'), ('adv_cav', 'Cavalry or Armored Force'))
+
+# Air superiority codes; any other input is air equality
+AIR_SUPERIORITY, AIR_INFERIORITY, AIR_EQUALITY = range(3)
+AIR_CODES = {'Air Superiority': AIR_SUPERIORITY, 'Air Inferiority': AIR_INFERIORITY}
+# River obstacle codes
+RIVER_NONE, RIVER_FORDABLE, RIVER_UNFORDABLE = range(3)
+# Mine density code where there is no minefield
+NO_MINES = -1.0
+NO_SHORELINE = 'No shoreline'
+
+_TERRAIN = TERRAIN_FACTORS.compile([c for _, c in TERRAIN_COLUMNS])
+_WEATHER = WEATHER_FACTORS.compile([c for _, c in WEATHER_COLUMNS])
+_SEASON = SEASON_FACTORS.compile([c for _, c in SEASON_COLUMNS])
+_POSTURE = POSTURE_FACTORS.compile([c for _, c in POSTURE_COLUMNS])
+_SURPRISE = SURPRISE_FACTORS.compile([c for _, c in SURPRISE_COLUMNS]) * ERA_SURPRISE_FACTOR
+_AIR = AIR_SUPERIORITY_FACTORS.compile(AIR_COLUMNS)
+# Attacker and defender rows of the air superiority table by air code
+_AIR_SIDES = np.array([[AIR_SUPERIORITY_FACTORS.code(a), AIR_SUPERIORITY_FACTORS.code(d)] for a, d in
+                       [('Air Superiority', 'Air Inferiority'),
+                        ('Air Inferiority', 'Air Superiority'),
+                        ('Air Equality', 'Air Equality')]])
+_SHORELINE = SHORELINE_FACTORS.values
+# Advance terrain factors reordered to the rows of the terrain table
+_ADVANCE_TERRAIN = ADVANCE_TERRAIN.compile([c for _, c in ADVANCE_TERRAIN_COLUMNS])[
+    [ADVANCE_TERRAIN.code(t) for t in TERRAIN_FACTORS.name]]
+# Advance rate defense type by posture code, defaults to hasty defense
+_DEFENSE_TYPE = np.array([DEFENSE_TYPES.index(p) if p in DEFENSE_TYPES else 0
+                          for p in POSTURE_FACTORS.name])
+
+
+def encode_environment(battle_input):
+    """Converts the environment of a battle input into integer table codes.
+
+    Args:
+        battle_input (dict): Dictionary with all battle data information
+
+    Returns:
+        dict: Codes and obstacle values accepted by gather_environment
+
+    Raises:
+        ValueError: If a label is not in its factor table
+    """
+    shore_type = battle_input['shorelineType']
+    shore_fires = battle_input['shorelineFires']
+    if shore_type == NO_SHORELINE or shore_fires == NO_SHORELINE:
+        shore_fires, shore_type = -1, -1
+    else:
+        shore_fires = SHORELINE_FACTORS.code(shore_fires)
+        if shore_type not in SHORELINE_FACTORS.columns:
+            raise ValueError(f'{shore_type!r} is not a shoreline type {SHORELINE_FACTORS.headers}')
+        shore_type = SHORELINE_FACTORS.columns[shore_type]
+
+    if battle_input['riverObstacle'] == 'none':
+        river, river_width = RIVER_NONE, 0.0
+    else:
+        fordable, width = battle_input['riverObstacle'].split(' ')
+        river = RIVER_FORDABLE if fordable == 'fordable' else RIVER_UNFORDABLE
+        river_width = float(width)
+    if battle_input['mineObstacle'] == 'none':
+        mines = NO_MINES
+    else:
+        mines = float(battle_input['mineObstacle'])
+
+    return {'terrain': TERRAIN_FACTORS.code(battle_input['terrain']),
+            'weather': WEATHER_FACTORS.code(battle_input['weather']),
+            'season': SEASON_FACTORS.code(battle_input['season']),
+            'posture': POSTURE_FACTORS.code(battle_input['posture']),
+            'surprise': SURPRISE_FACTORS.code(battle_input['atksurprise']),
+            'air': AIR_CODES.get(battle_input['airsuperiority'], AIR_EQUALITY),
+            'shore_fires': shore_fires,
+            'shore_type': shore_type,
+            'river': river,
+            'river_width': river_width,
+            'mines': mines}
+
+
+def gather_environment(codes):
+    """Gathers the factors of one or many environments from the compiled tables.
+
+    Args:
+        codes (dict): Output of encode_environment, where every value may
+            also be an array to resolve many environments at once
+
+    Returns:
+        dict: Factor values keyed by their QJM symbol, arrays if codes are
+    """
+    terrain = _TERRAIN[codes['terrain']]
+    weather = _WEATHER[codes['weather']]
+    season = _SEASON[codes['season']]
+    posture = _POSTURE[codes['posture']]
+    surprise = _SURPRISE[codes['surprise']]
+    env = {}
+    for table, columns in ((terrain, TERRAIN_COLUMNS), (weather, WEATHER_COLUMNS),
+                           (season, SEASON_COLUMNS), (posture, POSTURE_COLUMNS),
+                           (surprise, SURPRISE_COLUMNS)):
+        for i, (key, _) in enumerate(columns):
+            env[key] = table[..., i]
+
+    # Obstacle Factors, the defender is not vulnerable on shorelines
+    shore_fires = np.asarray(codes['shore_fires'])
+    env['vra'] = np.where(shore_fires < 0, 1.0, _SHORELINE[shore_fires, codes['shore_type']])
+
+    # Air Superiority Factors, mobility depends on whether the weather is dry
+    sides = _AIR_SIDES[codes['air']]
+    atk_air, def_air = _AIR[sides[..., 0]], _AIR[sides[..., 1]]
+    dry = env['hwy'] > 0.5
+    env['atk_my'] = np.where(dry, atk_air[..., 0], atk_air[..., 1])
+    env['def_my'] = np.where(dry, def_air[..., 0], def_air[..., 1])
+    env['wyga'], env['wygd'] = atk_air[..., 2], def_air[..., 2]
+    env['wyya'], env['wyyd'] = atk_air[..., 3], def_air[..., 3]
+    env['vya'], env['vyd'] = atk_air[..., 4], def_air[..., 4]
+
+    # Advance rate factors
+    env['def_type'] = _DEFENSE_TYPE[codes['posture']]
+    advance = _ADVANCE_TERRAIN[codes['terrain']]
+    env['adv_inf'], env['adv_cav'] = advance[..., 0], advance[..., 1]
+    river, width = np.asarray(codes['river']), np.asarray(codes['river_width'], dtype=float)
+    env['adv_river'] = np.where(river == RIVER_NONE, 1.0,
+                                np.where(river == RIVER_FORDABLE,
+                                         ADVANCE_RIVER_FORDABLE.interpolate_array(width),
+                                         ADVANCE_RIVER_UNFORDABLE.interpolate_array(width)))
+    mines = np.asarray(codes['mines'], dtype=float)
+    env['adv_mine'] = np.where(mines == NO_MINES, 1.0, ADVANCE_MINES.interpolate_array(mines))
+    return env
+
+
+@lru_cache(maxsize=1024)
+def _environment_bundle(codes):
+    env = gather_environment(dict(codes))
+    env['def_type'] = int(env['def_type'])
+    return {k: v if isinstance(v, int) else float(v) for k, v in env.items()}
+
+
+def resolve_environment(battle_input):
+    """Looks up every environmental factor used by the battle kernel.
+
+    The factors of each distinct environment are gathered from the compiled
+    tables once and cached.
+
+    Args:
+        battle_input (dict): Dictionary with all battle data information
+
+    Returns:
+        dict: Factor values keyed by their QJM symbol
+    """
+    return dict(_environment_bundle(tuple(encode_environment(battle_input).items())))
+
+
+def battle_kernel(atk_oli, def_oli, Na, Nd, Nia, Nid, Ja, Jd, env,
+                  atkcev, defcev, surprise_days, duration, road_quality,
+                  road_density, dispersion):
+    """Resolves N battles at once using the QJM method.
+
+    All inputs are broadcast against each other, so scalars may be mixed with
+    arrays of length N.
+
+    Args:
+        atk_oli (array): (N, 8) attacker OLI values in OLI_CATEGORIES order,
+            including aircraft sorties
+        def_oli (array): (N, 8) defender OLI values in OLI_CATEGORIES order
+        Na, Nd (array): Active personnel strength
+        Nia, Nid (array): Armour strength
+        Ja, Jd (array): Vehicle strength (J) before the era factor
+        env (dict): Environmental factors, as from resolve_environment
+        atkcev, defcev (array): Combat effectiveness values
+        surprise_days (array): Days since the attacker's surprise
+        duration (array): Battle duration in hours
+        road_quality, road_density (array): Advance rate road factors
+        dispersion (array): Scenario dispersion factor
+
+    Returns:
+        dict: Arrays of length N for the power ratio, casualty rates and
+            intermediate values, plus an (N, unit types) 'advanceRate' array
+            in ADVANCE_RATE.headers order. Battles where a side has no
+            personnel or strength give non-finite values, callers resolving
+            batches of battles run the kernel under np.errstate.
+    """
+    atk_oli = np.array(atk_oli, dtype=float, ndmin=2)
+    def_oli = np.array(def_oli, dtype=float, ndmin=2)
+    columns = [Na, Nd, Nia, Nid, Ja, Jd, atkcev, defcev, surprise_days, duration,
+               road_quality, road_density, dispersion, *env.values()]
+    n = max(len(atk_oli), len(def_oli), *(np.size(x) for x in columns))
+    atk_oli = np.broadcast_to(atk_oli, (n, 8))
+    def_oli = np.broadcast_to(def_oli, (n, 8))
+
+    def col(x):
+        return np.broadcast_to(np.asarray(x, dtype=float), (n,))
+
+    env = {k: col(v) for k, v in env.items()}
+
+    Na, Nd, Nia, Nid, Ja, Jd = col(Na), col(Nd), col(Nia), col(Nid), col(Ja), col(Jd)
+    atkcev, defcev = col(atkcev), col(defcev)
+    surprise_days, duration = col(surprise_days), col(duration)
+    road_quality, road_density, dispersion = col(road_quality), col(road_density), col(dispersion)
+
+    a_sa, a_mg, a_hw, a_at, a_art, a_aa, a_arm, a_air = atk_oli.T
+    d_sa, d_mg, d_hw, d_at, d_art, d_aa, d_arm, d_air = def_oli.T
+
+    # correct values of antitank, antiair, and aircraft by enemy values
+    a_at = np.where(a_at > d_arm, d_arm + 0.5 * (a_at - d_arm), a_at)
+    d_at = np.where(d_at > a_arm, a_arm + 0.5 * (d_at - a_arm), d_at)
+    a_aa = np.where(a_aa > d_air, d_air + 0.5 * (a_aa - d_air), a_aa)
+    d_aa = np.where(d_aa > a_air, a_air + 0.5 * (d_aa - a_air), d_aa)
+    atk_ground = (a_sa + a_mg + a_hw + a_at + a_art + a_aa + a_arm + a_air) - a_air
+    def_ground = (d_sa + d_mg + d_hw + d_at + d_art + d_aa + d_arm + d_air) - d_air
+    a_air = np.where(a_air > atk_ground, atk_ground + 0.5 * (a_air - atk_ground), a_air)
+    a_air = np.where(a_air > 3 * atk_ground, 3 * atk_ground, a_air)
+    d_air = np.where(d_air > def_ground, def_ground + 0.5 * (d_air - def_ground), d_air)
+    d_air = np.where(d_air > 3 * def_ground, 3 * def_ground, d_air)
+
+    # Factors fixed for each side
+    rua = 1.0
+    hud = 1.0
+    zud = 1.0
+    usa = 1.0
+    uva = 1.0
+    vrd = 1.0
+
+    # Update surprise factors for duration, all trend to 1.0 and reduce by 1/3 for each day
+    Msur  = 1.0 + (env['Msur']-1.0) * (3-surprise_days)/3
+    Vsura = 1.0 + (env['Vsura']-1.0) * (3-surprise_days)/3
+    Vsurd = 1.0 + (env['Vsurd']-1.0) * (3-surprise_days)/3
+    su_c  = 1.0 + (env['su_c']-1.0) * (3-surprise_days)/3
+    su_ct = 1.0 + (env['su_ct']-1.0) * (3-surprise_days)/3
+
+    rn, rwg, rwi, rwy = env['rn'], env['rwg'], env['rwi'], env['rwy']
+    hwg, hwi, hwy = env['hwg'], env['hwi'], env['hwy']
+    zwg, zwy = env['zwg'], env['zwy']
+
+    # Force strength
+    atk_S = (((a_sa + a_mg + a_hw) * rn)
+            + (a_at * rn)
+            + ((a_art + a_aa) * (rwg * hwg * zwg * env['wyga']))
+            + (a_arm * rwi * hwi)
+            + (a_air * rwy * hwy * zwy * env['wyya']))
+    def_S = (((d_sa + d_mg + d_hw) * rn)
+            + (d_at * rn)
+            + ((d_art + d_aa) * (rwg * hwg * zwg * env['wygd']))
+            + (d_arm * rwi * hwi)
+            + (d_air * rwy * hwy * zwy * env['wyyd']))
+
+    # Mobility
+    atk_M = (((Na + J_FACTOR*Ja + a_arm) * env['atk_my'] / Na) / ((Nd + J_FACTOR*Jd + d_arm) * env['def_my'] / Nd))**0.5 * Msur
+    atk_m = atk_M - (1-env['rm']*env['hm'])*(atk_M-1)  # operational mobility, different than M
+    def_m = np.ones(n)
+
+    # Vulnerability
+    atk_V = Na * uva/rua * (def_S/atk_S)**0.5 * env['vya'] * env['vra'] * Vsura
+    def_V = Nd * env['uvd']/env['rud'] * (atk_S/def_S)**0.5 * env['vyd'] * vrd * Vsurd
+    atk_VS = np.where(atk_V / atk_S > 0.3, 0.3 + 0.1*(atk_V/atk_S - 0.3), atk_V/atk_S)
+    def_VS = np.where(def_V / def_S > 0.3, 0.3 + 0.1*(def_V/def_S - 0.3), def_V/def_S)
+    atk_v = 1 - atk_VS * dispersion/3000
+    def_v = 1 - def_VS * dispersion/3000
+    atk_v = np.where(atk_v < 0.6, 0.6, atk_v)
+    def_v = np.where(def_v < 0.6, 0.6, def_v)
+
+    # Combat power
+    atk_P = atk_S * atk_m * usa * rua * env['hua'] * env['zua'] * atk_v * atkcev
+    def_P = def_S * def_m * env['usd'] * env['rud'] * hud * zud * def_v * defcev
+    PRatio = atk_P / def_P
+
+    # Casualty factors
+    ca_power    = OPPOSITION_FACTORS.interpolate_array(PRatio)
+    cd_power    = OPPOSITION_FACTORS.interpolate_array(1/PRatio)
+    ca_strength = STRENGTH_SIZE_FACTORS.interpolate_array(Na)
+    cd_strength = STRENGTH_SIZE_FACTORS.interpolate_array(Nd)
+    ca_arm      = STRENGTH_SIZE_ARMOUR_FACTORS.interpolate_array(Nia)
+    cd_arm      = STRENGTH_SIZE_ARMOUR_FACTORS.interpolate_array(Nid)
+    # Scales linearly between 4 hours to 24 hours
+    c_duration = duration/24
+    c_duration = np.where(c_duration < 4/24, 4/24, c_duration)
+    c_duration = np.where(c_duration > 1, 1, c_duration)
+    # TODO - factor in Attrition is 0.04, 0.028 in NPW, why?
+    ca  = 0.028 * env['rc'] * env['hc'] * env['uca'] * ca_strength * ca_power * c_duration
+    cia = ca * 6.0 * ca_arm * defcev
+    cga = ca * defcev
+    # TODO - factor in Attrition is 0.04, 0.015 in NPW, why?
+    cd  = 0.015 * env['rc'] * env['hc'] * env['ucd'] * cd_strength * cd_power * su_c * c_duration
+    cid = cd * 3.0 * cd_arm * su_ct * atkcev
+    cgd = cd * atkcev
+
+    # Advance rates, base rate by defense type modified by other factors
+    base = ADVANCE_RATE.rates(PRatio, env['def_type'].astype(int))
+    adv_terrain = np.where(_ADVANCE_CAVALRY, env['adv_cav'][:, None], env['adv_inf'][:, None])
+    adv = (base * adv_terrain * road_quality[:, None] * road_density[:, None]
+           * env['adv_river'][:, None] * env['adv_mine'][:, None] * c_duration[:, None])
+
+    return {'powerRatio': PRatio,
+            'powerAtk': atk_P,
+            'powerDef': def_P,
+            'atkPersCasualtyRate': ca,
+            'atkTankCasualtyRate': cia,
+            'atkArtilleryCasualtyRate': cga,
+            'defPersCasualtyRate': cd,
+            'defTankCasualtyRate': cid,
+            'defArtilleryCasualtyRate': cgd,
+            'advanceRate': adv,
+            'atk_S': atk_S, 'def_S': def_S,
+            'atk_M': atk_M,
+            'atk_m': atk_m, 'def_m': def_m,
+            'atk_V': atk_V, 'def_V': def_V,
+            'atk_v': atk_v, 'def_v': def_v,
+            'ca_power': ca_power, 'cd_power': cd_power,
+            'ca_strength': ca_strength, 'cd_strength': cd_strength,
+            'ca_arm': ca_arm, 'cd_arm': cd_arm}
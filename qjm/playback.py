@@ -0,0 +1,111 @@
+from bisect import bisect_right
+
+import numpy as np
+
+
+class Timeline:
+    """Frames of the positions and strengths of the formations on every
+    snapshot date of a range, precomputed for playback.
+
+    A frame only holds the units that changed since the previous frame. A
+    unit is the location of a formation, which carries over from earlier
+    snapshots without one, including snapshots before the range, and its
+    strength as the assigned and available personnel and equipment counts
+    of its latest snapshot.
+    """
+    def __init__(self, history, start, end):
+        """
+        Args:
+            history (toe.HistoryStore): Snapshots of the formations
+            start (str): First datecode of the range
+            end (str): Last datecode of the range, inclusive
+        """
+        self.start = start
+        self.end = end
+        self.dates = []
+        self.frames = []
+        totals = history.totals()
+        # Locations from before the range carry into the first frame
+        units = {formation_id: {'location': location, 'strength': None}
+                 for formation_id, location in history.located_before(start)[1].items()}
+        previous = np.full(len(history.formations), -1, dtype=np.int32)
+        for datecode, versions in history.timeline(start, end):
+            changed = {}
+            for f in np.flatnonzero(versions != previous).tolist():
+                version = int(versions[f])
+                formation_id = history.formations[f]
+                location = history.locations.get(version)
+                if location is None and formation_id in units:
+                    location = units[formation_id]['location']
+                unit = {'location': location, 'strength': totals[version].tolist()}
+                if unit != units.get(formation_id):
+                    changed[formation_id] = unit
+                    units[formation_id] = unit
+            previous = versions
+            self.dates.append(datecode)
+            self.frames.append(changed)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def index(self, datecode):
+        """Returns the index of the last frame on or before a datecode, or 0."""
+        return max(bisect_right(self.dates, datecode) - 1, 0)
+
+    def keyframe(self, index):
+        """Returns every unit as of a frame."""
+        units = {}
+        for frame in self.frames[:index + 1]:
+            units.update(frame)
+        return units
+
+
+class Playback:
+    """Position of a client in a Timeline.
+
+    The transport calls next_frame at the playback interval while playing.
+    Frames are messages of the frame index, its datecode and the units that
+    changed, or every unit when keyframe is True.
+    """
+    def __init__(self, timeline, interval=1.0):
+        self.timeline = timeline
+        self.interval = interval
+        # Index of the last frame sent, -1 before the first one
+        self.position = -1
+        self.playing = False
+        # Incremented on every play, so a superseded playback loop can stop
+        self.generation = 0
+
+    def _message(self, index, units, keyframe):
+        return {'index': index, 'date': self.timeline.dates[index], 'count': len(self.timeline),
+                'units': units, 'keyframe': keyframe}
+
+    def play(self):
+        """Starts playing and returns the generation of the playback loop."""
+        if self.position >= len(self.timeline) - 1:
+            self.position = -1
+        self.playing = True
+        self.generation += 1
+        return self.generation
+
+    def pause(self):
+        self.playing = False
+
+    def next_frame(self):
+        """Returns the next frame message, or None at the end of the timeline."""
+        if self.position >= len(self.timeline) - 1:
+            self.playing = False
+            return None
+        self.position += 1
+        return self._message(self.position, self.timeline.frames[self.position],
+                             self.position == 0)
+
+    def seek(self, index=None, datecode=None):
+        """Moves to a frame by index or datecode and returns it as a keyframe,
+        or None if the timeline is empty."""
+        if not len(self.timeline):
+            return None
+        if index is None:
+            index = self.position if datecode is None else self.timeline.index(datecode)
+        self.position = min(max(int(index), 0), len(self.timeline) - 1)
+        return self._message(self.position, self.timeline.keyframe(self.position), True)
@@ -1,4 +1,4 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from enum import Enum
 
 """ DATA CLASSES AND CONTAINERS """
@@ -11,6 +11,11 @@ class CasualtyRates:
     attacker: bool
 
 
+# Column order used when FormationOLI values are packed into arrays
+OLI_CATEGORIES = ('small_arms', 'machine_guns', 'heavy_weapons', 'antitank',
+                  'artillery', 'antiair', 'armour', 'aircraft')
+
+
 class FormationOLI:
     """Container for the OLI (Operational Lethality Index) of a formation."""
     def __init__(self, small_arms=0.0, machine_guns=0.0, heavy_weapons=0.0, antitank=0.0,
@@ -29,6 +34,17 @@ class FormationOLI:
               + self.antitank + self.artillery + self.antiair + self.armour
               + self.aircraft)
 
+    def to_list(self):
+        """Returns the OLI categories in the column order of OLI_CATEGORIES."""
+        return [getattr(self, c) for c in OLI_CATEGORIES]
+
+    def copy(self):
+        return FormationOLI(*self.to_list())
+
+    def to_dict(self):
+        """Returns the OLI categories as a dictionary keyed by OLI_CATEGORIES."""
+        return dict(zip(OLI_CATEGORIES, self.to_list()))
+
     def __add__(self, other):
         return FormationOLI(self.small_arms + other.small_arms,
                              self.machine_guns + other.machine_guns,
@@ -70,8 +86,10 @@ class BattleData:
     Nid: int = 0
     Ja: int = 0
     Jd: int = 0
+    environment: dict = field(default_factory=dict)  # factors by QJM symbol
     atk_S: float = 0.0
     def_S: float = 0.0
+    atk_M: float = 0.0
     atk_m: float = 0.0
     def_m: float = 1.0
     atk_V: float = 0.0
@@ -81,6 +99,12 @@ class BattleData:
     atk_P: float = 0.0
     def_P: float = 0.0
     PRatio: float = 0.0
+    ca_power: float = 0.0
+    cd_power: float = 0.0
+    ca_strength: float = 0.0
+    cd_strength: float = 0.0
+    ca_arm: float = 0.0
+    cd_arm: float = 0.0
 
     # Results
     powerRatio: float = 0.0
@@ -88,8 +112,24 @@ class BattleData:
     powerDef: float = 0.0
     atkPersCasualtyRate: float = 0.0
     atkTankCasualtyRate: float = 0.0
+    atkArtilleryCasualtyRate: float = 0.0
     defPersCasualtyRate: float = 0.0
     defTankCasualtyRate: float = 0.0
+    defArtilleryCasualtyRate: float = 0.0
+    advanceRate: dict = field(default_factory=dict)
+
+    # Seconds spent in each stage of the resolution
+    timings: dict = field(default_factory=dict)
+
+    def to_dict(self):
+        """Returns the battle data as a JSON serialisable dictionary."""
+        data = {}
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if isinstance(value, FormationOLI):
+                value = value.to_dict()
+            data[f.name] = value
+        return data
 
 
 class LossRateFactors:
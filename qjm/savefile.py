@@ -0,0 +1,213 @@
+import os
+import mmap
+import pickle
+import struct
+
+import numpy as np
+
+from toe import HistoryStore
+from toe.history import VERSION_COLUMNS, ROW_COLUMNS
+
+MAGIC = b'QJMSAVE'
+CONTAINER_VERSION = 1
+# Magic, container version and offset of the index
+HEADER = struct.Struct('<7sBQ')
+# Sections start on multiples of this, so arrays can be viewed in place
+ALIGNMENT = 64
+
+# Fields of a formation record that are kept in the list of formations of
+# the save rather than in the section of the formation
+SUMMARY_FIELDS = ('id', 'name', 'shortname', 'fullshortname', 'faction')
+
+
+def is_save_container(filename):
+    """Returns True if the file is a save container rather than a pickle."""
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class SaveWriter:
+    """Writes a save container: a header, a sequence of sections and an index
+    of the sections at the end.
+
+    Sections are either pickled objects or raw numpy arrays. Array sections
+    start on an ALIGNMENT boundary, so SaveReader can return arrays that view
+    the memory mapped file instead of copying it.
+    """
+    def __init__(self, file):
+        """
+        Args:
+            file: Binary file object open for writing, positioned at its start
+        """
+        self.file = file
+        self.index = {}
+        # Summaries of the formations and the element records they share
+        self.formations = []
+        self.elements = {}
+        file.write(HEADER.pack(MAGIC, CONTAINER_VERSION, 0))
+
+    def _align(self):
+        self.file.write(b'\0' * (-self.file.tell() % ALIGNMENT))
+        return self.file.tell()
+
+    def add_object(self, name, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.index[name] = ('object', offset, len(data))
+
+    def add_array(self, name, array):
+        array = np.ascontiguousarray(array)
+        offset = self._align()
+        self.file.write(array.tobytes())
+        self.index[name] = ('array', offset, array.dtype.str, array.shape)
+
+    def add_formation(self, record, parent=None):
+        """Adds the record of a formation, made by Formation.to_record without
+        recursion, as its own section.
+
+        The SUMMARY_FIELDS of the record go to the list of formations of the
+        save instead, and its element records are replaced by their position
+        in a table of the distinct records of the save.
+
+        Args:
+            record (dict): Record of the formation
+            parent (str, optional): Id of the parent formation
+        """
+        record = dict(record)
+        summary = {field: record.pop(field) for field in SUMMARY_FIELDS}
+        summary['parent'] = parent
+        self.formations.append(summary)
+        for key in ('personnel', 'vehicles'):
+            record[key] = [self.elements.setdefault(r, len(self.elements)) for r in record[key]]
+        self.add_object('formation/' + summary['id'], record)
+
+    def add_history(self, history):
+        """Adds the columns of a HistoryStore as arrays.
+
+        Args:
+            history (HistoryStore): Snapshots of the formations
+        """
+        arrays, index = history.arrays()
+        for name, array in arrays.items():
+            self.add_array('history/' + name, array)
+        self.add_object('history/index', index)
+
+    def close(self):
+        """Writes the formation and element tables and the index, and points
+        the header at the index."""
+        self.add_object('formations', self.formations)
+        self.add_object('elements', list(self.elements))
+        offset = self.file.tell()
+        self.file.write(pickle.dumps(self.index, protocol=pickle.HIGHEST_PROTOCOL))
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, CONTAINER_VERSION, offset))
+        self.file.seek(0, os.SEEK_END)
+
+
+class SaveReader:
+    """Reads sections of a save container on demand.
+
+    Opening a save only reads its index and metadata. Formation records are
+    unpickled one formation at a time, and the formation histories are arrays
+    that view the memory mapped file, so reading the history of one formation
+    or one date across all formations leaves the rest of the save on disk.
+
+    Arrays returned by the reader are read only and stay valid after the
+    reader is closed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, offset = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{filename} is not a save container')
+        if version != CONTAINER_VERSION:
+            raise ValueError(f'{filename} has unsupported container version {version}')
+        self.index = pickle.loads(self._map[offset:])
+        self.meta = self.object('meta')
+        self._formations = None
+        self._elements = None
+        self._history = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # Arrays still view the file, it is unmapped once they are gone
+            pass
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def object(self, name):
+        """Unpickles an object section."""
+        _, offset, length = self.index[name]
+        return pickle.loads(self._map[offset:offset + length])
+
+    def array(self, name):
+        """Returns an array section as a read only view of the file."""
+        _, offset, dtype, shape = self.index[name]
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if count == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.frombuffer(self._map, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    def formations(self, fullshortname=None):
+        """Lists the saved formations as dictionaries of their id, name,
+        shortname, fullshortname, faction and parent id.
+
+        Args:
+            fullshortname (str, optional): Only list formations with this fullshortname
+        """
+        if self._formations is None:
+            self._formations = self.object('formations')
+        formations = self._formations
+        if fullshortname is not None:
+            formations = [f for f in formations if f['fullshortname'] == fullshortname]
+        return formations
+
+    def formation(self, formation_id):
+        """Returns the record of a formation, see Formation.to_record. Its
+        subunits are listed by id and its snapshots are read with history()."""
+        if self._elements is None:
+            self._elements = self.object('elements')
+            self._summaries = {f['id']: f for f in self.formations()}
+        record = self.object('formation/' + formation_id)
+        summary = self._summaries[formation_id]
+        record.update({field: summary[field] for field in SUMMARY_FIELDS})
+        for key in ('personnel', 'vehicles'):
+            record[key] = [self._elements[i] for i in record[key]]
+        return record
+
+    def history_store(self):
+        """Returns the HistoryStore of the save. Its arrays view the file."""
+        if self._history is None:
+            arrays = {name: self.array('history/' + name) for name in VERSION_COLUMNS + ROW_COLUMNS}
+            self._history = HistoryStore.from_arrays(arrays, self.object('history/index'),
+                                                     copy=False)
+        return self._history
+
+    def dates(self):
+        """Lists the datecodes with snapshots in the save."""
+        return list(self.history_store().dates)
+
+    def history(self, formation_id):
+        """Returns the snapshots of a formation by datecode, as in
+        Formation.status_history."""
+        return self.history_store().history(formation_id)
+
+    def snapshot(self, datecode):
+        """Returns the snapshots of every formation on a datecode, by formation id."""
+        return self.history_store().snapshot(datecode)
+
+    def __repr__(self):
+        return f'SaveReader({self.filename}, {len(self.index)} sections)'
@@ -4,6 +4,9 @@ import numpy as np
 import logging
 
 from qjm import EquipmentOLICategory, VehicleCategory
+from .weapon import YAML_LOADER
+
+logger = logging.getLogger(__name__)
 
 
 # load in interpolation arrays
@@ -25,9 +28,13 @@ with open('./database/tables/ASE.csv') as f:
         ASE_ASE.append(float(row[1]))
 
 class Vehicle:
-    def __init__(self, file, weapons):
-        with open(file) as f:
-            data = yaml.full_load(f)
+    def __init__(self, file, weapons, data=None):
+        # weapons maps weapon names to Weapon objects, such as
+        # EquipmentDatabase.weapons. data is the already parsed yaml of file,
+        # if available
+        if data is None:
+            with open(file) as f:
+                data = yaml.load(f, Loader=YAML_LOADER)
 
         self.name = data.get('name', 'Unknown')
         self.description = data.get('description', 'No Description')
@@ -36,6 +43,8 @@ class Vehicle:
         self.category = data.get('category', 'unknown')
         self.d_sp_arty = None  # to solve error in casualty calculation
         d_weapons = data.get('weapons', [])
+        # names of the mounted weapons, in mount order
+        self.weapon_names = list(d_weapons) if d_weapons is not None else []
         d_speed = data.get('speed', 0)
         d_range = data.get('op_range', 0)
         d_weight = data.get('weight', 0)
@@ -64,7 +73,7 @@ class Vehicle:
             self.oli_category = EquipmentOLICategory.aircraft
         else:
             self.oli_category = EquipmentOLICategory.unknown
-            logging.error(f'Weapon {self.name} has unknown category {self.category}')
+            logger.error(f'Weapon {self.name} has unknown category {self.category}')
 
         # set the vehicle category
         if self.vehicle_type == 'tank':
@@ -91,17 +100,18 @@ class Vehicle:
             self.qjm_vehicle_category = VehicleCategory.helicopter
         else:
             self.qjm_vehicle_category = VehicleCategory.unknown
-            logging.error(f'Vehicle {self.name} has unknown category {self.vehicle_type}')
+            logger.error(f'Vehicle {self.name} has unknown category {self.vehicle_type}')
 
         # calculated values
         # sum up weapon values
         d_weaps = []
         q_weaps = 0
         if d_weapons is not None:
+            # mounted weapons are looked up by name, missing weapons are skipped.
+            # A name maps to one weapon, EquipmentDatabase warns about duplicates
             for dw in d_weapons:
-                for w in weapons:
-                    if dw == w.name:
-                        d_weaps.append(w)
+                if dw in weapons:
+                    d_weaps.append(weapons[dw])
             
             for i, w in enumerate(d_weaps):
                 # Special handling for aircraft, all weapons count 100%
@@ -1,60 +1,112 @@
+import os
 import pickle
+import hashlib
 import json
 import yaml
 import logging
 from glob import glob
 import datetime
+import itertools
+import threading
+import time
+from functools import wraps
+from uuid import uuid4
+from concurrent.futures import ProcessPoolExecutor
 
-from toe import Formation, TOE_Database
+import numpy as np
+
+from toe import (Formation, TOE_Database, ElementStore, ElementStatus, HistoryStore,
+                 LossPlan, loss_probabilities, replicate_losses)
 
-from .vehicle import Vehicle
 from .equipment_database import EquipmentDatabase
-from .factors import (
-    TERRAIN_FACTORS,
-    WEATHER_FACTORS,
-    SEASON_FACTORS,
-    POSTURE_FACTORS,
-    SURPRISE_FACTORS,
-    AIR_SUPERIORITY_FACTORS,
-    OPPOSITION_FACTORS,
-    STRENGTH_SIZE_FACTORS,
-    STRENGTH_SIZE_ARMOUR_FACTORS,
-    ADVANCE_RATE,
-    ADVANCE_TERRAIN,
-    ADVANCE_MINES,
-    ADVANCE_RIVER_FORDABLE,
-    ADVANCE_RIVER_UNFORDABLE,
-    SHORELINE_FACTORS)
+from .factors import ADVANCE_RATE
+from .kernel import battle_kernel, resolve_environment, encode_environment, gather_environment
 from .qjm_data_classes import (CasualtyRates,
                                FormationOLI,
-                               VehicleCategory,
                                BattleData)
+from .journal import Journal
+from .playback import Timeline
+from .savefile import SaveWriter, SaveReader, is_save_container
 from .utils import gist
 
-# Setup debug logging to an empty file
-logging.basicConfig(
-    filename='debug.log',
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(module)s/%(funcName)s - %(message)s'
-)
-with open('debug.log', 'w') as f:
-    f.write('')
-
+# Logging is configured by the application, see qjm.events.configure_logging
+logger = logging.getLogger(__name__)
+
+# Journal records after which saving writes a new checkpoint instead
+MAX_JOURNAL_RECORDS = 500
+
+# Version of the save format written by save_sim_state. Older saves are
+# pickles, of formation records if they have a version and of Formation
+# objects if they do not.
+SAVE_FORMAT = 4
+
+# Below this many loss replications a process pool costs more than it saves
+MIN_POOL_REPLICATIONS = 500
+
+# Battle input fields Wargame.sweep can vary
+SWEEP_FIELDS = ('terrain', 'weather', 'season', 'posture', 'airsuperiority', 'atksurprise',
+                'atksurprisedays', 'atkcev', 'defcev', 'battleDuration', 'roadQuality',
+                'roadDensity', 'riverObstacle', 'mineObstacle', 'shorelineType', 'shorelineFires')
+# Kernel results reported for each swept battle, besides the advance rates
+SWEEP_RESULTS = ('powerRatio', 'powerAtk', 'powerDef',
+                 'atkPersCasualtyRate', 'atkTankCasualtyRate', 'atkArtilleryCasualtyRate',
+                 'defPersCasualtyRate', 'defTankCasualtyRate', 'defArtilleryCasualtyRate')
+# Kernel results returned by simulate_battle
+BATTLE_RESULTS = SWEEP_RESULTS + ('advanceRate',)
+# Swept battles resolved per kernel call, to bound memory use
+SWEEP_CHUNK = 50_000
 
 GLOBAL_TOE_DATABASE = TOE_Database()
 GLOBAL_TOE_DATABASE.load_database()
 
 
+def locked(method):
+    """Runs a Wargame method while holding the wargame lock."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Wargame:
-    def __init__(self):
+    def __init__(self, element_store=True):
+        """
+        Args:
+            element_store (bool): If True, mirror the elements of loaded
+                scenarios into a columnar toe.ElementStore
+        """
         # import the database info
         self.equipment_database = EquipmentDatabase('./database/weapons',
-                                                    './database/vehicles')
+                                                    './database/vehicles',
+                                                    './database/equipment_cache.pkl')
 
         # init the formation container
         self.formations = {}
         self.formationsByName = {}
         self.formationsById = {}
+        # Formations by the NSNs of their own elements, built on demand
+        self._formations_by_nsn = None
+        self.use_element_store = element_store
+        self.element_store = None
+        # Journal of the changes since the last saved checkpoint
+        self.journal = None
+        # Snapshots of the formations of the scenario
+        self.history = HistoryStore()
+        # Last timeline made for playback, with the state of the history it was made from
+        self._timeline = None
+        # Called with the changes of every committed battle and snapshot, see subscribe
+        self._subscribers = []
+        # True while a journal is replayed, whose changes are not published
+        self._replaying = False
+        # Held by the battles and by equipment reloads, which rewrite the
+        # rollups and ElementStore columns the battles read
+        self._lock = threading.RLock()
+        # Version of the formation hierarchy and the ORBAT tree cached for it
+        self.orbat_version = 0
+        self._orbat = None
+        # Position of each formation id in formationsById, built on demand
+        self._formation_order = None
 
         # Init scenario data
         self.scenario_name = None
@@ -66,6 +118,8 @@ class Wargame:
         self.scenario_loaded = False
 
     def load_scenario(self, scenario):
+        self._formations_by_nsn = None
+        self.close_journal()
         if self.scenario_loaded:
             # clear the formations
             self.formations = {}
@@ -79,7 +133,7 @@ class Wargame:
             with open(scenario+'/wargame.yml') as f:
                 wargameRules = yaml.full_load(f)
         except FileNotFoundError:
-            logging.error(f'Scenario {scenario} not found')
+            logger.error(f'Scenario {scenario} not found')
             return False
         self.game_name = wargameRules['name']
         if wargameRules.get('maplayers') is not None:
@@ -188,10 +242,35 @@ class Wargame:
                                                    'color': wargameRules['factions'][faction]['color'],
                                                    'id': f'AIR{id_n:04d}'})
                     id_n += 1
+        self.build_history()
+        self.orbat_changed()
+        self.build_element_store()
         # Flag the scenario as loaded!
         self.scenario_loaded = True
         return True
 
+    def build_history(self, history=None):
+        """Attaches a HistoryStore to all formations.
+
+        Args:
+            history (HistoryStore, optional): Snapshots to start from, by
+                default only those the formations already have
+        """
+        self.history = HistoryStore() if history is None else history
+        for faction in self.formations:
+            for form in self.formations[faction]:
+                self.history.attach(form)
+        return self.history
+
+    def build_element_store(self):
+        """Mirrors the elements of all formations into a columnar ElementStore."""
+        if not self.use_element_store:
+            return None
+        top_level = [form for faction in self.formations for form in self.formations[faction]]
+        self.element_store = ElementStore(top_level)
+        logger.info(f'Built {self.element_store}')
+        return self.element_store
+
     def _add_subunits(self, formation):
         """Recursively adds subunits to the formationsById dictionary."""
         self.formationsById.update({formation.id: formation})
@@ -205,6 +284,92 @@ class Wargame:
             subunit.fullshortname = f'{subunit.shortname}/{parent_shortname}'
             self._update_subunit_parents(subunit, subunit.shortname)
 
+    @locked
+    def reload_equipment(self):
+        """Reloads changed equipment files and refreshes the formations using them.
+
+        Returns:
+            list: Names of the weapons and vehicles that changed
+        """
+        changed = self.equipment_database.reload()
+        self._equipment_changed(changed)
+        return sorted(changed)
+
+    def watch_equipment(self, interval=2.0):
+        """Reloads equipment files in the background whenever they change.
+
+        Each reload holds the wargame lock, so no battle reads the formations
+        while their equipment is refreshed.
+        """
+        return self.equipment_database.watch(interval, self._equipment_changed, self._lock)
+
+    def _equipment_changed(self, changed):
+        """Marks the rollups of formations with elements using changed equipment as dirty."""
+        if not changed:
+            return
+        if self._formations_by_nsn is None:
+            index = {}
+            for formation in self.formationsById.values():
+                for nsn in formation.get_nsns():
+                    index.setdefault(nsn, []).append(formation)
+            self._formations_by_nsn = index
+        affected = {}
+        for nsn in changed:
+            for formation in self._formations_by_nsn.get(nsn, []):
+                affected[formation.id] = formation
+        for formation in affected.values():
+            formation.refresh_qjm_equipment(self.equipment_database)
+        logger.info(f'Refreshed {len(affected)} formations after equipment changes')
+
+    def subscribe(self, callback):
+        """Calls callback with a dictionary of the changes after every
+        committed battle and snapshot.
+
+        A battle sends its 'battleId' and the 'formations' whose personnel,
+        OLI or element status changed, with their new state as given by
+        formation_state. A snapshot sends its 'date' and whether the date is
+        'new'. Loading a save sends all snapshot 'dates' once, instead of the
+        changes of the journal it replays.
+        """
+        self._subscribers.append(callback)
+
+    def _publish(self, changes):
+        if self._replaying:
+            return
+        for callback in self._subscribers:
+            try:
+                callback(changes)
+            except Exception as e:
+                logger.error(f'Failed to publish {changes["type"]} changes: {str(e)}')
+
+    def _affected_formations(self, formation_ids):
+        """Returns the formations whose strength losses to the given formations
+        can change: the formations, their subunits and their parents."""
+        affected = {}
+        for formation_id in formation_ids:
+            formation = self.formationsById[formation_id]
+            stack = [formation]
+            while stack:
+                f = stack.pop()
+                affected[f.id] = f
+                stack.extend(f.subunits)
+            while formation.parent is not None:
+                formation = formation.parent
+                affected[formation.id] = formation
+        return list(affected.values())
+
+    @staticmethod
+    def formation_state(formation):
+        """Returns the active personnel, total OLI and element counts by
+        status of a formation and all its subunits, and the active personnel
+        of the formation alone as 'localPersonnel'."""
+        rollup = formation.get_rollup()
+        return {'personnel': rollup.personnel,
+                'localPersonnel': formation.get_rollup(recursive=False).personnel,
+                'oli': float(rollup.oli.calc_total()),
+                'status': {status.name.lower(): int(rollup.status[status.value])
+                           for status in ElementStatus}}
+
     def get_formation(self, formation_id=None):
         if formation_id is not None:
             return self.formationsById.get(formation_id, None)
@@ -224,7 +389,79 @@ class Wargame:
             response.append(faction_response)
         return response
 
+    def orbat_changed(self):
+        """Drops the cached ORBAT tree after formations were added, removed,
+        renamed or moved between parents."""
+        self.orbat_version += 1
+        self._orbat = None
+        self._formation_order = None
+
+    def _orbat_cache(self):
+        """Returns the cached ORBAT tree, its JSON and its ETag, building
+        them if the ORBAT changed since they were last built."""
+        if self._orbat is None:
+            tree = self._build_formations_tree()
+            body = json.dumps(tree)
+            etag = hashlib.sha256(body.encode()).hexdigest()[:32]
+            self._orbat = {'tree': tree, 'nodes': self._index_tree(tree),
+                           'json': body, 'etag': etag}
+        return self._orbat
+
     def get_formations_as_tree(self):
+        """Returns the tree of factions, formations and subunits of the ORBAT.
+
+        The tree is cached until orbat_changed is called and must not be modified.
+        """
+        return self._orbat_cache()['tree']
+
+    def get_formations_tree_json(self):
+        """Returns the tree of get_formations_as_tree as JSON, and an ETag
+        that only changes when the tree does.
+
+        Returns:
+            tuple: (json, etag)
+        """
+        cache = self._orbat_cache()
+        return cache['json'], cache['etag']
+
+    def orbat_etag(self):
+        """Returns the ETag of the current ORBAT tree."""
+        return self._orbat_cache()['etag']
+
+    def get_formations_level(self, parent_id=None):
+        """Returns one level of the ORBAT tree, with the number of children
+        of each node instead of the children.
+
+        Args:
+            parent_id (str, optional): Id of a faction node or formation, by
+                default the factions are returned
+
+        Returns:
+            list: Nodes as in get_formations_as_tree, with 'childCount'
+                instead of 'children', or None if the parent is unknown
+        """
+        cache = self._orbat_cache()
+        if parent_id is None:
+            children = cache['tree']
+        elif parent_id in cache['nodes']:
+            children = cache['nodes'][parent_id]['children']
+        else:
+            return None
+        return [{**{key: value for key, value in child.items() if key != 'children'},
+                 'childCount': len(child['children'])} for child in children]
+
+    @staticmethod
+    def _index_tree(tree):
+        """Returns the nodes of a tree by id."""
+        nodes = {}
+        stack = list(tree)
+        while stack:
+            node = stack.pop()
+            nodes[node['id']] = node
+            stack.extend(node['children'])
+        return nodes
+
+    def _build_formations_tree(self):
         tree = []
         DEFAULT_SIDC = "30031000000000000000"  # Default SIDC for factions
 
@@ -282,15 +519,37 @@ class Wargame:
         gist(content)
         return True
 
-    def simulate_battle(self, battle_input, recursive=True, commit=False):
-        """Simulates the battle using the QJM method.
+    @staticmethod
+    def battle_seed(battle_input, seed=None):
+        """Returns the id and random seed of a battle.
 
-        Args:
-            battle_input (dict): Dictionary with all battle data information
-            recursive (bool): If True, the function will include all subunits in the battle
-            commit (bool): If True, the function will commit the losses to the formations
-        """
+        The battle id is battle_input['battleId'] if given, otherwise it is made
+        from the battle date, time and participants. Without an explicit seed
+        (argument or battle_input['seed']) the seed is derived from the battle
+        id, so recommitting the same battle from the same state reproduces it.
 
+        Returns:
+            tuple: (battle_id, seed)
+        """
+        battle_id = battle_input.get('battleId')
+        if battle_id is None:
+            battle_id = '{}T{}|{}|{}'.format(battle_input.get('battleDate', ''),
+                                             battle_input.get('battleTime', ''),
+                                             ','.join(battle_input['attackers']),
+                                             ','.join(battle_input['defenders']))
+        if seed is None:
+            seed = battle_input.get('seed')
+        if seed is None:
+            seed = int.from_bytes(hashlib.sha256(str(battle_id).encode()).digest()[:8], 'little')
+        return str(battle_id), int(seed)
+
+    def _gather_forces(self, battle_input, recursive=True):
+        """Sums the OLI, personnel, armour and vehicle strength of each side.
+
+        Returns:
+            dict: atk_oli, def_oli, Na, Nd, Nia, Nid, Ja and Jd as taken by
+                battle_kernel
+        """
         atk_land_units = battle_input['attackers']
         atk_sorties = battle_input['air_attackers']
         def_land_units = battle_input['defenders']
@@ -309,23 +568,6 @@ class Wargame:
         for d in def_sorties:
             def_air.append({'aircraft': aircraft_by_id[d['id']]['vehicle'], 'sorties': d['sorties']})
 
-        # TODO: Use battle_data in calculations
-        battle_data = BattleData(
-            terrain=battle_input['terrain'],
-            weather=battle_input['weather'],
-            season=battle_input['season'],
-            posture=battle_input['posture'],
-            air_superiority=battle_input['airsuperiority'],
-            atk_surprise=battle_input['atksurprise'],
-            atk_surprise_days=battle_input['atksurprisedays'],
-            atkcev=battle_input['atkcev'],
-            defcev=battle_input['defcev'],
-            attackers=battle_input['attackers'],
-            air_attackers=battle_input.get('air_attackers', []),
-            defenders=battle_input['defenders'],
-            air_defenders=battle_input.get('air_defenders', [])
-            )
-
         # calculate force strength
         # S = ((Ws + Wmg + Whw) * r_n) + (Wgi * rn) +
         # ((Wg + Wgy) * (rwg * hwg * zwg * wyg)) + 
@@ -340,60 +582,24 @@ class Wargame:
         Ja = 0  # vehicle strength
         Jd = 0  # vehicle strength
 
-        # J factors (only vehicles other than tanks):
-        J_unarmoured = 1
-        J_armoured = 2
-        J_air = 10  # only organic
-        
         # gather OLI values from each formation
         for a in atk_land_units:
-            atk_oli += self.formationsById[a].get_oli(recursive=recursive)
+            rollup = self.formationsById[a].get_rollup(recursive)
+            atk_oli += rollup.oli
             # calculate Na
-            Na += self.formationsById[a].count_personnel(recursive=recursive)
-            # Calculate Ja
-            for equip in self.formationsById[a].get_qjm_equipment(recursive=recursive):
-                if isinstance(equip, Vehicle):
-                    if equip.qjm_vehicle_category in [VehicleCategory.armoured_car,
-                                                      VehicleCategory.truck,
-                                                      VehicleCategory.arv]:
-                        Ja += J_unarmoured
-                    elif equip.qjm_vehicle_category in [VehicleCategory.apc,
-                                                        VehicleCategory.ifv,
-                                                        VehicleCategory.artillery]:
-                        Ja += J_armoured
-                    elif equip.qjm_vehicle_category in [VehicleCategory.combat_air_support,
-                                                        VehicleCategory.fighter,
-                                                        VehicleCategory.bomber,
-                                                        VehicleCategory.helicopter]:
-                        # only count organic aviation assets
-                        Ja += J_air
-                    elif equip.qjm_vehicle_category in [VehicleCategory.tank]:
-                        Nia += 1
- 
+            Na += rollup.personnel
+            # Calculate Ja (only vehicles other than tanks, organic aviation assets)
+            Ja += rollup.j
+            Nia += rollup.tanks
+
         for d in def_land_units:
-            oli = self.formationsById[d].get_oli(recursive=recursive)
-            def_oli += oli
+            rollup = self.formationsById[d].get_rollup(recursive)
+            def_oli += rollup.oli
             # calculate Nd
-            Nd += self.formationsById[d].count_personnel(recursive=recursive)
+            Nd += rollup.personnel
             # Calculate Jd
-            for equip in self.formationsById[a].get_qjm_equipment(recursive=recursive):
-                if isinstance(equip, Vehicle):
-                    if equip.qjm_vehicle_category in [VehicleCategory.armoured_car,
-                                                      VehicleCategory.truck,
-                                                      VehicleCategory.arv]:
-                        Jd += J_unarmoured
-                    elif equip.qjm_vehicle_category in [VehicleCategory.apc,
-                                                 VehicleCategory.ifv,
-                                                 VehicleCategory.artillery]:
-                        Jd += J_armoured
-                    elif equip.qjm_vehicle_category in [VehicleCategory.combat_air_support,
-                                                 VehicleCategory.fighter,
-                                                 VehicleCategory.bomber,
-                                                 VehicleCategory.helicopter]:
-                        # only count organic aviation assets
-                        Jd += J_air
-                    elif equip.qjm_vehicle_category in [VehicleCategory.tank]:
-                        Nid += 1
+            Jd += rollup.j
+            Nid += rollup.tanks
 
         # Add aircraft sorties
         for a in atk_air:
@@ -401,372 +607,498 @@ class Wargame:
         for d in def_air:
             def_oli.aircraft += d['aircraft'].q_OLI * d['sorties']
 
-        # correct values of antitank, antiaircraft, and aircraft by enemy values
-        if atk_oli.antitank > def_oli.armour:
-            atk_oli.antitank = def_oli.armour + 0.5 * (atk_oli.antitank -
-                                                       def_oli.armour)
-        if def_oli.antitank > atk_oli.armour:
-            def_oli.antitank = atk_oli.armour + 0.5 * (def_oli.antitank -
-                                                       atk_oli.armour)
-        if atk_oli.antiair > def_oli.aircraft:
-            atk_oli.antiair = def_oli.aircraft + 0.5 * (atk_oli.antiair -
-                                                        def_oli.aircraft)
-        if def_oli.antiair > atk_oli.aircraft:
-            def_oli.antiair = atk_oli.aircraft + 0.5 * (def_oli.antiair -
-                                                        atk_oli.aircraft)
-        atk_ground_firepower = atk_oli.calc_total() - atk_oli.aircraft
-        def_ground_firepower = def_oli.calc_total() - def_oli.aircraft
-
-        if atk_oli.aircraft > atk_ground_firepower:
-            atk_oli.aircraft = atk_ground_firepower + 0.5 * (atk_oli.aircraft - atk_ground_firepower)
-        if atk_oli.aircraft > 3 * atk_ground_firepower:
-            atk_oli.aircraft = 3 * atk_ground_firepower
-
-        if def_oli.aircraft > def_ground_firepower:
-            def_oli.aircraft = def_ground_firepower + 0.5 * (def_oli.aircraft - def_ground_firepower)
-        if def_oli.aircraft > 3 * def_ground_firepower:
-            def_oli.aircraft = 3 * def_ground_firepower
-
-        # Attacker variables
-        # Terrain Factors
-        rm  = TERRAIN_FACTORS.get(battle_input['terrain'],
-                                  'Mobility (r_m)')
-        rua  = 1.0
-        rud  = TERRAIN_FACTORS.get(battle_input['terrain'],
-                                  'Defense Position (r_u)')
-        rn  = TERRAIN_FACTORS.get(battle_input['terrain'],
-                                  'Infantry Weapons (r_n)')
-        rwg = TERRAIN_FACTORS.get(battle_input['terrain'],
-                                  'Artillery (r_wg)')
-        rwy = TERRAIN_FACTORS.get(battle_input['terrain'],
-                                  'Air (r_wy)')
-        rwi = TERRAIN_FACTORS.get(battle_input['terrain'],
-                                  'Tanks (r_wt)')
-        rc  = TERRAIN_FACTORS.get(battle_input['terrain'],
-                                  'Casualty (r_c)')
-        # Weather Factors
-        hm  = WEATHER_FACTORS.get(battle_input['weather'],
-                              'Mobility (h_m)')
-        hua = WEATHER_FACTORS.get(battle_input['weather'],
-                              'Attack (h_ua)')
-        hud = 1.0
-        hwg = WEATHER_FACTORS.get(battle_input['weather'],
-                              'Artillery (h_wg)')
-        hwy = WEATHER_FACTORS.get(battle_input['weather'],
-                              'Air (h_wy)')
-        hwi = WEATHER_FACTORS.get(battle_input['weather'],
-                              'Tanks (h_wt)')
-        hc  = WEATHER_FACTORS.get(battle_input['weather'],
-                              'Casualties (h_c)')
-        # Season Factors
-        zua = SEASON_FACTORS.get(battle_input['season'],
-                             'Attack (z_u)')
-        zud = 1.0
-        zwg = SEASON_FACTORS.get(battle_input['season'],
-                             'Artillery (z_wg)')
-        zwy = SEASON_FACTORS.get(battle_input['season'],
-                             'Air (z_wy)')
-        # Posture Factors
-        usa = 1.0
-        usd = POSTURE_FACTORS.get(battle_input['posture'],
-                              'Strength (u_s)')
-        uva = 1.0
-        uvd = POSTURE_FACTORS.get(battle_input['posture'],
-                              'Vulnerability (u_v)')
-        uca = POSTURE_FACTORS.get(battle_input['posture'],
-                              'Attack Casualties (u_ca)')
-        ucd = POSTURE_FACTORS.get(battle_input['posture'],
-                              'Defense Casualties (u_cd)')
-        # Surprise Factors
-        eraSurpriseFactor = 1.33 # 1.33 post 1966
-        Msur  = SURPRISE_FACTORS.get(battle_input['atksurprise'],
-                                     'Mobility Characteristics (Msur)'
-                                     ) * eraSurpriseFactor
-        Vsura = SURPRISE_FACTORS.get(battle_input['atksurprise'],
-                                     'Vulnerability (Vsur)'
-                                     ) * eraSurpriseFactor
-        Vsurd = SURPRISE_FACTORS.get(battle_input['atksurprise'],
-                                     'Surprised Vulnerability (Vsurd)'
-                                     ) * eraSurpriseFactor
-        su_c  = SURPRISE_FACTORS.get(battle_input['atksurprise'],
-                                     'Surprised Vulnerability (Vsurd)'
-                                     ) * eraSurpriseFactor
-        su_ct = SURPRISE_FACTORS.get(battle_input['atksurprise'],
-                                     'Surprised Vulnerability (Vsurd)'
-                                     ) * eraSurpriseFactor
-        surprise_days = int(battle_input['atksurprisedays'])
-        # Update surprise factors for duration, all trend to 1.0 and reduce by 1/3 for each day
-        Msur  = 1.0 + (Msur-1.0) * (3-surprise_days)/3
-        Vsura = 1.0 + (Vsura-1.0) * (3-surprise_days)/3
-        Vsurd = 1.0 + (Vsurd-1.0) * (3-surprise_days)/3
-        su_c  = 1.0 + (su_c-1.0) * (3-surprise_days)/3
-        su_ct = 1.0 + (su_ct-1.0) * (3-surprise_days)/3
-
-
-        # Obstacle Factors
-        shore_type = battle_input['shorelineType']
-        shore_fires = battle_input['shorelineFires']
-        print(SHORELINE_FACTORS.get_headers())
-        print(shore_type, shore_fires)
-        if shore_type == 'No shoreline' or shore_fires == 'No shoreline':
-            vra = 1.0
-        else:
-            vra = SHORELINE_FACTORS.get(shore_fires, shore_type)
-        print('Vra:', vra)
+        return {'atk_oli': [atk_oli.to_list()], 'def_oli': [def_oli.to_list()],
+                'Na': Na, 'Nd': Nd, 'Nia': Nia, 'Nid': Nid, 'Ja': Ja, 'Jd': Jd}
 
-        vrd = 1.0 # Defender is not vulnerable on shorelines
+    @locked
+    def simulate_battle(self, battle_input, recursive=True, commit=False, seed=None, trace=False):
+        """Simulates the battle using the QJM method.
 
+        Args:
+            battle_input (dict): Dictionary with all battle data information
+            recursive (bool): If True, the function will include all subunits in the battle
+            commit (bool): If True, the function will commit the losses to the formations
+            seed (int, optional): Seed of the committed losses, see battle_seed.
+                Every formation draws its losses from its own stream spawned
+                from the seed.
+            trace (bool): If True, the results include a 'trace' with every
+                factor and intermediate value of the battle and the time spent
+                in each stage, see BattleData
+
+        Raises:
+            ValueError: If a side has no active personnel or the battle
+                cannot be resolved, in which case no losses are committed
+        """
 
-        # Air Superiority Factors
-        if battle_input['airsuperiority'] == 'Air Superiority':
-            if hwy > 0.5:
-                atk_my = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Mobility (m_yd)')
-                def_my = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Mobility (m_yd)')
-            else:
-                atk_my = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Mobility (m_yw)')
-                def_my = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Mobility (m_yw)')
-            wyga = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Artillery (w_yg)')
-            wygd = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Artillery (w_yg)')
-            wyya = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Air (w_yy)')
-            wyyd = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Air (w_yy)')
-            vya  = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Vulnerability (v_y)')
-            vyd  = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Vulnerability (v_y)')
-        elif battle_input['airsuperiority'] == 'Air Inferiority':
-            if hwy > 0.5:
-                atk_my = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Mobility (m_yd)')
-                def_my = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Mobility (m_yd)')
-            else:
-                atk_my = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Mobility (m_yw)')
-                def_my = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Mobility (m_yw)')
-            wyga = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Artillery (w_yg)')
-            wygd = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Artillery (w_yg)')
-            wyya = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Air (w_yy)')
-            wyyd = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Air (w_yy)')
-            vya  = AIR_SUPERIORITY_FACTORS.get('Air Inferiority',
-                                                     'Vulnerability (v_y)')
-            vyd  = AIR_SUPERIORITY_FACTORS.get('Air Superiority',
-                                                     'Vulnerability (v_y)')
-        else:
-            if hwy > 0.5:
-                atk_my = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Mobility (m_yd)')
-                def_my = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Mobility (m_yd)')
-            else:
-                atk_my = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Mobility (m_yw)')
-                def_my = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Mobility (m_yw)')
-            wyga = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Artillery (w_yg)')
-            wygd = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Artillery (w_yg)')
-            wyya = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Air (w_yy)')
-            wyyd = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Air (w_yy)')
-            vya  = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Vulnerability (v_y)')
-            vyd  = AIR_SUPERIORITY_FACTORS.get('Air Equality',
-                                                     'Vulnerability (v_y)')
-
-        # Era factor:
-        JFactor = 15 # 20 for WW2, 15 for 1970s
-        # Attacker strength calculation
-        atk_S = (((atk_oli.small_arms + atk_oli.machine_guns + atk_oli.heavy_weapons) * rn)
-                + (atk_oli.antitank * rn)
-                + ((atk_oli.artillery + atk_oli.antiair) * (rwg * hwg * zwg * wyga))
-                + (atk_oli.armour * rwi * hwi)
-                + (atk_oli.aircraft * rwy * hwy * zwy * wyya))
-        
-        # Defender strength calculation
-        def_S = (((def_oli.small_arms + def_oli.machine_guns + def_oli.heavy_weapons) * rn)
-                + (def_oli.antitank * rn)
-                + ((def_oli.artillery + def_oli.antiair) * (rwg * hwg * zwg * wygd))
-                + (def_oli.armour * rwi * hwi)
-                + (def_oli.aircraft * rwy * hwy * zwy * wyyd))
+        atk_land_units = battle_input['attackers']
+        def_land_units = battle_input['defenders']
 
-        # Attacker mobility calculation
-        atk_M = (((Na + JFactor*Ja + atk_oli.armour) * atk_my / Na) / ((Nd + JFactor*Jd + def_oli.armour) * def_my / Nd))**0.5 * Msur
-        atk_m = atk_M - (1-rm*hm)*(atk_M-1) # operational mobility, different than M
+        start = time.perf_counter()
+        forces = self._gather_forces(battle_input, recursive)
+        aggregated = time.perf_counter()
+        if forces['Na'] <= 0:
+            raise ValueError('The attackers have no active personnel')
+        if forces['Nd'] <= 0:
+            raise ValueError('The defenders have no active personnel')
+
+        # Resolve the battle through the vectorized kernel as a batch of one
+        env = resolve_environment(battle_input)
+        resolved = time.perf_counter()
+        results = battle_kernel(env=env, **forces,
+                                atkcev=float(battle_input['atkcev']),
+                                defcev=float(battle_input['defcev']),
+                                surprise_days=int(battle_input['atksurprisedays']),
+                                duration=float(battle_input['battleDuration']),
+                                road_quality=float(battle_input['roadQuality']),
+                                road_density=float(battle_input['roadDensity']),
+                                dispersion=self.dispersion)
+        results = {key: value[0] for key, value in results.items()}
+        unresolved = [key for key in BATTLE_RESULTS if not np.all(np.isfinite(results[key]))]
+        if unresolved:
+            raise ValueError(f'The battle has no finite {", ".join(unresolved)}, '
+                             f'check the strength of both sides')
+        results['advanceRate'] = dict(zip(ADVANCE_RATE.headers, results['advanceRate']))
+        computed = time.perf_counter()
+
+        # return data to the caller
+        battleResults = {key: results[key] for key in BATTLE_RESULTS}
+        if commit:
+            # send casualty data to the formations, each from its own random stream
+            atkCas = CasualtyRates(results['atkPersCasualtyRate'], results['atkTankCasualtyRate'],
+                                   results['atkArtilleryCasualtyRate'], True)
+            defCas = CasualtyRates(results['defPersCasualtyRate'], results['defTankCasualtyRate'],
+                                   results['defArtilleryCasualtyRate'], False)
+            battle_id, seed = self.battle_seed(battle_input, seed)
+            participants = [(a, atkCas) for a in atk_land_units] + [(d, defCas) for d in def_land_units]
+            streams = np.random.SeedSequence(seed).spawn(len(participants))
+            if self.journal is not None:
+                elements = self._journal_elements(atk_land_units + def_land_units)
+                before = [e.status for _, _, e in elements]
+            if self._subscribers:
+                affected = self._affected_formations(atk_land_units + def_land_units)
+                states = {f.id: self.formation_state(f) for f in affected}
+            for (f, cas), stream in zip(participants, streams):
+                self.formationsById[f].inflict_losses(cas, rng=np.random.default_rng(stream))
+            if self.journal is not None:
+                changes = [[formation_id, index, e.status.value]
+                           for (formation_id, index, e), status in zip(elements, before)
+                           if e.status != status]
+                self.journal.append({'type': 'battle', 'battleId': battle_id, 'seed': seed,
+                                     'input': battle_input, 'changes': changes})
+            logger.info('Committed battle %s with seed %s', battle_id, seed,
+                        extra={'fields': {'event': 'battle_committed', 'battle_id': battle_id,
+                                          'seed': seed, 'participants': len(participants)}})
+            battleResults.update({'battleId': battle_id, 'seed': seed})
+            if self._subscribers:
+                changed = []
+                for formation in affected:
+                    state = self.formation_state(formation)
+                    if state != states[formation.id]:
+                        changed.append({'id': formation.id, **state})
+                self._publish({'type': 'battle', 'battleId': battle_id, 'formations': changed})
+        if trace:
+            battle_data = self._battle_trace(battle_input, forces, env, results)
+            battle_data.timings = {'aggregation': aggregated - start,
+                                   'environment': resolved - aggregated,
+                                   'kernel': computed - resolved,
+                                   'losses': time.perf_counter() - computed}
+            battleResults['trace'] = battle_data.to_dict()
+        return battleResults
+
+    @staticmethod
+    def _battle_trace(battle_input, forces, env, results):
+        """Fills a BattleData with the inputs, factors and intermediate values
+        of a resolved battle."""
+        battle_data = BattleData(
+            terrain=battle_input['terrain'],
+            weather=battle_input['weather'],
+            season=battle_input['season'],
+            posture=battle_input['posture'],
+            air_superiority=battle_input['airsuperiority'],
+            atk_surprise=battle_input['atksurprise'],
+            atk_surprise_days=int(battle_input['atksurprisedays']),
+            atkcev=float(battle_input['atkcev']),
+            defcev=float(battle_input['defcev']),
+            attackers=battle_input['attackers'],
+            air_attackers=battle_input.get('air_attackers', []),
+            defenders=battle_input['defenders'],
+            air_defenders=battle_input.get('air_defenders', []),
+            atk_oli=FormationOLI(*forces['atk_oli'][0]),
+            def_oli=FormationOLI(*forces['def_oli'][0]),
+            Na=forces['Na'], Nd=forces['Nd'], Nia=forces['Nia'], Nid=forces['Nid'],
+            Ja=forces['Ja'], Jd=forces['Jd'],
+            environment=dict(env),
+            atk_P=float(results['powerAtk']),
+            def_P=float(results['powerDef']),
+            PRatio=float(results['powerRatio']))
+        for key, value in results.items():
+            if key == 'advanceRate':
+                battle_data.advanceRate = {unit: float(rate) for unit, rate in value.items()}
+            elif hasattr(battle_data, key):
+                setattr(battle_data, key, float(value))
+        return battle_data
+
+    @locked
+    def sweep(self, battle_input, axes, recursive=True):
+        """Resolves a battle over every combination of the given battle
+        conditions.
+
+        The forces are gathered once and the whole grid is resolved by the
+        vectorized battle kernel. Losses are never committed.
 
-        # Defender mobility calculation
-        def_m = 1.0
+        Args:
+            battle_input (dict): Battle data information, as for simulate_battle
+            axes (dict): Lists of values to sweep by battle_input field, for
+                any of SWEEP_FIELDS
+            recursive (bool): If True, include all subunits in the battle
+
+        Returns:
+            list: One row per combination, in the order of the cartesian
+                product of axes, holding the swept values followed by the
+                power ratio, casualty rates and advance rates of the battle
+
+        Raises:
+            ValueError: If a field cannot be swept, has no values or a value
+                is not in its factor table
+        """
+        for field, values in axes.items():
+            if field not in SWEEP_FIELDS:
+                raise ValueError(f'Cannot sweep {field}, expected one of {", ".join(SWEEP_FIELDS)}')
+            if len(values) == 0:
+                raise ValueError(f'No values to sweep for {field}')
+        fields = list(axes)
+        grid = list(itertools.product(*axes.values()))
+        forces = self._gather_forces(battle_input, recursive)
+
+        rows = []
+        for start in range(0, len(grid), SWEEP_CHUNK):
+            points = [dict(battle_input, **dict(zip(fields, point)))
+                      for point in grid[start:start + SWEEP_CHUNK]]
+            codes = [encode_environment(point) for point in points]
+            env = gather_environment({key: np.array([c[key] for c in codes]) for key in codes[0]})
+            # Sides without personnel or strength give non-finite results, reported as None
+            with np.errstate(divide='ignore', invalid='ignore'):
+                results = battle_kernel(env=env, **forces,
+                                        atkcev=[float(p['atkcev']) for p in points],
+                                        defcev=[float(p['defcev']) for p in points],
+                                        surprise_days=[int(p['atksurprisedays']) for p in points],
+                                        duration=[float(p['battleDuration']) for p in points],
+                                        road_quality=[float(p['roadQuality']) for p in points],
+                                        road_density=[float(p['roadDensity']) for p in points],
+                                        dispersion=self.dispersion)
+            columns = {key: np.where(np.isfinite(results[key]), results[key], None).tolist()
+                       for key in SWEEP_RESULTS}
+            advance = np.where(np.isfinite(results['advanceRate']),
+                               results['advanceRate'], None).tolist()
+            for i, point in enumerate(grid[start:start + SWEEP_CHUNK]):
+                row = dict(zip(fields, point))
+                row.update({key: columns[key][i] for key in SWEEP_RESULTS})
+                row['advanceRate'] = dict(zip(ADVANCE_RATE.headers, advance[i]))
+                rows.append(row)
+        logger.info(f'Swept {len(rows)} battles over {", ".join(fields) or "no fields"}')
+        return rows
+
+    @locked
+    def power_matrix(self, attackers, defenders, conditions, recursive=True):
+        """Resolves every attacker against every defender under the same
+        conditions.
+
+        Each pair is a battle of one attacking and one defending formation
+        without air sorties. The strength of every formation is taken from
+        its cached rollup once and all pairs are resolved by the vectorized
+        battle kernel.
 
-        atk_V = Na * uva/rua * (def_S/atk_S)**0.5 * vya * vra * Vsura
-        def_V = Nd * uvd/rud * (atk_S/def_S)**0.5 * vyd * vrd * Vsurd
+        Args:
+            attackers (list): Formation ids of the attackers
+            defenders (list): Formation ids of the defenders
+            conditions (dict): Battle conditions, the SWEEP_FIELDS of a
+                battle_input
+            recursive (bool): If True, include all subunits of each formation
+
+        Returns:
+            dict: 'attackers' and 'defenders' lists describing the rows and
+                columns, and an (attackers, defenders) matrix for each of
+                SWEEP_RESULTS. Values that are not finite are None.
+
+        Raises:
+            ValueError: If a formation id is unknown
+        """
+        def strengths(formation_ids):
+            formations = []
+            for formation_id in formation_ids:
+                if formation_id not in self.formationsById:
+                    raise ValueError(f'Unknown formation {formation_id}')
+                formations.append(self.formationsById[formation_id])
+            rollups = [f.get_rollup(recursive) for f in formations]
+            info = [{'id': f.id, 'name': f.name, 'shortname': f.shortname, 'sidc': f.sidc}
+                    for f in formations]
+            oli = np.array([r.oli.to_list() for r in rollups], dtype=float).reshape(-1, 8)
+            personnel = np.array([r.personnel for r in rollups], dtype=float)
+            tanks = np.array([r.tanks for r in rollups], dtype=float)
+            j = np.array([r.j for r in rollups], dtype=float)
+            return info, oli, personnel, tanks, j
+
+        atk_info, atk_oli, Na, Nia, Ja = strengths(attackers)
+        def_info, def_oli, Nd, Nid, Jd = strengths(defenders)
+        n_atk, n_def = len(atk_info), len(def_info)
+        # Row major pairs: attacker i against defender j is pair i * n_def + j
+        pair_atk = np.repeat(np.arange(n_atk), n_def)
+        pair_def = np.tile(np.arange(n_def), n_atk)
+        env = resolve_environment(conditions)
+        # Pairs without personnel or strength give non-finite results, reported as None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results = battle_kernel(atk_oli[pair_atk], def_oli[pair_def],
+                                    Na[pair_atk], Nd[pair_def], Nia[pair_atk], Nid[pair_def],
+                                    Ja[pair_atk], Jd[pair_def], env,
+                                    atkcev=float(conditions['atkcev']),
+                                    defcev=float(conditions['defcev']),
+                                    surprise_days=int(conditions['atksurprisedays']),
+                                    duration=float(conditions['battleDuration']),
+                                    road_quality=float(conditions['roadQuality']),
+                                    road_density=float(conditions['roadDensity']),
+                                    dispersion=self.dispersion)
+
+        matrix = {'attackers': atk_info, 'defenders': def_info}
+        for key in SWEEP_RESULTS:
+            values = results[key].reshape(n_atk, n_def)
+            matrix[key] = np.where(np.isfinite(values), values, None).tolist()
+        return matrix
+
+    @locked
+    def simulate_losses(self, battle_input, replications=1000, recursive=True,
+                        workers=None, seed=None, percentiles=(5, 50, 95)):
+        """Samples the distribution of losses a committed battle would inflict.
+
+        The battle is resolved once, then the loss tests of every participating
+        formation are replicated independently without touching the live
+        element status. Large runs are split across a process pool.
 
-        if atk_V / atk_S > 0.3:
-            atk_VS = 0.3 + 0.1*(atk_V/atk_S - 0.3)
-        else:
-            atk_VS = atk_V/atk_S
-        if def_V / def_S > 0.3:
-            def_VS = 0.3 + 0.1*(def_V/def_S - 0.3)
-        else:
-            def_VS = def_V/def_S
-        atk_v = 1 - atk_VS * self.dispersion/3000
-        def_v = 1 - def_VS * self.dispersion/3000
-
-        if atk_v < 0.6:
-            atk_v = 0.6
-        if def_v < 0.6:
-            def_v = 0.6
-
-        atk_P = atk_S * atk_m * usa * rua * hua * zua * atk_v * float(battle_input['atkcev'])
-        def_P = def_S * def_m * usd * rud * hud * zud * def_v * float(battle_input['defcev'])
-
-        PRatio = atk_P / def_P
-
-        # calculate casualty factors
-        # power ratio factor for casualties
-        ca_power    = OPPOSITION_FACTORS.interpolate(PRatio)
-        # power ratio factor for casualties
-        cd_power    = OPPOSITION_FACTORS.interpolate(1/PRatio)
-        # personnel strength factor for casualties
-        ca_strength = STRENGTH_SIZE_FACTORS.interpolate(Na)
-        # personnel strength factor for casualties
-        cd_strength = STRENGTH_SIZE_FACTORS.interpolate(Nd)
-        # armour strength factor for casualties
-        ca_arm      = STRENGTH_SIZE_ARMOUR_FACTORS.interpolate(Nia)
-        # armour strength factor for casualties
-        cd_arm      = STRENGTH_SIZE_ARMOUR_FACTORS.interpolate(Nid)
-        # Casualty rate factor for duration
-        c_duration = float(battle_input['battleDuration'])/24 # Scales linearly between 4 hours to 24 hours
-        if c_duration < 4/24:
-            c_duration = 4/24
-        if c_duration > 1:
-            c_duration = 1
-        # TODO - factor in Attrition is 0.04, 0.028 in NPW, why?
-        ca  = 0.028 * rc * hc * uca * ca_strength * ca_power * c_duration
-        cia = ca * 6.0 * ca_arm * float(battle_input['defcev'])
-        cga = ca * float(battle_input['defcev'])
-
-        # TODO - factor in Attrition is 0.04, 0.015 in NPW, why?
-        cd  = 0.015 * rc * hc * ucd * cd_strength * cd_power * su_c * c_duration
-        cid = cd * 3.0 * cd_arm * su_ct * float(battle_input['atkcev'])
-        cgd = cd * float(battle_input['atkcev'])
-
-        # Calculate the advance rate
-        # Advance rate depends on the defense type
-        if battle_input['posture'] == 'Prepared Defense':
-            def_type = 'Prepared Defense'
-        elif battle_input['posture'] == 'Fortified Defense':
-            def_type = 'Fortified Defense'
-        else:
-            # Default to hasty defense
-            def_type = 'Hasty Defense'
-        adv = ADVANCE_RATE.get_advance_rate(PRatio, def_type,) # Base advance rate
-        # Modify advance rates by other factors
-        adv_terrain = ADVANCE_TERRAIN.get(battle_input['terrain'])
-        adv_road_quality = float(battle_input['roadQuality'])
-        adv_road_density = float(battle_input['roadDensity'])
-        adv_duration = float(battle_input['battleDuration'])/24
-        if adv_duration < 4/24:
-            adv_duration = 4/24
-        if adv_duration > 1:
-            adv_duration = 1
-        # River factors
-        if battle_input['riverObstacle'] == 'none':
-            adv_river = 1
-        else:
-            fordable, width = battle_input['riverObstacle'].split(' ')
-            if fordable == 'fordable':
-                adv_river = ADVANCE_RIVER_FORDABLE.interpolate(float(width))
-            else:
-                adv_river = ADVANCE_RIVER_UNFORDABLE.interpolate(float(width))
-        # Mine factor
-        if battle_input['mineObstacle'] == 'none':
-            adv_mine = 1
+        Args:
+            battle_input (dict): Dictionary with all battle data information
+            replications (int): Number of independent loss draws
+            recursive (bool): If True, the battle includes all subunits
+            workers (int): Number of worker processes, defaults to the CPU count
+            seed (int): Seed for the random streams of the replications
+            percentiles (tuple): Percentiles reported for every distribution
+
+        Returns:
+            dict: Loss distributions of each formation, keyed by formation id
+        """
+        results = self.simulate_battle(battle_input, recursive=recursive)
+        atkCas = CasualtyRates(results['atkPersCasualtyRate'],
+                               results['atkTankCasualtyRate'],
+                               results['atkArtilleryCasualtyRate'], True)
+        defCas = CasualtyRates(results['defPersCasualtyRate'],
+                               results['defTankCasualtyRate'],
+                               results['defArtilleryCasualtyRate'], False)
+        participants = ([(a, 'attacker', atkCas) for a in battle_input['attackers']] +
+                        [(d, 'defender', defCas) for d in battle_input['defenders']])
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if replications < MIN_POOL_REPLICATIONS:
+            workers = 1
+        chunks = [len(c) for c in np.array_split(np.arange(replications), workers) if len(c) > 0]
+        seeds = iter(np.random.SeedSequence(seed).spawn(len(participants) * len(chunks)))
+
+        plans = []
+        jobs = []
+        for formation_id, side, cr in participants:
+            plan = LossPlan(self.formationsById[formation_id])
+            plans.append((plan, side))
+            probabilities = loss_probabilities(cr)
+            jobs += [(plan.arrays, probabilities, n, next(seeds)) for n in chunks]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                outputs = list(pool.map(replicate_losses, *zip(*jobs)))
         else:
-            adv_mine = ADVANCE_MINES.interpolate(float(battle_input['mineObstacle']))
+            outputs = [replicate_losses(*job) for job in jobs]
+
+        def describe(counts):
+            stats = {'mean': counts.mean(axis=0)}
+            for p, value in zip(percentiles, np.percentile(counts, percentiles, axis=0)):
+                stats[f'p{p}'] = value
+            return stats
+
+        def by_key(keys, counts):
+            stats = {outcome: describe(c) for outcome, c in counts.items()}
+            return {key: {outcome: {name: float(v[i]) for name, v in s.items()}
+                          for outcome, s in stats.items()}
+                    for i, key in enumerate(keys)}
+
+        distributions = {}
+        for i, (plan, side) in enumerate(plans):
+            counts = {outcome: np.concatenate([o[outcome] for o in outputs[i*len(chunks):(i+1)*len(chunks)]])
+                      for outcome in outputs[0]}
+            totals = {outcome: {name: float(v) for name, v in describe(c.sum(axis=1)).items()}
+                      for outcome, c in counts.items()}
+            distributions[plan.formation.id] = {
+                'name': plan.formation.name,
+                'side': side,
+                'replications': replications,
+                'personnel': by_key(plan.ranks, {k: counts[k] for k in ('killed', 'wounded')}),
+                'equipment': by_key(plan.nsns, {k: counts[k] for k in ('damaged', 'destroyed')}),
+                'totals': totals,
+            }
+        return distributions
 
-        for unit_type, rate in adv.items():
-            if unit_type in ['Armored', 'HorseCavalry']:
-                adv_terrain_factor = adv_terrain['Cavalry or Armored Force']
-            else:
-                adv_terrain_factor = adv_terrain['Infantry Force']
-            adv[unit_type] = rate * adv_terrain_factor * adv_road_quality * adv_road_density * adv_river * adv_mine * adv_duration
-
-        # Print combat data
-        print('###### COMBAT RESULTS ########\n' +
-              'Power Ratio: {:,.1f}\n'.format(PRatio) +
-              '  Attacker: P:{:,.1f} m:{:,.1f} v:{:,.1f}\n'.format(atk_P, atk_m, atk_v) +
-              '  Defender: P:{:,.1f} m:{:,.1f} v:{:,.1f}\n'.format(def_P, def_m, def_v) +
-              'Casualty Rates:\n' +
-              '  Attacker: {:.2f}% pers {:.2f}% tanks {:.2f}% artillery\n'.format(ca*100, cia*100, cga*100) +
-              '             {:,.0f}/{:,.0f} personnel | {:,.0f}/{:,.0f} armour\n'.format(ca*Na, Na, cia*Nia, Nia) +
-              '      Factors: P{:,.2f} S{:,.2f} Arm{:,.2f}\n'.format(ca_power, ca_strength, ca_arm, Nia) +
-              '  Defender: {:.2f}% pers {:.2f}% tanks {:.2f}% artillery\n'.format(cd*100, cid*100, cgd*100) +
-              '      Factors: P{:,.2f} S{:,.2f} Arm{:,.2f}\n'.format(cd_power, cd_strength, cd_arm) +
-              '             {:,.0f}/{:,.0f} personnel | {:,.0f}/{:,.0f} armour\n'.format(cd*Nd, Nd, cid*Nid, Nid) +
-              'Advance Rates:'
-              )
-        for key in adv:
-            print('  {}: {:.1f} km/day'.format(key, adv[key]))
-        
-        if commit:
-            # send casualty data to the formations
-            atkCas = CasualtyRates(ca, cia, cga, True)
-            defCas = CasualtyRates(cd, cid, cgd, False)
-            for a in atk_land_units:
-                self.formationsById[a].inflict_losses(atkCas)
-            for d in def_land_units:
-                self.formationsById[d].inflict_losses(defCas)
+    @locked
+    def save_sim_state(self, filename, checkpoint=False):
+        """Saves the simulation state.
 
-        else:
-            # return data to the caller
-            battleResults = {'powerRatio': PRatio,
-                             'powerAtk': atk_P,
-                             'powerDef': def_P,
-                             'atkPersCasualtyRate': ca,
-                             'atkTankCasualtyRate': cia,
-                             'defPersCasualtyRate': cd,
-                             'defTankCasualtyRate': cid,
-                             'advanceRate': adv,
-                            }
-            return battleResults
-
-    def save_sim_state(self, filename):
-        logging.info(f'Saving simulation state to {filename}')
-        state = {
+        Once a checkpoint has been written, every committed battle and
+        snapshot is appended to its journal (filename + '.journal') as it
+        happens, so saving again only has to make sure the journal is on
+        disk. A new checkpoint is written when asked for, when the journal has
+        grown past MAX_JOURNAL_RECORDS or when saving to another file.
+
+        Args:
+            filename (str): Checkpoint file
+            checkpoint (bool): If True, always write a new checkpoint
+        """
+        journal = self.journal
+        if (not checkpoint and journal is not None and journal.filename == filename + '.journal'
+                and len(journal) < MAX_JOURNAL_RECORDS):
+            logger.info(f'Simulation state saved in journal {journal.filename} ({len(journal)} records)')
+            return
+        logger.info(f'Saving simulation state to {filename}')
+        checkpoint_id = str(uuid4())
+        formations = list(self.formationsById.values())
+        meta = {
+            'format': SAVE_FORMAT,
             'scenario_name': self.scenario_name,
-            'formations': self.formations,
-            'formationsByName': self.formationsByName,
-            'formationsById': self.formationsById,
+            'factions': {faction: [form.id for form in self.formations[faction]]
+                         for faction in self.formations},
+            'formationsByName': {name: form.id for name, form in self.formationsByName.items()},
             'dispersion': self.dispersion,
+            'checkpoint_id': checkpoint_id,
         }
-        with open(filename, 'wb') as f:
-            pickle.dump(state, f)
-        logging.info(f'Succesfully saved simulation state to {filename}')
-
+        # Replace the checkpoint atomically, an old journal no longer matches it
+        with open(filename + '.tmp', 'wb') as f:
+            writer = SaveWriter(f)
+            writer.add_object('meta', meta)
+            # Each formation is its own section of records that name its LINs
+            # and equipment, which are looked up again in the databases on load
+            for form in formations:
+                writer.add_formation(form.to_record(recursive=False),
+                                     form.parent.id if form.parent is not None else None)
+            writer.add_history(self.history)
+            writer.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+        self.close_journal()
+        self.journal = Journal.create(filename + '.journal', checkpoint_id)
+        logger.info(f'Succesfully saved simulation state to {filename}')
+
+    @locked
     def load_sim_state(self, filename):
-        logging.info(f'Loading simulation state from {filename}')
-        with open(filename, 'rb') as f:
-            state = pickle.load(f)
+        """Loads a checkpoint and replays its journal on top of it."""
+        logger.info(f'Loading simulation state from {filename}')
+        self.close_journal()
+        if is_save_container(filename):
+            with SaveReader(filename) as reader:
+                state = reader.meta
+                self._read_formations(reader)
+                self.build_history(HistoryStore.from_arrays(*reader.history_store().arrays()))
+        else:
+            with open(filename, 'rb') as f:
+                state = pickle.load(f)
+            self._unpickle_formations(state)
+            # Snapshots of pickled saves are kept by their formations
+            self.build_history()
+        self.dispersion = state['dispersion']
+        self.scenario_loaded = True
+        self._formations_by_nsn = None
+        self.orbat_changed()
+        self.build_element_store()
+
+        journal, records = Journal.open(filename + '.journal', state.get('checkpoint_id'))
+        self._replaying = True
+        try:
+            for record in records:
+                self._replay(record)
+        finally:
+            self._replaying = False
+        self.journal = journal
+        logger.info(f'Successfully loaded simulation state from {filename}, '
+                    f'replayed {len(records)} journal records')
+        self._publish({'type': 'load', 'dates': self.get_snapshot_dates()})
+
+    def _read_formations(self, reader):
+        """Rebuilds the formations of a save container."""
+        def read(formation_id):
+            record = reader.formation(formation_id)
+            subunits = [read(sub) for sub in record['subunits']]
+            form = Formation.from_record(record, GLOBAL_TOE_DATABASE, self.equipment_database,
+                                         subunits)
+            self.formationsById[form.id] = form
+            return form
+
+        self.formationsById = {}
+        self.formations = {faction: [read(f) for f in ids]
+                           for faction, ids in reader.meta['factions'].items()}
+        # Subunits were read first, restore the order the formations were saved in
+        self.formationsById = {f['id']: self.formationsById[f['id']]
+                               for f in reader.formations()}
+        self.formationsByName = {name: self.formationsById[form_id]
+                                 for name, form_id in reader.meta['formationsByName'].items()}
+
+    def _unpickle_formations(self, state):
+        """Rebuilds the formations of a save written as a single pickle."""
+        if 'format' in state:
+            self.formations = {}
+            self.formationsById = {}
+            for faction, records in state['formations'].items():
+                self.formations[faction] = [Formation.from_record(r, GLOBAL_TOE_DATABASE,
+                                                                  self.equipment_database)
+                                            for r in records]
+                for form in self.formations[faction]:
+                    self._add_subunits(form)
+            self.formationsByName = {name: self.formationsById[form_id]
+                                     for name, form_id in state['formationsByName'].items()}
+        else:
             self.formations = state['formations']
             self.formationsByName = state['formationsByName']
             self.formationsById = state['formationsById']
-            self.dispersion = state['dispersion']
-            self.scenario_loaded = True
-        logging.info(f'Successfully loaded simulation state from {filename}')
+            # Rebuild the parent links behind the cached formation rollups
+            for faction in self.formations:
+                for form in self.formations[faction]:
+                    form.parent = None
+                    form.link(recursive=True)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def _journal_elements(self, formation_ids):
+        """Lists the elements of formations and all their subunits as
+        (formation id, index within the formation, element)."""
+        elements = []
+        seen = set()
+        stack = [self.formationsById[f] for f in formation_ids]
+        while stack:
+            formation = stack.pop()
+            if formation.id in seen:
+                continue
+            seen.add(formation.id)
+            elements += [(formation.id, i, e) for i, e in enumerate(formation._elements())]
+            stack += formation.subunits
+        return elements
+
+    def _replay(self, record):
+        """Applies a journal record to the simulation state."""
+        if record['type'] == 'battle':
+            elements = {}
+            for formation_id, index, status in record['changes']:
+                if formation_id not in elements:
+                    elements[formation_id] = list(self.formationsById[formation_id]._elements())
+                elements[formation_id][index].set_status(ElementStatus(status))
+        elif record['type'] == 'snapshot':
+            self.formation_snapshot(record['date'], record['locations'])
+        else:
+            logger.warning(f'Skipping unknown journal record {record["type"]}')
 
 
     def log_sitrep(self, battle_input, results):
@@ -872,29 +1204,83 @@ class Wargame:
             file.write("\n".join(sitrep) + "\n\n")
 
     def formation_snapshot(self, battle_datetime, unit_locations):
-        for formation in self.formationsById.values():
-            # Check the unit_locations report to see if any match the formation
-            location = None
-            formation.snapshot(battle_datetime, location)
-            # Update the scenario date
-            self.current_date = datetime.datetime.fromisoformat(battle_datetime)
-        # Add the locations afterwards to avoid a bug where the location is reset to None in subformations for some reason!
+        """Snapshots every formation on a date.
+
+        Each top level formation snapshots its whole subtree in one pass, so
+        every formation is counted once, and the reported unit locations are
+        recorded in the same pass.
+
+        Args:
+            battle_datetime (str): Datecode of the snapshot
+            unit_locations (list): Dictionaries of the 'id' and 'coordinates'
+                of located formations
+
+        Returns:
+            int: Number of elements counted
+        """
+        locations = {}
         for unit in unit_locations:
-            formation = self.formationsById[unit['id']]
-            location = unit['coordinates']
-            logging.debug(f"Updating location for {formation.name} to {location}")
-            formation.snapshot(battle_datetime, location)
-        return True
+            if unit['id'] not in self.formationsById:
+                logger.warning(f'Skipping location of unknown formation {unit["id"]}')
+                continue
+            logger.debug('Updating location for %s to %s',
+                         self.formationsById[unit['id']].name, unit['coordinates'])
+            locations[unit['id']] = unit['coordinates']
+        new = battle_datetime not in self.history.dates
+        touched = 0
+        for faction in self.formations:
+            for formation in self.formations[faction]:
+                touched += formation.snapshot(battle_datetime, locations=locations)
+        # Update the scenario date
+        self.current_date = datetime.datetime.fromisoformat(battle_datetime)
+        if self.journal is not None:
+            self.journal.append({'type': 'snapshot', 'date': battle_datetime,
+                                 'locations': unit_locations})
+        logger.info(f'Snapshot of {battle_datetime} counted {touched} elements')
+        self._publish({'type': 'snapshot', 'date': battle_datetime, 'new': new})
+        return touched
+
+    def get_snapshot_dates(self):
+        """Lists the datecodes with snapshots, in time order."""
+        return sorted(self.history.dates)
+
+    def _located_formations(self, located):
+        """Lists the located formations of the scenario in ORBAT order."""
+        if self._formation_order is None:
+            self._formation_order = {formation_id: i
+                                     for i, formation_id in enumerate(self.formationsById)}
+        order = self._formation_order
+        return [{'id': formation_id, 'location': located[formation_id]}
+                for formation_id in sorted((f for f in located if f in order), key=order.get)]
+
+    def get_snapshots(self, battle_datetime, match='exact'):
+        """Retrieve snapshots for all formations on a specific battle_date.
 
-    def get_snapshots(self, battle_datetime):
-        """Retrieve snapshots for all formations on a specific battle_date."""
-        snapshots = []
-        for formation in self.formationsById.values():
-            snapshot = formation.get_snapshot(battle_datetime)
-            if snapshot is not None:
-                if snapshot['location'] is not None:
-                    snapshots.append({
-                        'id': formation.id,
-                        'location': snapshot['location']
-                    })
-        return {'formations': snapshots}
\ No newline at end of file
+        Args:
+            battle_datetime (str): Datecode of the snapshots
+            match (str): 'exact' for the snapshots on the datecode, or 'before'
+                for the latest location of each formation on or before it
+        """
+        if match == 'exact':
+            date, located = battle_datetime, self.history.located(battle_datetime)
+        elif match == 'before':
+            date, located = self.history.located_before(battle_datetime)
+        else:
+            raise ValueError(f'Unknown snapshot match {match}')
+        return {'date': date, 'formations': self._located_formations(located)}
+
+    def get_snapshots_between(self, start, end):
+        """Retrieve snapshots for all formations on every date from start to
+        end, inclusive, in date order."""
+        return {'snapshots': [{'date': date, 'formations': self._located_formations(located)}
+                              for date, located in self.history.located_between(start, end)]}
+
+    def timeline(self, start, end):
+        """Returns the playback Timeline of the snapshots from start to end.
+
+        The last timeline is reused until a snapshot is taken or a save is loaded.
+        """
+        key = (self.history, self.history.n_versions, start, end)
+        if self._timeline is None or self._timeline[0] != key:
+            self._timeline = (key, Timeline(self.history, start, end))
+        return self._timeline[1]
\ No newline at end of file
@@ -5,9 +5,14 @@ import logging
 
 from qjm import EquipmentOLICategory, VehicleCategory
 
+logger = logging.getLogger(__name__)
+
 GLOBAL_DISPERSION = 4000
 GUIDANCE_TYPES = ['radar', 'infrared', 'beam', 'wire', 'fire and forget']
 
+# Use the C accelerated YAML loader when libyaml is available
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
 # load in interpolation arrays
 RF_CAL = []
 RF_RF = []
@@ -28,9 +33,11 @@ with open('./database/tables/PTS.csv') as f:
 
 
 class Weapon:
-    def __init__(self, file):
-        with open(file) as f:
-            data = yaml.full_load(f)
+    def __init__(self, file, data=None):
+        # data is the already parsed yaml of file, if available
+        if data is None:
+            with open(file) as f:
+                data = yaml.load(f, Loader=YAML_LOADER)
 
         # raw data read in from yml data
         self.name = data.get('name', 'Unknown')
@@ -78,7 +85,7 @@ class Weapon:
             self.oli_category = EquipmentOLICategory.aircraft
         else:
             self.oli_category = EquipmentOLICategory.unknown
-            logging.error(f'Weapon {self.name} has unknown category {self.category}')
+            logger.error(f'Weapon {self.name} has unknown category {self.category}')
 
         # set the vehicle category
         self.qjm_vehicle_category = VehicleCategory.infantry
@@ -1,11 +1,21 @@
 from flask import Flask, render_template, jsonify, request, redirect
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit
+
+import os
+import logging
 
 from qjm import Wargame
+from qjm.events import EVENTS, configure_logging
+from qjm.playback import Playback
 
+configure_logging(level=logging.INFO, filename='debug.log')
 app = Flask(__name__)
 socketio = SocketIO(app)
 wargame = Wargame()
+# Timeline playback of each connected client, by session id
+playbacks = {}
+# Push the changes of committed battles and snapshots to every client
+wargame.subscribe(lambda changes: socketio.emit('state_changes', changes))
 
 
 @app.route("/")
@@ -30,8 +40,24 @@ def load_scenario(scenario):
 
 @app.route("/qjm/get_units", methods=['GET'])
 def get_units():
-    formations = wargame.get_formations_as_tree()
-    return jsonify(formations)
+    # lazy=1 returns one level of the tree, below the parent id if given
+    lazy = request.args.get('lazy', '0') not in ('0', 'false', '')
+    etag = wargame.orbat_etag()
+    if lazy:
+        etag += '-lazy'
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    elif lazy:
+        level = wargame.get_formations_level(request.args.get('parent'))
+        if level is None:
+            return jsonify({'error': 'Formation not found'}), 404
+        response = jsonify(level)
+    else:
+        body, _ = wargame.get_formations_tree_json()
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route("/qjm/get_air_units", methods=['GET'])
 def get_air_units():
@@ -56,8 +82,12 @@ def get_air_units():
 @app.route('/simulate_battle', methods=['POST'])
 def simulate_battle():
     data = request.json
-    # run the simulation function
-    results = wargame.simulate_battle(data, recursive=False)
+    # run the simulation function, with the factor trace if asked for
+    trace = bool(data.pop('trace', False))
+    try:
+        results = wargame.simulate_battle(data, recursive=False, trace=trace)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify(results)
 
 
@@ -65,10 +95,76 @@ def simulate_battle():
 def commit_battle():
     data = request.json
     # run the simulation function
-    status = wargame.simulate_battle(data, recursive=False, commit=True)
+    try:
+        status = wargame.simulate_battle(data, recursive=False, commit=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify({'status': status})
 
 
+@app.route('/simulate_losses', methods=['POST'])
+def simulate_losses():
+    data = request.json
+    # sample the loss distributions without committing them
+    replications = int(data.get('replications', 1000))
+    try:
+        results = wargame.simulate_losses(data, replications=replications, recursive=False)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(results)
+
+
+@app.route('/sweep', methods=['POST'])
+def sweep():
+    data = request.json
+    # resolve the battle over every combination of the swept conditions
+    axes = data.pop('axes', {})
+    try:
+        rows = wargame.sweep(data, axes, recursive=False)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'rows': rows})
+
+
+@app.route('/power_matrix', methods=['POST'])
+def power_matrix():
+    data = request.json
+    # every attacker against every defender, by default all units of two factions
+    attackers = data.pop('attackers', None)
+    defenders = data.pop('defenders', None)
+    if attackers is None:
+        attackers = [f.id for f in wargame.formations.get(data.get('attackerFaction'), [])]
+    if defenders is None:
+        defenders = [f.id for f in wargame.formations.get(data.get('defenderFaction'), [])]
+    try:
+        matrix = wargame.power_matrix(attackers, defenders, data, recursive=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(matrix)
+
+
+@app.route('/reload_equipment', methods=['POST'])
+def reload_equipment():
+    changed = wargame.reload_equipment()
+    return jsonify({'changed': changed})
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    # buffered engine events, optionally filtered by level
+    level = logging.getLevelName(request.args.get('level', 'NOTSET').upper())
+    if not isinstance(level, int):
+        return jsonify({'error': 'Unknown level'}), 400
+    return jsonify({'events': EVENTS.records(level), 'dropped': EVENTS.dropped})
+
+
+@app.route('/flush_events', methods=['POST'])
+def flush_events():
+    # empty the event buffer, appending the events to the event log file
+    events = EVENTS.drain('events.jsonl')
+    return jsonify({'flushed': len(events)})
+
+
 @app.route('/export_orbatmapper', methods=['POST'])
 def export_orbatmapper():
     status = wargame.export_orbatmapper('toe.json')
@@ -77,7 +173,10 @@ def export_orbatmapper():
 
 @app.route('/save_scenario_state', methods=['POST'])
 def save_scenario_state():
-    wargame.save_sim_state('./wargames/saves/scenario_save.sav')
+    # saves append to the journal, unless a full checkpoint is asked for
+    data = request.get_json(silent=True) or {}
+    wargame.save_sim_state('./wargames/saves/scenario_save.sav',
+                           checkpoint=bool(data.get('checkpoint', False)))
     return jsonify({'status': True})
 
 
@@ -139,18 +238,102 @@ def snapshot():
     battle_date = data.get('date')
     unit_locations = data.get('unitLocations', [])
     if battle_date:
-        success = wargame.formation_snapshot(battle_date, unit_locations)
-        if success:
-            return jsonify({'status': 'success'})
+        elements = wargame.formation_snapshot(battle_date, unit_locations)
+        return jsonify({'status': 'success', 'elements': elements})
     
     return jsonify({'status': 'failure'}), 400
 
 
+@app.route('/get_snapshot_dates')
+def get_snapshot_dates():
+    return jsonify({'dates': wargame.get_snapshot_dates()})
+
+
 @app.route('/get_snapshots/<date>')
 def get_snapshots(date):
-    snapshots = wargame.get_snapshots(date)
+    # match=before returns the latest location of each formation on or before the date
+    match = request.args.get('match', 'exact')
+    if match not in ('exact', 'before'):
+        return jsonify({'error': 'Unknown match'}), 400
+    snapshots = wargame.get_snapshots(date, match)
     return jsonify(snapshots)
 
 
+@app.route('/get_snapshots/<start>/<end>')
+def get_snapshots_between(start, end):
+    snapshots = wargame.get_snapshots_between(start, end)
+    return jsonify(snapshots)
+
+
+def stream_playback(sid, playback, generation):
+    # send frames until paused, superseded by a new play or at the end
+    while playback.playing and playback.generation == generation:
+        frame = playback.next_frame()
+        if frame is None:
+            socketio.emit('playback_end', {'index': playback.position}, to=sid)
+            break
+        socketio.emit('playback_frame', frame, to=sid)
+        socketio.sleep(playback.interval)
+
+
+def client_playback(data):
+    # the playback of the client, on the timeline from start to end if given
+    sid = request.sid
+    playback = playbacks.get(sid)
+    start, end = data.get('start'), data.get('end')
+    if start is not None and end is not None:
+        timeline = wargame.timeline(start, end)
+        if playback is None or playback.timeline is not timeline:
+            if playback is not None:
+                playback.pause()
+            playback = playbacks[sid] = Playback(timeline)
+    return playback
+
+
+@socketio.on('playback_play')
+def playback_play(data=None):
+    # data: start and end datecodes of the timeline, and seconds between frames
+    data = data or {}
+    sid = request.sid
+    playback = client_playback(data)
+    if playback is None:
+        emit('playback_error', {'error': 'No timeline, play with a start and end date'})
+        return
+    if 'interval' in data:
+        playback.interval = max(float(data['interval']), 0.05)
+    generation = playback.play()
+    socketio.start_background_task(stream_playback, sid, playback, generation)
+
+
+@socketio.on('playback_pause')
+def playback_pause(data=None):
+    playback = playbacks.get(request.sid)
+    if playback is not None:
+        playback.pause()
+
+
+@socketio.on('playback_seek')
+def playback_seek(data):
+    # seek by frame index or datecode, the frame is sent with every unit
+    playback = client_playback(data)
+    if playback is None:
+        emit('playback_error', {'error': 'No timeline, play with a start and end date'})
+        return
+    frame = playback.seek(index=data.get('index'), datecode=data.get('date'))
+    if frame is not None:
+        emit('playback_frame', frame)
+
+
+@socketio.on('disconnect')
+def playback_disconnect(*args):
+    playback = playbacks.pop(request.sid, None)
+    if playback is not None:
+        playback.pause()
+
+
 if __name__ == "__main__":
-    app.run(app, debug=True)
+    debug = True
+    # With the reloader, only watch from the child process that serves requests
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        wargame.watch_equipment()
+    socketio.run(app, debug=debug)
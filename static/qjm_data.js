@@ -51,6 +51,9 @@ function sendData(commit=false) {
         .then(result => {
         console.log('Success:', result);
         // Handle success response
+        if (result.error) {
+            alert(`Battle not committed: ${result.error}`);
+        };
         })
         .catch(error => {
         console.error('Error:', error);
@@ -58,6 +61,8 @@ function sendData(commit=false) {
         });
 
     } else {
+        // Ask for the factor trace to show how the result was reached
+        data.trace = true;
         fetch('/simulate_battle', {
         method: 'POST',
         headers: {
@@ -71,6 +76,10 @@ function sendData(commit=false) {
         // Handle success response
         // Populate the modal with the simulation results
         const battleResultsContent = document.getElementById('battleResultsContent');
+        if (result.error) {
+            battleResultsContent.innerHTML = `<p><strong>Battle not resolved:</strong> ${result.error}</p>`;
+            return;
+        };
         // loop through result.advanceRate keys and values to present them in the modal
         battleResultsContent.innerHTML = `
             <p><strong>Power Ratio:</strong> ${result.powerRatio.toFixed(2)}</p>
@@ -85,6 +94,9 @@ function sendData(commit=false) {
             for (const [key, value] of Object.entries(result.advanceRate)) {
                 battleResultsContent.innerHTML += `<p>${key}: ${value.toFixed(1)} km/day</p>`;
             };
+            if (result.trace) {
+                battleResultsContent.innerHTML += formatBattleTrace(result.trace);
+            };
         })
         .catch(error => {
         console.error('Error:', error);
@@ -94,6 +106,30 @@ function sendData(commit=false) {
 }
 
 
+function formatBattleTrace(trace) {
+    // Render every factor and intermediate value of the battle as a collapsible table
+    const formatValue = value => typeof value === 'number'
+        ? value.toLocaleString('en-US', {maximumFractionDigits: 4})
+        : value;
+    let rows = '';
+    for (const [key, value] of Object.entries(trace)) {
+        if (value !== null && typeof value === 'object' && !Array.isArray(value)) {
+            for (const [subkey, subvalue] of Object.entries(value)) {
+                rows += `<tr><td>${key}.${subkey}</td><td>${formatValue(subvalue)}</td></tr>`;
+            };
+        } else {
+            rows += `<tr><td>${key}</td><td>${formatValue(value)}</td></tr>`;
+        };
+    };
+    return `
+        <details>
+            <summary><strong>Battle Trace</strong></summary>
+            <table class="table table-xs">${rows}</table>
+        </details>
+        `;
+}
+
+
 function getPersonnelCount() {
     const data = {
       attackers: Array.from(document.querySelectorAll('#attackers .draggable')).map(el => el.dataset.unitId),
@@ -0,0 +1,96 @@
+// Timeline playback of the snapshots, streamed by the server over the socket of qjm_sync.js
+var playbackPlaying = false;
+// Latest playback frame of each unit, applied once its marker is created
+const playbackUnits = new Map();
+// Units whose marker waits for their formation details
+const pendingMarkers = new Set();
+
+function playbackRange() {
+    // Play over every snapshot date in the snapshot list
+    const dates = Array.from(document.getElementById('snapshot_dates').options)
+        .map(option => option.value).filter(date => date !== '');
+    return dates.length ? { start: dates[0], end: dates[dates.length - 1] } : null;
+}
+
+function togglePlayback() {
+    const range = playbackRange();
+    if (!range) {
+        alert('There are no snapshots to play.');
+        return;
+    }
+    if (playbackPlaying) {
+        socket.emit('playback_pause');
+        setPlaybackPlaying(false);
+    } else {
+        socket.emit('playback_play', { start: range.start, end: range.end, interval: 1.0 });
+        setPlaybackPlaying(true);
+    }
+}
+
+function seekPlayback(index) {
+    const range = playbackRange();
+    if (range) {
+        socket.emit('playback_seek', { start: range.start, end: range.end, index: Number(index) });
+    }
+}
+
+function setPlaybackPlaying(playing) {
+    playbackPlaying = playing;
+    document.getElementById('playbackButton').textContent = playing ? 'Pause' : 'Play';
+}
+
+socket.on('playback_frame', frame => {
+    if (frame.keyframe) {
+        // A keyframe holds every unit, so remove the markers of the others
+        Object.keys(mapUnits).forEach(unitId => {
+            if (!(unitId in frame.units)) {
+                mapUnits[unitId].remove();
+                delete mapUnits[unitId];
+                playbackUnits.delete(unitId);
+            }
+        });
+    }
+    Object.entries(frame.units).forEach(([unitId, unit]) => moveUnitMarker(unitId, unit));
+    const slider = document.getElementById('playbackSlider');
+    slider.max = frame.count - 1;
+    slider.value = frame.index;
+    document.getElementById('playbackDate').textContent = frame.date.replace('T', ' ');
+});
+
+socket.on('playback_end', () => setPlaybackPlaying(false));
+
+socket.on('playback_error', error => {
+    console.error('Playback error:', error.error);
+    setPlaybackPlaying(false);
+});
+
+function moveUnitMarker(unitId, unit) {
+    // Move the marker of a unit, creating it the first time the unit is located
+    if (!unit.location) {
+        return;
+    }
+    playbackUnits.set(unitId, unit);
+    if (unitId in mapUnits) {
+        showMarkerStrength(mapUnits[unitId], unit);
+        mapUnits[unitId].setLngLat([unit.location.lng, unit.location.lat]);
+    } else if (!pendingMarkers.has(unitId)) {
+        pendingMarkers.add(unitId);
+        getFormationById(unitId).then(formation => {
+            pendingMarkers.delete(unitId);
+            const latest = playbackUnits.get(unitId);
+            if (!latest || unitId in mapUnits) {
+                return;
+            }
+            mapUnits[unitId] = createUnitMarker(unitId, formation, latest.location);
+            showMarkerStrength(mapUnits[unitId], latest);
+        });
+    }
+}
+
+function showMarkerStrength(marker, unit) {
+    // Fade the marker with the available share of the assigned personnel
+    const [assigned, available, equipmentAssigned, equipmentAvailable] = unit.strength;
+    const element = marker.getElement();
+    element.style.opacity = assigned ? 0.4 + 0.6 * available / assigned : 1;
+    element.title = `Personnel ${available}/${assigned}, equipment ${equipmentAvailable}/${equipmentAssigned}`;
+}
@@ -0,0 +1,114 @@
+// Changes pushed by the server after committed battles, snapshots and loaded saves
+const socket = io();
+
+// Latest state of the formations changed by battles, by formation id
+const formationStates = new Map();
+
+socket.on('state_changes', changes => {
+    console.log('State changes:', changes);
+    if (changes.type === 'battle') {
+        applyBattleChanges(changes.formations);
+    } else if (changes.type === 'snapshot') {
+        addSnapshotDate(changes.date);
+    } else if (changes.type === 'load') {
+        // A loaded save replaces every formation, so start over
+        formationStates.clear();
+        formationCache.clear();
+        setSnapshotDates(changes.dates);
+        reloadTree();
+    }
+});
+
+
+function applyBattleChanges(formations) {
+    formations.forEach(state => {
+        formationStates.set(state.id, state);
+        const cached = formationCache.get(state.id);
+        if (cached) {
+            cached.personnel = state.personnel;
+            cached.oli = state.oli;
+        }
+        document.querySelectorAll(`.node[data-unit-id="${state.id}"]`).forEach(node => showStrength(node, state));
+        if (shownFormationId === state.id) {
+            document.getElementById('formationPersonnel').value = state.personnel;
+            document.getElementById('formationOLI').value = state.oli.toFixed(0);
+        }
+    });
+    updateDefenderDensity();
+}
+
+
+function showStrength(node, state) {
+    // Show the strength after the name of a unit tree node
+    let strength = node.querySelector('.unit-strength');
+    if (!strength) {
+        strength = document.createElement('span');
+        strength.classList.add('unit-strength');
+        strength.style.marginLeft = '5px';
+        strength.style.fontSize = 'smaller';
+        node.firstChild.appendChild(strength);
+    }
+    strength.textContent = `(${state.personnel} pers, OLI ${state.oli.toFixed(0)})`;
+    strength.title = Object.entries(state.status).map(([status, count]) => `${status}: ${count}`).join(', ');
+}
+
+
+function updateDefenderDensity() {
+    // Recalculate the defender density from the pushed states, when all defenders have one
+    const defenders = Array.from(document.querySelectorAll('#defenders .draggable')).map(el => el.dataset.unitId);
+    if (defenders.length === 0 || !defenders.every(id => formationStates.has(id))) {
+        return;
+    }
+    const personnel = defenders.reduce((total, id) => total + formationStates.get(id).localPersonnel, 0);
+    const defFrontage = document.getElementById('defFrontage').value;
+    document.getElementById('defDensity').value = (personnel / (1000 * defFrontage)).toFixed(1);
+}
+
+
+async function fetchSnapshotDates() {
+    const response = await fetch('/get_snapshot_dates');
+    const data = await response.json();
+    setSnapshotDates(data.dates);
+}
+
+
+function setSnapshotDates(dates) {
+    const select = document.getElementById('snapshot_dates');
+    select.querySelectorAll('option[value]:not([value=""])').forEach(option => option.remove());
+    dates.forEach(addSnapshotDate);
+}
+
+
+function addSnapshotDate(date) {
+    // Insert a date into the snapshot list, keeping it in time order
+    const select = document.getElementById('snapshot_dates');
+    const options = Array.from(select.options).filter(option => option.value !== '');
+    if (options.some(option => option.value === date)) {
+        return;
+    }
+    const option = document.createElement('option');
+    option.value = date;
+    option.textContent = date.replace('T', ' ');
+    const next = options.find(other => other.value > date);
+    select.insertBefore(option, next || null);
+}
+
+
+function selectSnapshotDate(date) {
+    // Move the date inputs to a snapshot and show its units on the map
+    const [day, time] = date.split('T');
+    const [hour, minute] = time.split(':');
+    document.getElementById('battle_date').value = day;
+    document.getElementById('battle_hour').value = hour;
+    document.getElementById('battle_minute').value = minute;
+    handleDateChange();
+}
+
+
+async function reloadTree() {
+    unitLevels.clear();
+    ['unit-tree-container', 'map-units-list'].forEach(containerId => {
+        document.getElementById(containerId).querySelectorAll('.tree-list').forEach(ul => ul.remove());
+    });
+    await initTree();
+}
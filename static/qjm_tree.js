@@ -1,8 +1,20 @@
-async function fetchUnits() {
-    const response = await fetch('/qjm/get_units');
+// Levels of the unit tree already fetched, by URL, with their ETags
+const unitLevels = new Map();
+
+async function fetchUnits(parentId = null) {
+    // Fetch one level of the tree: the factions, or the children of parentId
+    let url = '/qjm/get_units?lazy=1';
+    if (parentId !== null) {
+        url += '&parent=' + encodeURIComponent(parentId);
+    }
+    const cached = unitLevels.get(url);
+    const headers = cached ? { 'If-None-Match': cached.etag } : {};
+    const response = await fetch(url, { headers: headers, cache: 'no-store' });
+    if (response.status === 304) {
+        return cached.data;
+    }
     const data = await response.json();
-    // log data to console for debug
-    console.log(data);
+    unitLevels.set(url, { etag: response.headers.get('ETag'), data: data });
     return data;
 }
 
@@ -29,11 +41,19 @@ function renderTreeList(containerId, data) {
         li.setAttribute('data-shortname', nodeData.shortname);
         li.setAttribute('data-original-index', index); // Store original index
 
-        // Toggle functionality to expand/collapse children
-        li.addEventListener('click', (event) => {
+        // Toggle functionality to expand/collapse children, fetched on the first expand
+        li.addEventListener('click', async (event) => {
             event.stopPropagation();  // Prevent triggering toggle on parent nodes
-            const childUl = li.querySelector('ul');
-            if (childUl) {
+            let childUl = li.querySelector(':scope > ul');
+            if (!childUl && nodeData.childCount > 0 && !li.dataset.loading) {
+                li.dataset.loading = 'true';
+                try {
+                    childUl = createChildList(await fetchUnits(nodeData.id));
+                    li.appendChild(childUl);
+                } finally {
+                    delete li.dataset.loading;
+                }
+            } else if (childUl) {
                 childUl.style.display = childUl.style.display === 'none' ? 'block' : 'none';
             }
         });
@@ -61,19 +81,18 @@ function renderTreeList(containerId, data) {
 
         // Add the container to the list item
         li.appendChild(symbolContainer);
+        if (formationStates.has(nodeData.id)) {
+            showStrength(li, formationStates.get(nodeData.id));
+        }
 
-        // If the node has children, create a nested ul element
-        if (nodeData.children && nodeData.children.length > 0) {
+        // Children are only fetched and created when the node is expanded
+        function createChildList(children) {
             const ul = document.createElement('ul');
             ul.classList.add('children-list');
-            ul.style.display = 'none';  // Initially hide children
-
-            // Recursively create child nodes
-            nodeData.children.forEach((child, childIndex) => {
+            children.forEach((child, childIndex) => {
                 ul.appendChild(createNode(child, nodeData.id, childIndex));
             });
-
-            li.appendChild(ul);
+            return ul;
         }
 
         // Make the list item draggable
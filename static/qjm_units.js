@@ -54,10 +54,13 @@ function createUnitDiv(unit, factionName, parent, isAirUnit = false) {
 }
 
 
+// Id of the formation shown in the formation modal
+var shownFormationId = null;
+
 function showFormationDetails(unitId) {
-  // Fetch the formation data from the server or use a preloaded JavaScript object
-  fetch(`/get_formation/${unitId}`)
-    .then(response => response.json())
+  // Fetch the formation data from the server, or reuse it if battles pushed its changes
+  shownFormationId = unitId;
+  getFormationById(unitId)
     .then(data => {
       const formationDetails = document.getElementById('formationDetails');
       formationDetails.innerHTML = ''; // Clear existing details
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The engine reads its databases relative to the repository root
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+from qjm import Wargame  # noqa: E402
+
+SCENARIO = 'bruderkrieg'
+
+# Battle conditions of the battles used by the tests
+CONDITIONS = [
+    {'terrain': 'Rolling - Mixed', 'weather': 'Dry - Sunshine - Temperate',
+     'season': 'Summer - Temperature', 'posture': 'Hasty Defense',
+     'airsuperiority': 'Air Parity', 'atksurprise': 'No Surprise', 'atksurprisedays': '0',
+     'atkcev': '1.0', 'defcev': '1.0', 'battleDuration': '24',
+     'roadQuality': '1.0', 'roadDensity': '1.0', 'riverObstacle': 'none',
+     'mineObstacle': 'none', 'shorelineType': 'No shoreline', 'shorelineFires': 'No shoreline'},
+    {'terrain': 'Rugged - Heavily Wooded', 'weather': 'Wet - Heavy - Extreme Cold',
+     'season': 'Winter - Temperate', 'posture': 'Prepared Defense',
+     'airsuperiority': 'Air Superiority', 'atksurprise': 'Minor Surprise', 'atksurprisedays': '1',
+     'atkcev': '1.3', 'defcev': '0.9', 'battleDuration': '12',
+     'roadQuality': '0.8', 'roadDensity': '0.7', 'riverObstacle': 'fordable 50',
+     'mineObstacle': '20', 'shorelineType': 'No shoreline', 'shorelineFires': 'No shoreline'},
+    {'terrain': 'Urban', 'weather': 'Dry - Overcast - Extreme Heat',
+     'season': 'Spring - Desert', 'posture': 'Fortified Defense',
+     'airsuperiority': 'Air Inferiority', 'atksurprise': 'Complete Surprise',
+     'atksurprisedays': '2', 'atkcev': '0.8', 'defcev': '1.2', 'battleDuration': '48',
+     'roadQuality': '1.0', 'roadDensity': '0.7', 'riverObstacle': 'unfordable 100',
+     'mineObstacle': '100', 'shorelineType': 'Across Beach',
+     'shorelineFires': 'Light Artillery (up to 10,000 m from shore)'},
+]
+
+
+@pytest.fixture
+def wargame():
+    """A freshly loaded scenario, which the test may change."""
+    wargame = Wargame()
+    wargame.load_scenario(SCENARIO)
+    return wargame
+
+
+def top_formations(wargame):
+    """Returns the top level formations of the two factions of the scenario."""
+    blue, red = wargame.formations.values()
+    return blue, red
+
+
+def battle_input(attackers, defenders, conditions=0, **fields):
+    """Makes the battle_input of a battle between formations, without air
+    sorties unless given in fields.
+
+    Args:
+        attackers, defenders (list): Attacking and defending formations
+        conditions (int): Index of the battle conditions in CONDITIONS
+    """
+    battle = dict(CONDITIONS[conditions],
+                  attackers=[f.id for f in attackers], defenders=[f.id for f in defenders],
+                  air_attackers=[], air_defenders=[], battleDate='1985-08-14',
+                  battleTime='08:00', defFrontage='1')
+    battle.update(fields)
+    return battle
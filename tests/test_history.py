@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from toe import HistoryStore
+
+FORMATIONS = [f'formation-{i}' for i in range(8)]
+DATES = [f'1985-08-{day:02d}T08:00' for day in range(10, 22)]
+RANKS = ['Pvt', 'Cpl', 'Sgt', 'Lt']
+NSNS = ['1005-01', '2350-02', '2320-03']
+
+
+def random_entry(rng):
+    """Returns a random snapshot entry, located half of the time."""
+    def table(keys):
+        return {key: {'assigned': rng.randint(0, 20), 'available': rng.randint(0, 20)}
+                for key in rng.sample(keys, rng.randint(0, len(keys)))}
+    location = [rng.uniform(9, 11), rng.uniform(50, 52)] if rng.random() < 0.5 else None
+    return {'personnel': table(RANKS), 'equipment': table(NSNS), 'location': location}
+
+
+def random_history(seed):
+    """Records random snapshots out of time order, some of them again on the
+    same datecode.
+
+    Returns:
+        tuple: (store, snapshots) with the latest entry recorded for each
+            (formation id, datecode)
+    """
+    rng = random.Random(seed)
+    store = HistoryStore()
+    snapshots = {}
+    for _ in range(rng.randint(1, 80)):
+        formation_id, datecode = rng.choice(FORMATIONS), rng.choice(DATES)
+        entry = random_entry(rng)
+        store.record(formation_id, datecode, entry)
+        snapshots[formation_id, datecode] = entry
+    return store, snapshots
+
+
+def located_before(snapshots, datecode):
+    """Brute force HistoryStore.located_before."""
+    latest = {}
+    for (formation_id, date), entry in snapshots.items():
+        if date <= datecode and entry['location'] is not None:
+            if formation_id not in latest or date > latest[formation_id][0]:
+                latest[formation_id] = (date, entry['location'])
+    if not latest:
+        return None, {}
+    return (max(date for date, _ in latest.values()),
+            {formation_id: location for formation_id, (_, location) in latest.items()})
+
+
+def check(store, snapshots):
+    for datecode in DATES + ['1985-08-01T08:00', '1985-09-01T08:00']:
+        for formation_id in FORMATIONS:
+            entry = snapshots.get((formation_id, datecode))
+            assert store.get(formation_id, datecode) == entry
+            assert store.location(formation_id, datecode) == (entry and entry['location'])
+        assert store.snapshot(datecode) == {f: entry for (f, date), entry in snapshots.items()
+                                            if date == datecode}
+        assert store.located(datecode) == {f: entry['location']
+                                           for (f, date), entry in snapshots.items()
+                                           if date == datecode and entry['location'] is not None}
+        assert store.located_before(datecode) == located_before(snapshots, datecode)
+    for formation_id in FORMATIONS:
+        history = store.history(formation_id)
+        assert history == {date: entry for (f, date), entry in snapshots.items()
+                           if f == formation_id}
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_matches_brute_force(seed):
+    store, snapshots = random_history(seed)
+    check(store, snapshots)
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_from_arrays_round_trip(seed):
+    store, snapshots = random_history(seed)
+    check(HistoryStore.from_arrays(*store.arrays()), snapshots)
+    check(HistoryStore.from_arrays(*store.arrays(), copy=False), snapshots)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_timeline(seed):
+    store, snapshots = random_history(seed)
+    start, end = DATES[3], DATES[8]
+    frames = store.timeline(start, end)
+    assert [date for date, _ in frames] == sorted({date for _, date in snapshots
+                                                   if start <= date <= end})
+    for datecode, versions in frames:
+        for f, formation_id in enumerate(store.formations):
+            dates = [date for fid, date in snapshots if fid == formation_id and date <= datecode]
+            if dates:
+                assert store._version(formation_id, max(dates)) == versions[f]
+            else:
+                assert versions[f] == -1
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from qjm.kernel import battle_kernel, resolve_environment
+from qjm.wargame import BATTLE_RESULTS, SWEEP_RESULTS
+from toe import ElementStatus
+
+from conftest import CONDITIONS, battle_input, top_formations
+
+
+def battles(wargame):
+    """Fixed battles between the scenario's formations under every set of
+    CONDITIONS, as pairs of battle_input and gathered forces."""
+    blue, red = top_formations(wargame)
+    pairs = [([blue[0]], [red[0]]),
+             ([red[0]], [blue[1]]),
+             ([blue[1], blue[2]], red[0].subunits[:1]),
+             (red[0].subunits[3:4], [blue[1]])]
+    out = []
+    for i in range(len(CONDITIONS)):
+        for attackers, defenders in pairs:
+            battle = battle_input(attackers, defenders, conditions=i)
+            out.append((battle, wargame._gather_forces(battle)))
+    return out
+
+
+def kernel_args(wargame, battle):
+    return dict(atkcev=float(battle['atkcev']), defcev=float(battle['defcev']),
+                surprise_days=int(battle['atksurprisedays']),
+                duration=float(battle['battleDuration']),
+                road_quality=float(battle['roadQuality']),
+                road_density=float(battle['roadDensity']),
+                dispersion=wargame.dispersion)
+
+
+def test_batch_matches_single_battles(wargame):
+    """Resolving battles as one batch gives the results of resolving each alone."""
+    cases = battles(wargame)
+    single = [battle_kernel(env=resolve_environment(b), **forces, **kernel_args(wargame, b))
+              for b, forces in cases]
+    envs = [resolve_environment(b) for b, _ in cases]
+    args = [kernel_args(wargame, b) for b, _ in cases]
+    batch = battle_kernel(
+        np.concatenate([f['atk_oli'] for _, f in cases]),
+        np.concatenate([f['def_oli'] for _, f in cases]),
+        *(np.array([f[key] for _, f in cases]) for key in ('Na', 'Nd', 'Nia', 'Nid', 'Ja', 'Jd')),
+        {key: np.array([env[key] for env in envs]) for key in envs[0]},
+        **{key: np.array([a[key] for a in args]) for key in args[0]})
+    for i, results in enumerate(single):
+        for key in BATTLE_RESULTS:
+            np.testing.assert_allclose(batch[key][i], results[key][0], rtol=1e-12)
+
+
+def test_simulate_battle_matches_sweep(wargame):
+    """A battle resolved alone gives the results of the same battle in a sweep."""
+    blue, red = top_formations(wargame)
+    battle = battle_input([blue[0]], [red[0]])
+    postures = ['Hasty Defense', 'Prepared Defense', 'Fortified Defense']
+    rows = wargame.sweep(battle, {'posture': postures})
+    for posture, row in zip(postures, rows):
+        results = wargame.simulate_battle(dict(battle, posture=posture))
+        assert row['posture'] == posture
+        for key in SWEEP_RESULTS:
+            assert row[key] == pytest.approx(results[key], rel=1e-12)
+        assert row['advanceRate'] == pytest.approx(results['advanceRate'], rel=1e-12)
+
+
+def test_simulate_battle_matches_power_matrix(wargame):
+    """Every pair of the power matrix gives the results of the same battle alone."""
+    blue, red = top_formations(wargame)
+    attackers, defenders = blue[1:3], red[0].subunits[:2]
+    matrix = wargame.power_matrix([f.id for f in attackers], [f.id for f in defenders],
+                                  CONDITIONS[1])
+    for i, attacker in enumerate(attackers):
+        for j, defender in enumerate(defenders):
+            results = wargame.simulate_battle(battle_input([attacker], [defender], conditions=1))
+            for key in SWEEP_RESULTS:
+                assert matrix[key][i][j] == pytest.approx(results[key], rel=1e-12)
+
+
+def test_simulate_battle_is_deterministic(wargame):
+    blue, red = top_formations(wargame)
+    battle = battle_input([blue[0]], [red[0]], conditions=2)
+    assert wargame.simulate_battle(battle) == wargame.simulate_battle(battle)
+
+
+def test_side_without_personnel(wargame):
+    """A battle with a side without active personnel is rejected, and a
+    rejected battle commits no losses."""
+    blue, red = top_formations(wargame)
+    for person in red[0].get_all_personnel():
+        person.set_status(ElementStatus.DESTROYED)
+    statuses = [e.status for e in blue[0].get_all_personnel()]
+    with pytest.raises(ValueError, match='defenders have no active personnel'):
+        wargame.simulate_battle(battle_input([blue[0]], [red[0]]))
+    with pytest.raises(ValueError, match='attackers have no active personnel'):
+        wargame.simulate_battle(battle_input([red[0]], [blue[0]]), commit=True, seed=1)
+    assert [e.status for e in blue[0].get_all_personnel()] == statuses
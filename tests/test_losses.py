@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from qjm.qjm_data_classes import CasualtyRates
+from toe.losses import LOSS_CLASSES, WOUNDED, KILLED, loss_probabilities, sample_losses
+
+REPLICATIONS = 200_000
+SEED = 1985
+
+
+@pytest.fixture(params=[True, False], ids=['attacker', 'defender'])
+def probabilities(request):
+    return loss_probabilities(CasualtyRates(personnel=0.04, armour=0.12, artillery=0.09,
+                                            attacker=request.param))
+
+
+def plan_arrays():
+    """LossPlan.arrays of 4 personnel and a vehicle of every loss class with
+    two crew each, and one vehicle with two equipment items."""
+    n_classes = len(LOSS_CLASSES)
+    classes = np.full((2, n_classes + 1), -1, dtype=np.int16)
+    classes[0, :n_classes] = np.arange(n_classes)
+    classes[:, n_classes] = [0, 3]
+    return {'vehicle_classes': classes,
+            'crew_vehicle': np.repeat(np.arange(n_classes + 1), 2),
+            'n_personnel': 4}
+
+
+def assert_frequency(outcomes, p):
+    """Asserts the frequency of outcomes over the replications is within five
+    standard errors of p, for every element."""
+    error = 5 * np.sqrt(p * (1 - p) / len(outcomes))
+    np.testing.assert_array_less(np.abs(outcomes.mean(axis=0) - p), error + 1e-12)
+
+
+def test_same_seed_gives_same_draws(probabilities):
+    arrays = plan_arrays()
+    first = sample_losses(arrays, probabilities, np.random.default_rng(SEED), 1000)
+    second = sample_losses(arrays, probabilities, np.random.default_rng(SEED), 1000)
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+    other = sample_losses(arrays, probabilities, np.random.default_rng(SEED + 1), 1000)
+    assert any((a != b).any() for a, b in zip(first, other))
+
+
+def test_personnel_distribution(probabilities):
+    personnel, _, _ = sample_losses(plan_arrays(), probabilities,
+                                    np.random.default_rng(SEED), REPLICATIONS)
+    p, w = probabilities['personnel'], probabilities['wounded']
+    assert personnel.shape == (REPLICATIONS, 4)
+    assert set(np.unique(personnel)) <= {0, WOUNDED, KILLED}
+    assert_frequency(personnel == WOUNDED, p * w)
+    assert_frequency(personnel == KILLED, p * (1 - w))
+
+
+def test_vehicle_distribution(probabilities):
+    _, _, vehicles = sample_losses(plan_arrays(), probabilities,
+                                   np.random.default_rng(SEED), REPLICATIONS)
+    n_classes = len(LOSS_CLASSES)
+    hit, recover = probabilities['hit'], probabilities['recover']
+    single = vehicles[:, :n_classes]
+    assert_frequency(single == WOUNDED, hit * recover)
+    assert_frequency(single == KILLED, hit * (1 - recover))
+    # A vehicle with two equipment items is hit unless both of them are missed
+    assert_frequency(vehicles[:, n_classes] != 0, 1 - (1 - hit[0]) * (1 - hit[3]))
+
+
+def test_crew_only_hit_with_their_vehicle(probabilities):
+    arrays = plan_arrays()
+    _, crew, vehicles = sample_losses(arrays, probabilities,
+                                      np.random.default_rng(SEED), REPLICATIONS)
+    assert not crew[vehicles[:, arrays['crew_vehicle']] == 0].any()
+    # The crew of a hit vehicle with one equipment item take one personnel test
+    p, w = probabilities['personnel'], probabilities['wounded']
+    n_classes = len(LOSS_CLASSES)
+    for c, v in enumerate(arrays['crew_vehicle']):
+        if v == n_classes:
+            continue
+        was_hit = vehicles[:, v] != 0
+        assert_frequency((crew[was_hit, c] == WOUNDED)[:, None], p * w)
+        assert_frequency((crew[was_hit, c] == KILLED)[:, None], p * (1 - w))
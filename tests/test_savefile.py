@@ -0,0 +1,109 @@
+import pickle
+
+import numpy as np
+
+from qjm import Wargame
+from qjm.journal import Journal
+from qjm.savefile import SaveReader, SaveWriter, is_save_container
+
+from conftest import battle_input, top_formations
+
+
+def test_container_round_trip(tmp_path):
+    filename = str(tmp_path / 'container.sav')
+    meta = {'format': 2, 'dates': ['1985-08-14T08:00']}
+    arrays = {'ints': np.arange(12, dtype=np.int32).reshape(3, 4),
+              'floats': np.linspace(0, 1, 7),
+              'empty': np.zeros((0, 5), dtype=np.int16)}
+    with open(filename, 'wb') as f:
+        writer = SaveWriter(f)
+        writer.add_object('meta', meta)
+        for name, array in arrays.items():
+            writer.add_array(name, array)
+        writer.add_object('after', {'a': [1, 2, 3]})
+        writer.close()
+    assert is_save_container(filename)
+    with SaveReader(filename) as reader:
+        assert reader.meta == meta
+        assert reader.object('after') == {'a': [1, 2, 3]}
+        assert 'ints' in reader and 'missing' not in reader
+        for name, array in arrays.items():
+            read = reader.array(name)
+            assert read.dtype == array.dtype
+            np.testing.assert_array_equal(read, array)
+
+    pickled = str(tmp_path / 'pickled.sav')
+    with open(pickled, 'wb') as f:
+        pickle.dump(meta, f)
+    assert not is_save_container(pickled)
+
+
+def commit_battle(wargame, time):
+    blue, red = top_formations(wargame)
+    wargame.simulate_battle(battle_input([blue[1]], [red[0]], battleTime=time), commit=True)
+
+
+def snapshot(wargame, datecode, coordinates):
+    blue, red = top_formations(wargame)
+    wargame.formation_snapshot(datecode, [{'id': blue[1].id, 'coordinates': coordinates},
+                                          {'id': red[0].id, 'coordinates': coordinates[::-1]}])
+
+
+def assert_same_state(loaded, wargame):
+    assert list(loaded.formationsById) == list(wargame.formationsById)
+    assert {faction: [f.id for f in forms] for faction, forms in loaded.formations.items()} \
+        == {faction: [f.id for f in forms] for faction, forms in wargame.formations.items()}
+    assert loaded.get_snapshot_dates() == wargame.get_snapshot_dates()
+    for formation_id, formation in wargame.formationsById.items():
+        assert loaded.formationsById[formation_id].to_record(recursive=False) \
+            == formation.to_record(recursive=False)
+        assert loaded.history.history(formation_id) == wargame.history.history(formation_id)
+
+
+def test_checkpoint_and_journal_replay(wargame, tmp_path):
+    filename = str(tmp_path / 'state.sav')
+    commit_battle(wargame, '08:00')
+    snapshot(wargame, '1985-08-14T08:00', [10.0, 51.0])
+    wargame.save_sim_state(filename)
+    assert is_save_container(filename)
+    assert len(wargame.journal) == 0
+
+    loaded = Wargame()
+    loaded.load_sim_state(filename)
+    assert_same_state(loaded, wargame)
+    loaded.close_journal()
+
+    # Changes after the checkpoint only go to its journal
+    commit_battle(wargame, '14:00')
+    snapshot(wargame, '1985-08-14T14:00', [10.5, 51.5])
+    wargame.save_sim_state(filename)
+    assert len(wargame.journal) == 2
+
+    loaded = Wargame()
+    loaded.load_sim_state(filename)
+    assert len(loaded.journal) == 2
+    assert_same_state(loaded, wargame)
+    assert loaded.get_snapshots('1985-08-14T14:00') == wargame.get_snapshots('1985-08-14T14:00')
+    loaded.close_journal()
+    wargame.close_journal()
+
+
+def test_journal_drops_incomplete_record(tmp_path):
+    filename = str(tmp_path / 'state.sav.journal')
+    journal = Journal.create(filename, 'checkpoint')
+    journal.append({'type': 'snapshot', 'date': '1985-08-14T08:00', 'locations': []})
+    journal.append({'type': 'snapshot', 'date': '1985-08-15T08:00', 'locations': []})
+    journal.close()
+    with open(filename, 'ab') as f:
+        f.write(b'{"type": "battle", "chan')
+
+    assert Journal.open(filename, 'another checkpoint') == (None, [])
+    journal, records = Journal.open(filename, 'checkpoint')
+    assert [r['date'] for r in records] == ['1985-08-14T08:00', '1985-08-15T08:00']
+    assert len(journal) == 2
+    journal.append({'type': 'snapshot', 'date': '1985-08-16T08:00', 'locations': []})
+    journal.close()
+    journal, records = Journal.open(filename, 'checkpoint')
+    assert [r['date'] for r in records] == ['1985-08-14T08:00', '1985-08-15T08:00',
+                                            '1985-08-16T08:00']
+    journal.close()
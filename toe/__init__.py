@@ -1,5 +1,8 @@
-from .toe import TOE_Database, TOE, Formation
+from .toe import TOE_Database, TOE, Formation, FormationRollup
+from .history import HistoryStore
 from .enums import ElementStatus
 from .element import Element, Personnel, Vehicle
 from .exceptions import DuplicateIDError
-from .lin import LIN
\ No newline at end of file
+from .lin import LIN
+from .store import ElementStore, ElementView
+from .losses import LossPlan, loss_probabilities, replicate_losses
\ No newline at end of file
@@ -6,6 +6,29 @@ from qjm import (EquipmentOLICategory, VehicleCategory,
                    RecoveryRatesAttacker, RecoveryRatesDefender,
                    FormationOLI)
 
+logger = logging.getLogger(__name__)
+
+# Loss classes of QJM vehicle categories as (casualty rate, loss rate factor,
+# recovery rate). The casualty and recovery rates name attributes of
+# CasualtyRates and RecoveryRatesAttacker/RecoveryRatesDefender.
+VEHICLE_LOSS_CLASSES = {
+    VehicleCategory.tank:               ('armour', LossRateFactors.tanks, 'tanks'),
+    VehicleCategory.armoured_car:       ('personnel', LossRateFactors.apc, 'apc'),
+    VehicleCategory.truck:              ('personnel', LossRateFactors.vehicles, 'vehicles'),
+    VehicleCategory.artillery:          ('artillery', LossRateFactors.artillery_self_propelled, 'artillery_self_propelled'),
+    VehicleCategory.arv:                ('personnel', LossRateFactors.artillery_self_propelled, 'vehicles'),
+    VehicleCategory.ifv:                ('armour', LossRateFactors.tanks, 'tanks'),
+    VehicleCategory.apc:                ('personnel', LossRateFactors.apc, 'apc'),
+    VehicleCategory.combat_air_support: ('personnel', LossRateFactors.fixed_wing, 'fixed_wing'),
+    VehicleCategory.fighter:            ('personnel', LossRateFactors.fixed_wing, 'fixed_wing'),
+    VehicleCategory.bomber:             ('personnel', LossRateFactors.fixed_wing, 'fixed_wing'),
+    VehicleCategory.helicopter:         ('personnel', LossRateFactors.rotary_wing, 'rotary_wing'),
+}
+# Crew served weapons and anything else without a vehicle loss class
+DEFAULT_LOSS_CLASS = ('personnel', LossRateFactors.infantry_weaps, 'infantry_weaps')
+# Equipment that was not found in the equipment database
+MISSING_LOSS_CLASS = ('personnel', LossRateFactors.vehicles, 'vehicles')
+
 
 class Element:
     def __init__(self, name: str):
@@ -20,14 +43,27 @@ class Element:
         self.status = ElementStatus.UNDEFINED
         self.assigned_equipment = None
         self.qjm_equipment = None
+        # Formation the element belongs to, set by Formation.link()
+        self.formation = None
+        # Row of the element in the formation's ElementStore, if any
+        self.store_index = None
     
     def set_status(self, status: ElementStatus):
         """Set an Element's current status.
 
+        Marks the cached rollups of the owning formation as dirty and writes
+        the status through to its ElementStore.
+
         Args:
             status (ElementStatus): New status to set on the Element
         """
+        if status == self.status:
+            return
         self.status = status
+        if self.formation is not None:
+            self.formation.invalidate()
+            if self.formation.store is not None:
+                self.formation.store.set_status(self, status)
 
     def assign_equipment(self, nsns: list):
         """
@@ -36,7 +72,7 @@ class Element:
         Args:
             nsns (list): List of available NSNs (National Stock Numbers) to choose from.
         """
-        logging.error(f'---Attention: Assign_equipemnt is not overwritten for this Element type! {self}')
+        logger.error(f'---Attention: Assign_equipemnt is not overwritten for this Element type! {self}')
         pass
 
     
@@ -54,17 +90,58 @@ class Element:
                 qjm_equip = edb.get_weapon(e)
             if qjm_equip is None:
                 # if still not found, log a warning
-                logging.warning(f'{e} not found in database!')
+                logger.warning(f'{e} not found in database!')
             self.qjm_equipment.append(qjm_equip)
 
+    def resolve_missing_qjm_equipment(self, edb):
+        """
+        Fill QJM equipment slots that were not found in the database when the
+        equipment was assigned.
+
+        Args:
+            edb (EquipmentDatabase): The EquipmentDatabase object to search.
+
+        Returns:
+            bool: True if any slot was filled
+        """
+        filled = False
+        for i, e in enumerate(self.qjm_equipment):
+            if e is None:
+                # Slots repeat the assigned equipment in order
+                nsn = self.assigned_equipment[i % len(self.assigned_equipment)]
+                qjm_equip = edb.get_vehicle(nsn)
+                if qjm_equip is None:
+                    qjm_equip = edb.get_weapon(nsn)
+                if qjm_equip is not None:
+                    self.qjm_equipment[i] = qjm_equip
+                    filled = True
+        return filled
+
+    def _equipment_passes(self):
+        """Number of times the QJM equipment was assigned from the assigned
+        equipment, as every assign_qjm_equipment call appends a full set."""
+        if not self.assigned_equipment:
+            return 0
+        return len(self.qjm_equipment) // len(self.assigned_equipment)
+
+    def _rehydrate(self, status, nsns, passes, edb):
+        """Restores the status and equipment of an element from a record."""
+        self.status = ElementStatus(status)
+        self.assigned_equipment = list(nsns)
+        self.qjm_equipment = [None] * (len(self.assigned_equipment) * passes)
+        self.resolve_missing_qjm_equipment(edb)
+
     def get_qjm_equipment(self,):
         return self.qjm_equipment
 
     def get_oli(self):
+        # Checked once, so the loop does no logging work unless debugging
+        debug = logger.isEnabledFor(logging.DEBUG)
         oli = FormationOLI()
         for e in self.qjm_equipment:
             if e is not None:
-                logging.debug(f'Element {self.name} has equipment {e.name} with OLI {e.q_OLI}')
+                if debug:
+                    logger.debug('Element %s has equipment %s with OLI %s', self.name, e.name, e.q_OLI)
                 if e.oli_category == EquipmentOLICategory.small_arms:
                     oli.small_arms = e.q_OLI
                 elif e.oli_category == EquipmentOLICategory.heavy_weapon:
@@ -79,7 +156,8 @@ class Element:
                     oli.armour = e.q_OLI
                 elif e.oli_category == EquipmentOLICategory.aircraft:
                     oli.aircraft = e.q_OLI
-        logging.debug(f'Element {self.name} has OLI {oli}')
+        if debug:
+            logger.debug('Element %s has OLI %s', self.name, oli)
         return oli
 
     def __repr__(self):
@@ -110,31 +188,61 @@ class Personnel(Element):
         for e in self.equipment:
             self.assigned_equipment.append(e.assign_equipment(nsns))
 
-    def test_casualty(self, cr):
+    def test_casualty(self, cr, rng=None):
         """Test if this personnel is killed or not.
 
         Args:
             cr (CasualtyRates): Casualty rates object from the battle resolution
+            rng (numpy.random.Generator, optional): Random number generator to
+                draw from instead of the random module
         """
+        draw = random if rng is None else rng.random
         if cr.attacker:
-            rr = RecoveryRatesAttacker()
+            rr = RecoveryRatesAttacker
         else:
-            rr = RecoveryRatesDefender()
+            rr = RecoveryRatesDefender
         
         # Personnel always just use the CR for personnel
         cr_total = cr.personnel
 
         # test if the personnel is hit
-        if random() < cr_total:
+        if draw() < cr_total:
             # personnel is hit
-            if random() < rr.personnel:
+            if draw() < rr.personnel:
                 # personnel is wounded, use DAMAGED for wounded
-                self.status = ElementStatus.DAMAGED
-                logging.debug(f'{self} is wounded')
+                self.set_status(ElementStatus.DAMAGED)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('%s is wounded', self)
             else:
                 # personnel is killed, use DESTROYED for killed
-                self.status = ElementStatus.DESTROYED
-                logging.debug(f'{self} is destroyed')
+                self.set_status(ElementStatus.DESTROYED)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('%s is destroyed', self)
+
+    def to_record(self):
+        """Returns the personnel as a tuple of plain values, referencing its
+        LINs by id and its equipment by NSN.
+
+        Returns:
+            tuple: (name, rank, status, LIN ids, NSNs, equipment passes)
+        """
+        return (self.name, self.rank, self.status.value,
+                tuple(lin.lin for lin in self.equipment),
+                tuple(self.assigned_equipment), self._equipment_passes())
+
+    @classmethod
+    def from_record(cls, record, toe_db, edb):
+        """Creates personnel from Personnel.to_record output.
+
+        Args:
+            record (tuple): Record of the personnel
+            toe_db (TOE_Database): Database to look up the LINs in
+            edb (EquipmentDatabase): Database to look up the QJM equipment in
+        """
+        name, rank, status, lins, nsns, passes = record
+        pers = cls(name, rank, [toe_db.LIN[lin] for lin in lins])
+        pers._rehydrate(status, nsns, passes, edb)
+        return pers
 
     def __repr__(self):
         return f"Personnel({self.name}. {self.rank})"
@@ -166,90 +274,72 @@ class Vehicle(Element):
         self.assigned_equipment = [self.equipment.assign_equipment(nsns)]
 
 
-    def test_casualty(self, cr):
+    def test_casualty(self, cr, rng=None):
         """Test if this vehicle is destroyed or not.
 
         Args:
             cr (CasualtyRates): Casualty rates object from the battle resolution
+            rng (numpy.random.Generator, optional): Random number generator to
+                draw from instead of the random module
         """
+        draw = random if rng is None else rng.random
         if cr.attacker:
-            rr = RecoveryRatesAttacker()
+            rr = RecoveryRatesAttacker
         else:
-            rr = RecoveryRatesDefender()
+            rr = RecoveryRatesDefender
         for e in self.qjm_equipment:
             if e is not None:
-                if e.qjm_vehicle_category == VehicleCategory.tank:
-                    loss_rate_factor = LossRateFactors.tanks
-                    recovery_rate = rr.tanks
-                    cr_total = cr.armour * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.armoured_car:
-                    loss_rate_factor = LossRateFactors.apc
-                    recovery_rate = rr.apc
-                    cr_total = cr.personnel * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.truck:
-                    loss_rate_factor = LossRateFactors.vehicles
-                    recovery_rate = rr.vehicles
-                    cr_total = cr.personnel * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.artillery:
-                    loss_rate_factor = LossRateFactors.artillery_self_propelled
-                    recovery_rate = rr.artillery_self_propelled
-                    cr_total = cr.artillery * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.arv:
-                    loss_rate_factor = LossRateFactors.artillery_self_propelled
-                    recovery_rate = rr.vehicles
-                    cr_total = cr.personnel * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.ifv:
-                    loss_rate_factor = LossRateFactors.tanks
-                    recovery_rate = rr.tanks
-                    cr_total = cr.armour * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.apc:
-                    loss_rate_factor = LossRateFactors.apc
-                    recovery_rate = rr.apc
-                    cr_total = cr.personnel * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.combat_air_support:
-                    loss_rate_factor = LossRateFactors.fixed_wing
-                    recovery_rate = rr.fixed_wing
-                    cr_total = cr.personnel * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.fighter:
-                    loss_rate_factor = LossRateFactors.fixed_wing
-                    recovery_rate = rr.fixed_wing
-                    cr_total = cr.personnel * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.bomber:
-                    loss_rate_factor = LossRateFactors.fixed_wing
-                    recovery_rate = rr.fixed_wing
-                    cr_total = cr.personnel * loss_rate_factor
-                elif e.qjm_vehicle_category == VehicleCategory.helicopter:
-                    loss_rate_factor = LossRateFactors.rotary_wing
-                    recovery_rate = rr.rotary_wing
-                    cr_total = cr.personnel * loss_rate_factor
-                else:
-                    loss_rate_factor = LossRateFactors.infantry_weaps
-                    recovery_rate = rr.infantry_weaps
-                    cr_total = cr.personnel * loss_rate_factor
+                rate, loss_rate_factor, recovery = VEHICLE_LOSS_CLASSES.get(
+                    e.qjm_vehicle_category, DEFAULT_LOSS_CLASS)
             else:
                 # if still not found, log a warning
-                logging.warning(f'{self} qjm equipment {e} not assigned a category! '\
+                logger.warning(f'{self} qjm equipment {e} not assigned a category! '\
                                 f'Assigned equipment: {self.assigned_equipment}')
-                loss_rate_factor = LossRateFactors.vehicles
-                recovery_rate = rr.vehicles
-                cr_total = cr.personnel * loss_rate_factor
+                rate, loss_rate_factor, recovery = MISSING_LOSS_CLASS
+            cr_total = getattr(cr, rate) * loss_rate_factor
+            recovery_rate = getattr(rr, recovery)
             
             # test if the vehicle is hit
-            if random() < cr_total:
+            if draw() < cr_total:
                 # vehicle is hit
                 # test if it is destroyed
-                if random() < recovery_rate:
+                if draw() < recovery_rate:
                     # vehicle is damaged
-                    self.status = ElementStatus.DAMAGED
+                    self.set_status(ElementStatus.DAMAGED)
                 else:
                     # vehicle is destroyed
-                    self.status = ElementStatus.DESTROYED
+                    self.set_status(ElementStatus.DESTROYED)
                 
                 # Add casualties to the crew of the destroyed vehicle
                 for crew in self.crew:
-                    crew.test_casualty(cr)
+                    crew.test_casualty(cr, rng)
                 
         return self.status
     
+    def to_record(self):
+        """Returns the vehicle and its crew as a tuple of plain values,
+        referencing its LIN by id and its equipment by NSN.
+
+        Returns:
+            tuple: (name, LIN id, status, NSNs, equipment passes, crew records)
+        """
+        return (self.name, self.equipment.lin, self.status.value,
+                tuple(self.assigned_equipment), self._equipment_passes(),
+                tuple(crew.to_record() for crew in self.crew))
+
+    @classmethod
+    def from_record(cls, record, toe_db, edb):
+        """Creates a vehicle and its crew from Vehicle.to_record output.
+
+        Args:
+            record (tuple): Record of the vehicle
+            toe_db (TOE_Database): Database to look up the LINs in
+            edb (EquipmentDatabase): Database to look up the QJM equipment in
+        """
+        name, lin, status, nsns, passes, crew = record
+        veh = cls(name, toe_db.LIN[lin], [Personnel.from_record(c, toe_db, edb) for c in crew])
+        veh._rehydrate(status, nsns, passes, edb)
+        return veh
+
     def __repr__(self):
         return f"Vehicle({self.name})"
\ No newline at end of file
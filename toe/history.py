@@ -0,0 +1,485 @@
+from bisect import bisect_left, bisect_right, insort
+
+import numpy as np
+
+# Tables of a status_history entry
+HISTORY_TABLES = ('personnel', 'equipment')
+# Assigned count of a row that removes a rank or NSN from a formation
+REMOVED = -1
+# Columns of a HistoryStore, see HistoryStore.arrays
+VERSION_COLUMNS = ('version_formation', 'version_date')
+ROW_COLUMNS = ('row_formation', 'row_version', 'row_key', 'row_assigned', 'row_available')
+
+
+class HistoryStore:
+    """Columnar history of the snapshots of the formations of a scenario.
+
+    Every snapshot of a formation on a datecode is a version. A version only
+    stores the ranks and NSNs whose assigned or available counts changed since
+    the previous version of the same formation, as rows of (formation,
+    version, key, assigned, available), so memory grows with the changes
+    rather than with the number of formations and dates. A rank or NSN that is
+    no longer present gets a row with an assigned count of REMOVED.
+
+    Rows are kept grouped by formation in the order they were recorded, so the
+    history of a formation is a slice of the row arrays. Rows recorded since
+    the last read are grouped again on the next read.
+
+    The latest version of a formation on each of its datecodes is kept in a
+    list per formation sorted by datecode, so looking up a snapshot is a
+    bisection and the index grows with the versions, not with the formations
+    times the dates.
+
+    The latest locations of the formations are also indexed by datecode, with
+    the datecodes with locations kept sorted, and by formation, with the
+    datecodes each formation was located on kept sorted. Datecodes are ISO 8601
+    strings of the same precision, so they sort in time order.
+    """
+    def __init__(self):
+        # Formation ids, datecodes and (table, key) pairs the columns index into
+        self.formations = []
+        self.dates = []
+        self.keys = []
+        # Locations by version, only for versions that have one
+        self.locations = {}
+        self._formation_index = {}
+        self._date_index = {}
+        self._key_index = {}
+        self.n_versions = 0
+        self.n_rows = 0
+        self._versions = {name: np.zeros(64, dtype=np.int32) for name in VERSION_COLUMNS}
+        self._rows = {name: np.zeros(256, dtype=np.int32) for name in ROW_COLUMNS}
+        # Datecodes of the versions of each formation in time order, and the
+        # latest version on each of them
+        self._formation_dates = []
+        self._formation_versions = []
+        # Rows before n_grouped are grouped by formation, starting at _offsets
+        self.n_grouped = 0
+        self._offsets = np.zeros(1, dtype=np.int64)
+        # Counts of each formation at its latest version, made when it is next recorded
+        self._current = {}
+        # Versions and rows recorded since the columns were last appended to
+        self._new_versions = []
+        self._new_rows = []
+        # Locations by formation id by datecode, and the sorted datecodes
+        self._located = {}
+        self._located_dates = []
+        # Sorted datecodes and locations of each located formation, by formation id
+        self._formation_located = {}
+
+    def __repr__(self):
+        return (f'HistoryStore({len(self.formations)} formations, {len(self.dates)} dates, '
+                f'{self.n_versions} versions, {self.n_rows} rows)')
+
+    @classmethod
+    def from_arrays(cls, arrays, index, copy=True):
+        """Creates a store from the output of HistoryStore.arrays.
+
+        Args:
+            arrays (dict): Columns of the store
+            index (dict): Lists and locations of the store
+            copy (bool): If False, the store reads the arrays without copying
+                them, which is enough as long as nothing new is recorded
+        """
+        store = cls()
+        store.formations = list(index['formations'])
+        store.dates = list(index['dates'])
+        store.keys = [tuple(key) for key in index['keys']]
+        store.locations = dict(index['locations'])
+        store._formation_index = {f: i for i, f in enumerate(store.formations)}
+        store._date_index = {d: i for i, d in enumerate(store.dates)}
+        store._key_index = {k: i for i, k in enumerate(store.keys)}
+        as_array = np.array if copy else np.asarray
+        store._versions = {name: as_array(arrays[name]) for name in VERSION_COLUMNS}
+        store._rows = {name: as_array(arrays[name]) for name in ROW_COLUMNS}
+        store.n_versions = len(store._versions['version_formation'])
+        store.n_rows = len(store._rows['row_formation'])
+        store._index_versions()
+        for version, location in store.locations.items():
+            f = int(store._versions['version_formation'][version])
+            datecode = store.dates[store._versions['version_date'][version]]
+            if store._version_at(f, datecode) == version:
+                store._locate(store.formations[f], datecode, location)
+        store._group()
+        return store
+
+    def arrays(self):
+        """Returns the contents of the store, with the rows grouped by formation.
+
+        Returns:
+            tuple: (arrays, index) with the columns named in VERSION_COLUMNS and
+                ROW_COLUMNS, and the formations, dates, keys and locations
+        """
+        self._group()
+        arrays = {name: column[:self.n_versions] for name, column in self._versions.items()}
+        arrays.update({name: column[:self.n_rows] for name, column in self._rows.items()})
+        index = {'formations': self.formations,
+                 'dates': self.dates,
+                 'keys': self.keys,
+                 'locations': self.locations}
+        return arrays, index
+
+    def attach(self, formation):
+        """Makes the store the history of a formation and all its subunits.
+
+        Snapshots the formations already have in another store are copied into
+        this one.
+        """
+        previous = vars(formation).get('history')
+        if previous is not None and previous is not self:
+            self.add_history(formation.id, previous.history(formation.id))
+        # Formations pickled before the history store kept a plain dictionary
+        status_history = vars(formation).pop('status_history', None)
+        if status_history:
+            self.add_history(formation.id, status_history)
+        formation.history = self
+        for sub in formation.subunits:
+            self.attach(sub)
+
+    def add_history(self, formation_id, status_history):
+        """Records every entry of a status_history dictionary, in order."""
+        for datecode, entry in status_history.items():
+            self.record(formation_id, datecode, entry)
+
+    @staticmethod
+    def _index(values, index, value):
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(values)
+            values.append(value)
+        return i
+
+    @staticmethod
+    def _append(columns, n, names, values):
+        """Appends the rows of values to columns holding n values, growing
+        them if needed."""
+        if not values:
+            return
+        values = np.array(values, dtype=np.int32).T
+        k = values.shape[1]
+        for name, value in zip(names, values):
+            column = columns[name]
+            if n + k > len(column):
+                grown = np.zeros(max(2 * len(column), n + k), dtype=column.dtype)
+                grown[:n] = column[:n]
+                column = columns[name] = grown
+            column[n:n + k] = value
+
+    def _flush(self):
+        """Appends the versions and rows recorded since the last read to the columns."""
+        self._append(self._versions, self.n_versions - len(self._new_versions),
+                     VERSION_COLUMNS, self._new_versions)
+        self._append(self._rows, self.n_rows - len(self._new_rows), ROW_COLUMNS, self._new_rows)
+        self._new_versions = []
+        self._new_rows = []
+
+    def record(self, formation_id, datecode, entry):
+        """Records a snapshot entry of a formation, replacing any earlier
+        entry of the formation on the same datecode.
+
+        Args:
+            formation_id (str): Id of the formation
+            datecode (str): Datecode of the snapshot
+            entry (dict): Snapshot entry in the format of Formation.status_history
+        """
+        f = self._index(self.formations, self._formation_index, formation_id)
+        d = self._index(self.dates, self._date_index, datecode)
+        if f not in self._current:
+            # Rows of a formation that is not in _current have all been grouped
+            self._current[f] = self._state(f, self.n_versions, group=False)
+        current = self._current[f]
+        state = {}
+        for t, table in enumerate(HISTORY_TABLES):
+            for key, counts in entry[table].items():
+                k = self._index(self.keys, self._key_index, (t, key))
+                state[k] = (counts['assigned'], counts['available'])
+        version = self.n_versions
+        changes = [(f, version, k, a, n) for k, (a, n) in state.items() if current.get(k) != (a, n)]
+        changes += [(f, version, k, REMOVED, 0) for k in current if k not in state]
+        self._new_versions.append((f, d))
+        self._new_rows += changes
+        self.n_versions += 1
+        self.n_rows += len(changes)
+        self._current[f] = state
+        if entry.get('location') is not None:
+            self.locations[version] = entry['location']
+        self._locate(formation_id, datecode, entry.get('location'))
+        while len(self._formation_dates) <= f:
+            self._formation_dates.append([])
+            self._formation_versions.append([])
+        dates = self._formation_dates[f]
+        i = bisect_left(dates, datecode)
+        if i < len(dates) and dates[i] == datecode:
+            self._formation_versions[f][i] = version
+        else:
+            dates.insert(i, datecode)
+            self._formation_versions[f].insert(i, version)
+
+    def _index_versions(self):
+        """Builds the datecodes and latest versions of each formation from the
+        version columns."""
+        formation = self._versions['version_formation'][:self.n_versions]
+        date = self._versions['version_date'][:self.n_versions]
+        # Rank of each datecode in time order
+        rank = np.empty(len(self.dates), dtype=np.int64)
+        rank[sorted(range(len(self.dates)), key=self.dates.__getitem__)] = np.arange(len(self.dates))
+        order = np.lexsort((np.arange(self.n_versions), rank[date], formation))
+        # Keep the last version of each formation on each datecode
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = ((formation[order][1:] != formation[order][:-1])
+                     | (date[order][1:] != date[order][:-1]))
+        order = order[last]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(formation[order],
+                                                             minlength=len(self.formations)))])
+        dates = [self.dates[d] for d in date[order].tolist()]
+        versions = order.tolist()
+        self._formation_dates = [dates[offsets[f]:offsets[f + 1]]
+                                 for f in range(len(self.formations))]
+        self._formation_versions = [versions[offsets[f]:offsets[f + 1]]
+                                    for f in range(len(self.formations))]
+
+    def _version_at(self, f, datecode):
+        """Returns the latest version of a formation on a datecode, or -1."""
+        if f >= len(self._formation_dates):
+            return -1
+        dates = self._formation_dates[f]
+        i = bisect_left(dates, datecode)
+        if i < len(dates) and dates[i] == datecode:
+            return self._formation_versions[f][i]
+        return -1
+
+    def _group(self):
+        """Groups the rows by formation, keeping the order they were recorded in."""
+        self._flush()
+        if self.n_grouped == self.n_rows and len(self._offsets) == len(self.formations) + 1:
+            return
+        formation = self._rows['row_formation'][:self.n_rows]
+        if np.any(formation[1:] < formation[:-1]):
+            order = np.argsort(formation, kind='stable')
+            for name in ROW_COLUMNS:
+                self._rows[name] = self._rows[name][:self.n_rows][order]
+        counts = np.bincount(self._rows['row_formation'][:self.n_rows],
+                             minlength=len(self.formations))
+        self._offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.n_grouped = self.n_rows
+
+    def _formation_rows(self, f, group=True):
+        """Returns the versions, keys and assigned and available counts of the
+        rows of a formation, in the order they were recorded.
+
+        Args:
+            f (int): Index of the formation
+            group (bool): If False, only return the rows that are already grouped
+        """
+        if group:
+            self._group()
+        if f + 1 >= len(self._offsets):
+            return [], [], [], []
+        start, end = self._offsets[f], self._offsets[f + 1]
+        return (self._rows['row_version'][start:end].tolist(),
+                self._rows['row_key'][start:end].tolist(),
+                self._rows['row_assigned'][start:end].tolist(),
+                self._rows['row_available'][start:end].tolist())
+
+    def _state(self, f, version, group=True):
+        """Returns the counts of a formation up to and including a version."""
+        state = {}
+        for v, k, a, n in zip(*self._formation_rows(f, group)):
+            if v > version:
+                break
+            if a == REMOVED:
+                state.pop(k, None)
+            else:
+                state[k] = (a, n)
+        return state
+
+    def _entry(self, state, version):
+        entry = {table: {} for table in HISTORY_TABLES}
+        for k, (assigned, available) in state.items():
+            t, key = self.keys[k]
+            entry[HISTORY_TABLES[t]][key] = {'assigned': assigned, 'available': available}
+        entry['location'] = self.locations.get(version)
+        return entry
+
+    def _version(self, formation_id, datecode):
+        f = self._formation_index.get(formation_id)
+        if f is None:
+            return -1
+        return self._version_at(f, datecode)
+
+    def get(self, formation_id, datecode):
+        """Returns the snapshot entry of a formation on a datecode, or None."""
+        version = self._version(formation_id, datecode)
+        if version < 0:
+            return None
+        return self._entry(self._state(self._formation_index[formation_id], version), version)
+
+    def location(self, formation_id, datecode):
+        """Returns the location of a formation on a datecode, or None."""
+        return self.locations.get(self._version(formation_id, datecode))
+
+    def history(self, formation_id):
+        """Returns the snapshot entries of a formation by datecode, in the
+        order the datecodes were first recorded."""
+        f = self._formation_index.get(formation_id)
+        if f is None:
+            return {}
+        self._group()
+        versions = np.flatnonzero(self._versions['version_formation'][:self.n_versions] == f)
+        dates = self._versions['version_date'][versions].tolist()
+        rows = list(zip(*self._formation_rows(f)))
+        entries = {}
+        state = {}
+        i = 0
+        for version, d in zip(versions.tolist(), dates):
+            while i < len(rows) and rows[i][0] <= version:
+                _, k, a, n = rows[i]
+                if a == REMOVED:
+                    state.pop(k, None)
+                else:
+                    state[k] = (a, n)
+                i += 1
+            datecode = self.dates[d]
+            if self._version_at(f, datecode) == version:
+                entries[datecode] = self._entry(state, version)
+            else:
+                # Keep the position of a datecode that is recorded again later
+                entries.setdefault(datecode, None)
+        return entries
+
+    def snapshot(self, datecode):
+        """Returns the snapshot entries of every formation on a datecode, by
+        formation id."""
+        if datecode not in self._date_index:
+            return {}
+        entries = {}
+        for f in range(len(self._formation_dates)):
+            version = self._version_at(f, datecode)
+            if version >= 0:
+                entries[self.formations[f]] = self._entry(self._state(f, version), version)
+        return entries
+
+    def totals(self):
+        """Returns the counts of every version summed over its ranks and NSNs.
+
+        Returns:
+            np.ndarray: (n_versions, 2 * len(HISTORY_TABLES)) int64 array of
+                the assigned and available counts of each table in turn
+        """
+        self._group()
+        rows = {name: self._rows[name][:self.n_rows] for name in ROW_COLUMNS}
+        # Put the rows of each rank or NSN of a formation next to each other
+        order = np.lexsort((rows['row_version'], rows['row_key'], rows['row_formation']))
+        formation = rows['row_formation'][order]
+        key = rows['row_key'][order]
+        version = rows['row_version'][order]
+        assigned = rows['row_assigned'][order].astype(np.int64)
+        removed = assigned == REMOVED
+        counts = np.stack([np.where(removed, 0, assigned),
+                           np.where(removed, 0, rows['row_available'][order])], axis=1)
+        # A row changes the counts of its version by the difference to the previous row
+        deltas = counts.copy()
+        follows = (formation[1:] == formation[:-1]) & (key[1:] == key[:-1])
+        deltas[1:][follows] -= counts[:-1][follows]
+        tables = np.array([t for t, _ in self.keys], dtype=np.intp)[key]
+        changes = np.zeros((self.n_versions, 2 * len(HISTORY_TABLES)), dtype=np.int64)
+        np.add.at(changes, (version, 2 * tables), deltas[:, 0])
+        np.add.at(changes, (version, 2 * tables + 1), deltas[:, 1])
+        # Sum the changes over the versions of each formation
+        formations = self._versions['version_formation'][:self.n_versions]
+        by_formation = np.argsort(formations, kind='stable')
+        changes = changes[by_formation]
+        summed = np.cumsum(changes, axis=0)
+        first = np.ones(self.n_versions, dtype=bool)
+        first[1:] = formations[by_formation][1:] != formations[by_formation][:-1]
+        start = np.maximum.accumulate(np.where(first, np.arange(self.n_versions), 0))
+        totals = np.empty_like(summed)
+        totals[by_formation] = summed - summed[start] + changes[start]
+        return totals
+
+    def timeline(self, start, end):
+        """Returns the latest version of every formation as of every datecode
+        from start to end, inclusive.
+
+        Only the returned arrays are dense, the versions are read from the
+        sorted versions of each formation.
+
+        Returns:
+            list: (datecode, versions) in time order, where versions is an
+                array of the latest version of each formation on or before the
+                datecode, or -1 for formations without a snapshot by then
+        """
+        current = np.full(len(self.formations), -1, dtype=np.int32)
+        changes = {}
+        for f, (dates, versions) in enumerate(zip(self._formation_dates, self._formation_versions)):
+            first = bisect_left(dates, start)
+            if first:
+                current[f] = versions[first - 1]
+            for i in range(first, bisect_right(dates, end)):
+                changes.setdefault(dates[i], []).append((f, versions[i]))
+        frames = []
+        for datecode in sorted(changes):
+            formations, versions = zip(*changes[datecode])
+            current = current.copy()
+            current[list(formations)] = versions
+            frames.append((datecode, current))
+        return frames
+
+    def _locate(self, formation_id, datecode, location):
+        """Updates the location index with the latest location of a formation."""
+        located = self._located.get(datecode)
+        dates, locations = self._formation_located.get(formation_id, ([], []))
+        i = bisect_left(dates, datecode)
+        exists = i < len(dates) and dates[i] == datecode
+        if location is None:
+            if located is not None:
+                located.pop(formation_id, None)
+            if exists:
+                del dates[i]
+                del locations[i]
+            return
+        if located is None:
+            located = self._located[datecode] = {}
+            insort(self._located_dates, datecode)
+        located[formation_id] = location
+        if exists:
+            locations[i] = location
+        else:
+            dates.insert(i, datecode)
+            locations.insert(i, location)
+            self._formation_located[formation_id] = (dates, locations)
+
+    def located(self, datecode):
+        """Returns the locations of the formations that have one on a datecode,
+        by formation id."""
+        return dict(self._located.get(datecode, {}))
+
+    def located_before(self, datecode):
+        """Returns the latest location of every formation on or before a
+        datecode.
+
+        Returns:
+            tuple: (datecode, locations by formation id), where datecode is the
+                latest datecode of the locations, or (None, {}) if no formation
+                was located by then
+        """
+        latest = None
+        located = {}
+        for formation_id, (dates, locations) in self._formation_located.items():
+            i = bisect_right(dates, datecode)
+            if i:
+                located[formation_id] = locations[i - 1]
+                if latest is None or dates[i - 1] > latest:
+                    latest = dates[i - 1]
+        return latest, located
+
+    def located_between(self, start, end):
+        """Returns the locations on every datecode from start to end, inclusive.
+
+        Returns:
+            list: (datecode, locations by formation id) in time order
+        """
+        first = bisect_left(self._located_dates, start)
+        last = bisect_right(self._located_dates, end)
+        return [(datecode, dict(self._located[datecode]))
+                for datecode in self._located_dates[first:last] if self._located[datecode]]
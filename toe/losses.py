@@ -0,0 +1,195 @@
+import numpy as np
+
+from .enums import ElementStatus
+from .element import VEHICLE_LOSS_CLASSES, DEFAULT_LOSS_CLASS, MISSING_LOSS_CLASS
+from qjm import RecoveryRatesAttacker, RecoveryRatesDefender
+
+# Every vehicle loss class in a fixed order so elements can reference them by index
+LOSS_CLASSES = list(dict.fromkeys([*VEHICLE_LOSS_CLASSES.values(),
+                                   DEFAULT_LOSS_CLASS, MISSING_LOSS_CLASS]))
+
+WOUNDED = ElementStatus.DAMAGED.value
+KILLED = ElementStatus.DESTROYED.value
+
+# Upper bound on replications x elements drawn at once, to bound memory use
+MAX_DRAWS_PER_BLOCK = 2_000_000
+
+
+def loss_class(equipment):
+    """Returns the index into LOSS_CLASSES of a QJM equipment item. Equipment
+    that was not found in the equipment database is None."""
+    if equipment is None:
+        return LOSS_CLASSES.index(MISSING_LOSS_CLASS)
+    return LOSS_CLASSES.index(VEHICLE_LOSS_CLASSES.get(equipment.qjm_vehicle_category,
+                                                       DEFAULT_LOSS_CLASS))
+
+
+def loss_probabilities(cr):
+    """Converts casualty rates into per loss class hit and recovery probabilities.
+
+    Args:
+        cr (CasualtyRates): Casualty rates object from the battle resolution
+
+    Returns:
+        dict: Personnel hit and wounded probabilities, and arrays of vehicle hit
+            and recovery probabilities indexed like LOSS_CLASSES
+    """
+    if cr.attacker:
+        rr = RecoveryRatesAttacker
+    else:
+        rr = RecoveryRatesDefender
+    return {'personnel': cr.personnel,
+            'wounded': rr.personnel,
+            'hit': np.array([getattr(cr, rate) * factor for rate, factor, _ in LOSS_CLASSES]),
+            'recover': np.array([getattr(rr, recovery) for _, _, recovery in LOSS_CLASSES])}
+
+
+class LossPlan:
+    """Flattened arrays of every element a formation exposes to losses.
+
+    Mirrors Formation.inflict_losses: the personnel and vehicles of the
+    formation and all of its subunits are tested once per loss draw, each QJM
+    equipment item of a vehicle is tested in turn, and crew are only tested
+    when their vehicle is hit.
+    """
+    def __init__(self, formation):
+        self.formation = formation
+        self.personnel = []
+        self.vehicles = []
+        self.crew = []
+        self._collect(formation)
+
+        crew_vehicle = []
+        for i, veh in enumerate(self.vehicles):
+            crew_vehicle += [i] * len(veh.crew)
+        slots = max([len(veh.qjm_equipment) for veh in self.vehicles], default=0)
+        vehicle_classes = np.full((slots, len(self.vehicles)), -1, dtype=np.int16)
+        for i, veh in enumerate(self.vehicles):
+            for slot, e in enumerate(veh.qjm_equipment):
+                vehicle_classes[slot, i] = loss_class(e)
+
+        # Personnel (including crew) are reported by rank, vehicles by NSN
+        people = self.personnel + self.crew
+        self.ranks = sorted({p.rank for p in people})
+        self.nsns = sorted({self._nsn(veh) for veh in self.vehicles})
+        rank_ids = {rank: i for i, rank in enumerate(self.ranks)}
+        nsn_ids = {nsn: i for i, nsn in enumerate(self.nsns)}
+        self.arrays = {
+            'vehicle_classes': vehicle_classes,
+            'crew_vehicle': np.array(crew_vehicle, dtype=np.int64),
+            'n_personnel': len(self.personnel),
+            'rank': np.array([rank_ids[p.rank] for p in people], dtype=np.int64),
+            'nsn': np.array([nsn_ids[self._nsn(veh)] for veh in self.vehicles], dtype=np.int64),
+            'person_active': np.array([p.status == ElementStatus.ACTIVE for p in people], dtype=bool),
+            'vehicle_active': np.array([v.status == ElementStatus.ACTIVE for v in self.vehicles], dtype=bool),
+            'n_ranks': len(self.ranks),
+            'n_nsns': len(self.nsns),
+        }
+
+    def _collect(self, formation):
+        self.vehicles += formation.vehicles
+        for veh in formation.vehicles:
+            self.crew += veh.crew
+        self.personnel += formation.personnel
+        for sub in formation.subunits:
+            self._collect(sub)
+
+    @staticmethod
+    def _nsn(veh):
+        if veh.assigned_equipment:
+            return veh.assigned_equipment[0]
+        return veh.name
+
+    def __repr__(self):
+        return (f'LossPlan({self.formation.shortname}: {len(self.personnel)} personnel, '
+                f'{len(self.vehicles)} vehicles, {len(self.crew)} crew)')
+
+
+def sample_losses(arrays, probabilities, rng, replications):
+    """Draws the outcome of a number of independent loss tests.
+
+    Args:
+        arrays (dict): LossPlan.arrays of the formation
+        probabilities (dict): Output of loss_probabilities
+        rng (numpy.random.Generator): Random number generator to draw from
+        replications (int): Number of independent draws
+
+    Returns:
+        tuple: (personnel, crew, vehicles) int8 arrays of shape
+            (replications, elements) holding the new ElementStatus value of
+            every element that was hit, or 0 if it was not
+    """
+    classes = arrays['vehicle_classes']
+    crew_vehicle = arrays['crew_vehicle']
+    n_personnel = arrays['n_personnel']
+    n_crew = len(crew_vehicle)
+    n_vehicles = classes.shape[1]
+    # A single uniform draw decides each test: below hit x recovery the element
+    # is wounded or damaged, between that and the hit probability it is killed
+    # or destroyed. This has the same distribution as two separate draws.
+    hit = np.float32(probabilities['personnel'])
+    wounded = np.float32(probabilities['personnel'] * probabilities['wounded'])
+
+    u = rng.random((replications, n_personnel), dtype=np.float32)
+    personnel = np.where(u < wounded, WOUNDED, np.where(u < hit, KILLED, 0)).astype(np.int8)
+
+    vehicles = np.zeros((replications, n_vehicles), dtype=np.int8)
+    crew = np.zeros((replications, n_crew), dtype=np.int8)
+    for slot in classes:
+        valid = slot >= 0
+        vehicle_hit = probabilities['hit'][slot].astype(np.float32)
+        vehicle_damaged = (probabilities['hit'][slot] * probabilities['recover'][slot]).astype(np.float32)
+        u = rng.random((replications, n_vehicles), dtype=np.float32)
+        is_hit = (u < vehicle_hit) & valid
+        vehicles = np.where(is_hit, np.where(u < vehicle_damaged, WOUNDED, KILLED), vehicles).astype(np.int8)
+        # Crew of a hit vehicle take their own personnel casualty test
+        u = rng.random((replications, n_crew), dtype=np.float32)
+        u[~is_hit[:, crew_vehicle]] = 1.0
+        crew = np.where(u < wounded, WOUNDED, np.where(u < hit, KILLED, crew)).astype(np.int8)
+    return personnel, crew, vehicles
+
+
+def _count_by_key(outcomes, keys, n_keys, value):
+    """Counts outcomes equal to value per key for every replication."""
+    counts = np.zeros((outcomes.shape[0], n_keys), dtype=np.int32)
+    if outcomes.shape[1] == 0:
+        return counts
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    present, starts = np.unique(sorted_keys, return_index=True)
+    counts[:, present] = np.add.reduceat(outcomes[:, order] == value, starts, axis=1,
+                                         dtype=np.int32)
+    return counts
+
+
+def replicate_losses(arrays, probabilities, replications, seed=None):
+    """Runs independent loss draws and counts the losses of each replication.
+
+    Only elements that are currently active contribute to the counts.
+
+    Args:
+        arrays (dict): LossPlan.arrays of the formation
+        probabilities (dict): Output of loss_probabilities
+        replications (int): Number of independent draws
+        seed (optional): Seed or SeedSequence of the random number generator
+
+    Returns:
+        dict: (replications, ranks) 'killed' and 'wounded' counts and
+            (replications, NSNs) 'damaged' and 'destroyed' counts
+    """
+    rng = np.random.default_rng(seed)
+    n_elements = len(arrays['rank']) + arrays['vehicle_classes'].size
+    block = max(1, MAX_DRAWS_PER_BLOCK // max(1, n_elements))
+    counts = {'killed': [], 'wounded': [], 'damaged': [], 'destroyed': []}
+    done = 0
+    while done < replications:
+        n = min(block, replications - done)
+        personnel, crew, vehicles = sample_losses(arrays, probabilities, rng, n)
+        people = np.concatenate([personnel, crew], axis=1) * arrays['person_active']
+        vehicles = vehicles * arrays['vehicle_active']
+        counts['killed'].append(_count_by_key(people, arrays['rank'], arrays['n_ranks'], KILLED))
+        counts['wounded'].append(_count_by_key(people, arrays['rank'], arrays['n_ranks'], WOUNDED))
+        counts['damaged'].append(_count_by_key(vehicles, arrays['nsn'], arrays['n_nsns'], WOUNDED))
+        counts['destroyed'].append(_count_by_key(vehicles, arrays['nsn'], arrays['n_nsns'], KILLED))
+        done += n
+    return {key: np.concatenate(value) for key, value in counts.items()}
@@ -0,0 +1,292 @@
+import numpy as np
+
+from .enums import ElementStatus
+from .toe import J_UNARMOURED, J_ARMOURED, J_AIR
+from .losses import loss_class
+from qjm import FormationOLI, OLI_CATEGORIES, VehicleCategory
+
+ACTIVE = ElementStatus.ACTIVE.value
+
+# J group codes of QJM equipment in ElementStore.qjm_group
+J_NONE, J_GROUP_UNARMOURED, J_GROUP_ARMOURED, J_GROUP_AIR, J_GROUP_TANK = range(5)
+
+
+def _j_group(equipment):
+    if equipment is None:
+        return J_NONE
+    category = equipment.qjm_vehicle_category
+    if category in J_UNARMOURED:
+        return J_GROUP_UNARMOURED
+    if category in J_ARMOURED:
+        return J_GROUP_ARMOURED
+    if category in J_AIR:
+        return J_GROUP_AIR
+    if category == VehicleCategory.tank:
+        return J_GROUP_TANK
+    return J_NONE
+
+
+class ElementStore:
+    """Columnar copy of every element of a scenario held in NumPy arrays.
+
+    Formations are numbered depth first and the elements of each formation
+    are stored before those of its subunits, so the elements of a formation
+    occupy the index range [start, local_end) and those of the formation and
+    all of its subunits the range [start, end). Element objects remain the
+    source of truth; status changes made through Element.set_status are
+    written through to the store.
+
+    Columns, one row per element:
+        status: ElementStatus value
+        rank: index into ranks, -1 for vehicles
+        nsn: index into nsns of the first assigned equipment, -1 if none
+        qjm: index into qjm_equipment of the first QJM equipment, -1 if none
+        formation: index into formations
+        crew_of: row of the vehicle a crewman belongs to, -1 otherwise
+        is_vehicle: True for vehicles
+        oli: (elements, 8) OLI of each element in OLI_CATEGORIES order
+    """
+    def __init__(self, formations):
+        """
+        Build the store for a list of top level formations.
+
+        Args:
+            formations (list): Top level toe.Formation objects of the scenario
+        """
+        self.formations = []
+        # One past the last formation index of each formation's subtree
+        self.formation_end = []
+        self.elements = []
+        self.ranks = []
+        self.nsns = []
+        self.qjm_equipment = []
+        self._rank_ids = {}
+        self._nsn_ids = {}
+        self._qjm_ids = {}
+        self._columns = {'status': [], 'rank': [], 'nsn': [], 'qjm': [], 'formation': [],
+                         'crew_of': [], 'is_vehicle': []}
+        # Every assigned NSN and every QJM equipment item, by element row
+        self._equipment = ([], [])
+        self._qjm = ([], [])
+        ranges = []
+        for formation in formations:
+            self._add_formation(formation, ranges)
+
+        columns = self._columns
+        self.status = np.array(columns['status'], dtype=np.int8)
+        self.rank = np.array(columns['rank'], dtype=np.int32)
+        self.nsn = np.array(columns['nsn'], dtype=np.int32)
+        self.qjm = np.array(columns['qjm'], dtype=np.int32)
+        self.formation = np.array(columns['formation'], dtype=np.int32)
+        self.crew_of = np.array(columns['crew_of'], dtype=np.int32)
+        self.is_vehicle = np.array(columns['is_vehicle'], dtype=bool)
+        self.oli = np.zeros((len(self.elements), len(OLI_CATEGORIES)))
+        for i, element in enumerate(self.elements):
+            self.oli[i] = element.get_oli().to_list()
+        self.equipment_element = np.array(self._equipment[0], dtype=np.int32)
+        self.equipment_nsn = np.array(self._equipment[1], dtype=np.int32)
+        self.qjm_element = np.array(self._qjm[0], dtype=np.int32)
+        self.qjm_group = np.array([_j_group(self.qjm_equipment[q]) for q in self._qjm[1]],
+                                  dtype=np.int8)
+        self.qjm_loss_class = np.array([loss_class(self.qjm_equipment[q]) for q in self._qjm[1]],
+                                       dtype=np.int16)
+        self.ranges = np.array(ranges, dtype=np.int64).reshape(-1, 3)
+        del self._columns, self._equipment, self._qjm
+
+    @staticmethod
+    def _id(ids, values, key):
+        if key not in ids:
+            ids[key] = len(values)
+            values.append(key)
+        return ids[key]
+
+    def _add_element(self, element, formation_index, crew_of=-1):
+        row = len(self.elements)
+        element.store_index = row
+        self.elements.append(element)
+        is_vehicle = crew_of == -1 and hasattr(element, 'crew')
+        columns = self._columns
+        columns['status'].append(element.status.value)
+        columns['rank'].append(-1 if is_vehicle else self._id(self._rank_ids, self.ranks, element.rank))
+        columns['formation'].append(formation_index)
+        columns['crew_of'].append(crew_of)
+        columns['is_vehicle'].append(is_vehicle)
+        nsns = [self._id(self._nsn_ids, self.nsns, nsn) for nsn in element.assigned_equipment]
+        columns['nsn'].append(nsns[0] if nsns else -1)
+        self._equipment[0].extend([row] * len(nsns))
+        self._equipment[1].extend(nsns)
+        qjm = [self._id(self._qjm_ids, self.qjm_equipment, e) for e in element.qjm_equipment]
+        columns['qjm'].append(qjm[0] if qjm else -1)
+        self._qjm[0].extend([row] * len(qjm))
+        self._qjm[1].extend(qjm)
+        return row
+
+    def _add_formation(self, formation, ranges):
+        index = len(self.formations)
+        self.formations.append(formation)
+        formation.store = self
+        formation.store_index = index
+        ranges.append([len(self.elements), 0, 0])
+        self.formation_end.append(index)
+        for pers in formation.personnel:
+            self._add_element(pers, index)
+        for veh in formation.vehicles:
+            row = self._add_element(veh, index)
+            for crew in veh.crew:
+                self._add_element(crew, index, crew_of=row)
+        ranges[index][1] = len(self.elements)
+        for sub in formation.subunits:
+            self._add_formation(sub, ranges)
+        ranges[index][2] = len(self.elements)
+        self.formation_end[index] = len(self.formations)
+
+    def set_status(self, element, status: ElementStatus):
+        """Mirrors the status of an element into the store."""
+        self.status[element.store_index] = status.value
+
+    def refresh_equipment(self, formation):
+        """Recalculates the OLI, J groups and loss classes of the elements of
+        a formation, excluding subunits, after its QJM equipment changed."""
+        start, local_end, _ = self.ranges[formation.store_index]
+        # Resolved equipment fills existing slots, so the item rows stay put
+        item = np.searchsorted(self.qjm_element, start)
+        for row in range(start, local_end):
+            element = self.elements[row]
+            self.oli[row] = element.get_oli().to_list()
+            for e in element.qjm_equipment:
+                self.qjm_group[item] = _j_group(e)
+                self.qjm_loss_class[item] = loss_class(e)
+                item += 1
+
+    def snapshot(self, formation):
+        """Counts personnel by rank and equipment by NSN, assigned and
+        available, for a formation and every formation below it.
+
+        Crew are counted neither as personnel nor by their equipment, as in
+        Formation.snapshot.
+
+        Returns:
+            dict: {'personnel': ..., 'equipment': ...} entries in the format of
+                Formation.status_history, by Formation
+        """
+        first = formation.store_index
+        last = self.formation_end[first]
+        start, _, end = self.ranges[first]
+        active = self.status[start:end] == ACTIVE
+        counted = self.crew_of[start:end] == -1
+        people = counted & ~self.is_vehicle[start:end]
+        entries = {self.formations[i]: {'personnel': {}, 'equipment': {}} for i in range(first, last)}
+
+        def count(formations, keys, is_active, names, table):
+            # Group by (formation, key) pairs in a single pass
+            pairs = formations.astype(np.int64) * len(names) + keys
+            unique, assigned = np.unique(pairs, return_counts=True)
+            available = np.bincount(np.searchsorted(unique, pairs[is_active]), minlength=len(unique))
+            for pair, n_assigned, n_available in zip(unique.tolist(), assigned.tolist(), available.tolist()):
+                f, key = divmod(pair, len(names))
+                entries[self.formations[f]][table][names[key]] = {'assigned': n_assigned,
+                                                                  'available': n_available}
+
+        formations = self.formation[start:end]
+        count(formations[people], self.rank[start:end][people], active[people],
+              self.ranks, 'personnel')
+        lo, hi = np.searchsorted(self.equipment_element, [start, end])
+        rows = self.equipment_element[lo:hi] - start
+        keep = counted[rows]
+        rows = rows[keep]
+        count(formations[rows], self.equipment_nsn[lo:hi][keep], active[rows],
+              self.nsns, 'equipment')
+        return entries
+
+    def loss_arrays(self, formation):
+        """Builds the arrays sample_losses needs for a formation and all its
+        subunits from the store.
+
+        Elements are ordered as in a LossPlan of the formation, so both give
+        the same losses for the same random draws.
+
+        Returns:
+            tuple: (arrays, rows) where arrays holds 'vehicle_classes',
+                'crew_vehicle' and 'n_personnel' like LossPlan.arrays, and rows
+                are the personnel, crew and vehicle rows in the store
+        """
+        start, _, end = self.ranges[formation.store_index]
+        rows = np.arange(start, end)
+        is_vehicle = self.is_vehicle[start:end]
+        crew_of = self.crew_of[start:end]
+        personnel_rows = rows[~is_vehicle & (crew_of == -1)]
+        crew_rows = rows[crew_of >= 0]
+        vehicle_rows = rows[is_vehicle]
+
+        # Equipment items of the vehicles, in slot order within each vehicle
+        lo, hi = np.searchsorted(self.qjm_element, [start, end])
+        item_rows = self.qjm_element[lo:hi]
+        on_vehicle = self.is_vehicle[item_rows]
+        item_rows = item_rows[on_vehicle]
+        slot = np.arange(len(item_rows)) - np.searchsorted(item_rows, item_rows)
+        slots = int(slot.max()) + 1 if len(slot) else 0
+        vehicle_classes = np.full((slots, len(vehicle_rows)), -1, dtype=np.int16)
+        vehicle_classes[slot, np.searchsorted(vehicle_rows, item_rows)] = self.qjm_loss_class[lo:hi][on_vehicle]
+
+        arrays = {'vehicle_classes': vehicle_classes,
+                  'crew_vehicle': np.searchsorted(vehicle_rows, self.crew_of[crew_rows]).astype(np.int64),
+                  'n_personnel': len(personnel_rows)}
+        return arrays, (personnel_rows, crew_rows, vehicle_rows)
+
+    def view(self, formation, recursive=True):
+        """Returns an ElementView over the elements of a formation.
+
+        Args:
+            formation (Formation): Formation in this store
+            recursive (bool): If True, include the elements of all subunits
+        """
+        start, local_end, end = self.ranges[formation.store_index]
+        return ElementView(self, start, end if recursive else local_end)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __repr__(self):
+        return f'ElementStore({len(self.formations)} formations, {len(self.elements)} elements)'
+
+
+class ElementView:
+    """Slices of the ElementStore columns over a contiguous range of elements."""
+    def __init__(self, store, start, stop):
+        self.store = store
+        self.start = start
+        self.stop = stop
+        self.status = store.status[start:stop]
+        self.rank = store.rank[start:stop]
+        self.nsn = store.nsn[start:stop]
+        self.qjm = store.qjm[start:stop]
+        self.formation = store.formation[start:stop]
+        self.crew_of = store.crew_of[start:stop]
+        self.is_vehicle = store.is_vehicle[start:stop]
+        self.oli = store.oli[start:stop]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def _ragged(self, element_rows):
+        """Returns the slice of a per equipment table covering this range."""
+        return slice(np.searchsorted(element_rows, self.start),
+                     np.searchsorted(element_rows, self.stop))
+
+    def count_personnel(self):
+        """Number of active personnel, including crew."""
+        return int(np.count_nonzero(~self.is_vehicle & (self.status == ACTIVE)))
+
+    def count_vehicles(self):
+        """Number of active vehicles."""
+        return int(np.count_nonzero(self.is_vehicle & (self.status == ACTIVE)))
+
+    def get_oli(self):
+        """Summed OLI of all elements, regardless of status, like Formation.get_oli."""
+        return FormationOLI(*self.oli.sum(axis=0).tolist())
+
+    def count_j_groups(self):
+        """Counts of QJM equipment items by J group code, regardless of status,
+        like FormationRollup.categories."""
+        groups = self.store.qjm_group[self._ragged(self.store.qjm_element)]
+        return np.bincount(groups, minlength=J_GROUP_TANK + 1)
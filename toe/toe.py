@@ -7,11 +7,69 @@ from glob import glob
 from uuid import uuid4
 import html
 
+import numpy as np
+
 from .enums import ElementStatus
 from .exceptions import DuplicateIDError
 from .lin import LIN
 from .element import Personnel, Vehicle
-from qjm import FormationOLI, EquipmentOLICategory
+from .history import HistoryStore
+from .losses import LossPlan, loss_probabilities, sample_losses
+from qjm import FormationOLI, EquipmentOLICategory, VehicleCategory
+
+logger = logging.getLogger(__name__)
+
+# QJM vehicle categories counted towards the J (vehicle strength) factor
+J_UNARMOURED = (VehicleCategory.armoured_car, VehicleCategory.truck, VehicleCategory.arv)
+J_ARMOURED = (VehicleCategory.apc, VehicleCategory.ifv, VehicleCategory.artillery)
+J_AIR = (VehicleCategory.combat_air_support, VehicleCategory.fighter,
+         VehicleCategory.bomber, VehicleCategory.helicopter)
+
+# Vehicle categories in the order of Formation.category_counts
+VEHICLE_CATEGORIES = list(VehicleCategory)
+CATEGORY_INDEX = {category: i for i, category in enumerate(VEHICLE_CATEGORIES)}
+TANK_CATEGORY = CATEGORY_INDEX[VehicleCategory.tank]
+# J of each vehicle category, only organic aviation assets count as air
+J_WEIGHTS = np.array([1 if c in J_UNARMOURED else 2 if c in J_ARMOURED else 10 if c in J_AIR else 0
+                      for c in VEHICLE_CATEGORIES], dtype=float)
+# Length of FormationRollup.status, indexed by ElementStatus value
+N_STATUS = max(status.value for status in ElementStatus) + 1
+
+
+class FormationRollup:
+    """Strength totals of a formation as used by the battle resolution.
+
+    OLI, J and armour strength count the equipment of every assigned element
+    regardless of status, so the weapon and vehicle strengths of a formation
+    follow the same rule. Personnel strength counts active personnel only.
+    """
+    def __init__(self):
+        self.oli = FormationOLI()
+        self.personnel = 0   # active personnel, including crew
+        # QJM equipment of all elements by VEHICLE_CATEGORIES
+        self.categories = np.zeros(len(VEHICLE_CATEGORIES), dtype=np.int64)
+        # Elements, including crew, by ElementStatus value
+        self.status = np.zeros(N_STATUS, dtype=np.int64)
+
+    @property
+    def tanks(self):
+        """Armour strength, the number of assigned tanks."""
+        return int(self.categories[TANK_CATEGORY])
+
+    @property
+    def j(self):
+        """Vehicle strength (J) before the era factor."""
+        return float(self.categories @ J_WEIGHTS)
+
+    def __iadd__(self, other):
+        self.oli += other.oli
+        self.personnel += other.personnel
+        self.categories += other.categories
+        self.status += other.status
+        return self
+
+    def __repr__(self):
+        return f'FormationRollup(personnel={self.personnel}, tanks={self.tanks}, j={self.j})'
 
 
 class Formation:
@@ -75,15 +133,198 @@ class Formation:
                     new_pers.assign_equipment(nsns)
                     self.personnel.append(new_pers)
 
-        self.status_history = {}
+        # HistoryStore holding the snapshots of the formation, see status_history
+        self.history = None
+
+        # Set by the parent formation, see link()
+        self.parent = None
+        self.link()
 
     def __repr__(self,):
         return f'Formation({self.shortname}/{self.parent_shortname}, {self.nation})'
 
+    def to_record(self, cache=None, recursive=True):
+        """Returns the formation and its subunits as plain values that do not
+        reference the equipment or TO&E databases, see from_record.
+
+        Args:
+            cache (dict, optional): Element records made so far. Equal element
+                records are shared, so they are only stored once when pickled.
+            recursive (bool): If True, include the records of the subunits,
+                otherwise only their ids
+
+        Returns:
+            dict: Record of the formation
+        """
+        if cache is None:
+            cache = {}
+        personnel = [pers.to_record() for pers in self.personnel]
+        vehicles = [veh.to_record() for veh in self.vehicles]
+        return {'id': self.id,
+                'name': self.name,
+                'shortname': self.shortname,
+                'parent_shortname': self.parent_shortname,
+                'fullshortname': self.fullshortname,
+                'faction': self.faction,
+                'nation': self.nation,
+                'sidc': self.sidc,
+                'color': self.color,
+                'personnel': [cache.setdefault(r, r) for r in personnel],
+                'vehicles': [cache.setdefault(r, r) for r in vehicles],
+                'subunits': [sub.to_record(cache) if recursive else sub.id
+                             for sub in self.subunits]}
+
+    @classmethod
+    def from_record(cls, record, toe_db, equipment_db, subunits=None):
+        """Creates a formation and its subunits from Formation.to_record output.
+
+        Args:
+            record (dict): Record of the formation
+            toe_db (TOE_Database): Database to look up the LINs of the elements in
+            equipment_db (EquipmentDatabase): Database to look up the QJM equipment in
+            subunits (list, optional): Formations to use as the subunits, for
+                records made without recursion
+
+        Returns:
+            Formation: The formation, linked to its subunits and elements
+        """
+        if subunits is None:
+            subunits = [cls.from_record(sub, toe_db, equipment_db) for sub in record['subunits']]
+        custom_data = {'nation': record['nation'],
+                       'sidc': record['sidc'],
+                       'subunits': subunits}
+        form = cls(record['name'], record['shortname'], record['parent_shortname'],
+                   faction=record['faction'], custom_data=custom_data)
+        form.id = record['id']
+        form.fullshortname = record['fullshortname']
+        form.color = record['color']
+        if record.get('status_history'):
+            # Records saved before the history store carry their snapshots
+            form.history = HistoryStore()
+            form.history.add_history(form.id, record['status_history'])
+        form.personnel = [Personnel.from_record(r, toe_db, equipment_db) for r in record['personnel']]
+        form.vehicles = [Vehicle.from_record(r, toe_db, equipment_db) for r in record['vehicles']]
+        form.link()
+        return form
+
     def copy_toe(self, name, shortname, toe, nsns):
         # Pass current formation's shortname as the parent_shortname for subunits
         return Formation(name, shortname, self.shortname, toe, nsns, self.faction)
     
+    def link(self, recursive=False):
+        """Points the subunits and elements of the formation back at it and
+        clears its cached rollups and ElementStore.
+
+        Args:
+            recursive (bool): If True, also link all subunits below this formation
+        """
+        self._local_rollup = None
+        self._rollup = None
+        self.count_categories()
+        # Set when the formation is added to an ElementStore
+        self.store = None
+        self.store_index = None
+        for sub in self.subunits:
+            sub.parent = self
+            if recursive:
+                sub.link(recursive)
+        for veh in self.vehicles:
+            veh.formation = self
+            for crew in veh.crew:
+                crew.formation = self
+        for pers in self.personnel:
+            pers.formation = self
+
+    def count_categories(self):
+        """Counts the QJM equipment of the elements of this formation,
+        excluding subunits, by vehicle category into category_counts.
+        Like OLI, the counts do not depend on the status of the elements."""
+        indices = []
+        for element in self._elements():
+            indices += [CATEGORY_INDEX[e.qjm_vehicle_category] for e in element.qjm_equipment
+                        if e is not None]
+        self.category_counts = np.bincount(np.array(indices, dtype=np.int64),
+                                           minlength=len(VEHICLE_CATEGORIES))
+
+    def _elements(self):
+        """Yields the elements of this formation, excluding subunits, in the
+        order of the ElementStore: personnel, then each vehicle and its crew."""
+        yield from self.personnel
+        for veh in self.vehicles:
+            yield veh
+            yield from veh.crew
+
+    def invalidate(self):
+        """Marks the cached rollups of the formation and of all its parents as dirty."""
+        self._local_rollup = None
+        formation = self
+        # A parent can only hold a rollup while its subunits do, so stop at the
+        # first formation that is already dirty
+        while formation is not None and formation._rollup is not None:
+            formation._rollup = None
+            formation = formation.parent
+
+    def get_rollup(self, recursive=True):
+        """Returns the cached strength totals of the formation.
+
+        The returned object is shared with the cache and must not be modified.
+
+        Args:
+            recursive (bool): If True, include all subunits in the totals
+        """
+        if self._local_rollup is None:
+            self._local_rollup = self._build_rollup()
+        if not recursive:
+            return self._local_rollup
+        if self._rollup is None:
+            rollup = FormationRollup()
+            rollup += self._local_rollup
+            for sub in self.subunits:
+                rollup += sub.get_rollup()
+            self._rollup = rollup
+        return self._rollup
+
+    def _build_rollup(self):
+        """Totals the elements of this formation, excluding subunits."""
+        rollup = FormationRollup()
+        rollup.oli = self.get_oli(recursive=False, cached=False)
+        rollup.personnel = sum(1 for p in self.get_all_personnel(recursive=False)
+                               if p.status == ElementStatus.ACTIVE)
+        rollup.categories = self.category_counts.copy()
+        if self.store is not None:
+            statuses = self.view(recursive=False).status
+        else:
+            statuses = np.array([e.status.value for e in self._elements()], dtype=np.int64)
+        rollup.status = np.bincount(statuses, minlength=N_STATUS).astype(np.int64)
+        return rollup
+
+    def get_nsns(self):
+        """Returns the set of NSNs assigned to the elements of this formation,
+        excluding subunits."""
+        nsns = set()
+        for veh in self.vehicles:
+            nsns.update(veh.assigned_equipment)
+            for crew in veh.crew:
+                nsns.update(crew.assigned_equipment)
+        for pers in self.personnel:
+            nsns.update(pers.assigned_equipment)
+        return nsns
+
+    def refresh_qjm_equipment(self, equipment_db):
+        """Resolves equipment that has since been added to the equipment
+        database and marks the cached rollups as dirty. Subunits are not
+        refreshed."""
+        for veh in self.vehicles:
+            veh.resolve_missing_qjm_equipment(equipment_db)
+            for crew in veh.crew:
+                crew.resolve_missing_qjm_equipment(equipment_db)
+        for pers in self.personnel:
+            pers.resolve_missing_qjm_equipment(equipment_db)
+        self.count_categories()
+        if self.store is not None:
+            self.store.refresh_equipment(self)
+        self.invalidate()
+
     def add_qjm_weapons(self, equipment_db):
         """ Assign QJM equipment to all personnel and vehicles in the formation. """
         for veh in self.vehicles:
@@ -92,18 +333,42 @@ class Formation:
                 crew.assign_qjm_equipment(equipment_db)
         for weap in self.personnel:
             weap.assign_qjm_equipment(equipment_db)
+        self.count_categories()
+        self.invalidate()
 
         for sub in self.subunits:
             sub.add_qjm_weapons(equipment_db)
 
-    def inflict_losses(self, cr):
-        """ Inflict casualties on the formation based on the casualty rates. """
-        for veh in self.vehicles:
-            veh.test_casualty(cr)
-        for pers in self.personnel:
-            pers.test_casualty(cr)
-        for sub in self.subunits:
-            sub.inflict_losses(cr)
+    def inflict_losses(self, cr, rng=None):
+        """ Inflict casualties on the formation based on the casualty rates.
+
+        The elements of the formation and all its subunits are tested at once,
+        with the same outcome probabilities as Personnel.test_casualty and
+        Vehicle.test_casualty.
+
+        Args:
+            cr (CasualtyRates): Casualty rates object from the battle resolution
+            rng (optional): numpy.random.Generator, or a seed for one
+
+        Returns:
+            int: Number of elements that were hit
+        """
+        rng = np.random.default_rng(rng)
+        if self.store is not None:
+            arrays, rows = self.store.loss_arrays(self)
+            groups = [(self.store.elements, r) for r in rows]
+        else:
+            plan = LossPlan(self)
+            arrays = plan.arrays
+            groups = [(elements, range(len(elements)))
+                      for elements in (plan.personnel, plan.crew, plan.vehicles)]
+        outcomes = sample_losses(arrays, loss_probabilities(cr), rng, 1)
+        hit = 0
+        for (elements, index), outcome in zip(groups, outcomes):
+            for i in np.flatnonzero(outcome[0]):
+                elements[index[i]].set_status(ElementStatus(int(outcome[0, i])))
+                hit += 1
+        return hit
     
     def get_all_equipment(self,):
         all_equipment = []
@@ -149,12 +414,17 @@ class Formation:
 
     # FUNCTIONS FOR QJM INTEGRATION
     def count_personnel(self, recursive=True):
-        N_personnel = 0
-        personnel = self.get_all_personnel(recursive)
-        for p in personnel:
-            if p.status == ElementStatus.ACTIVE:
-                N_personnel += 1
-        return N_personnel
+        return self.get_rollup(recursive).personnel
+
+    def view(self, recursive=True):
+        """Returns an ElementView over the elements of the formation in its ElementStore.
+
+        Args:
+            recursive (bool): If True, include the elements of all subunits
+        """
+        if self.store is None:
+            raise ValueError(f'{self} is not in an ElementStore')
+        return self.store.view(self, recursive)
 
     def count_vehicles(self,):
         vehicles = {}
@@ -166,8 +436,10 @@ class Formation:
         # TODO: Need to get equipment by type
         return equipment
     
-    def get_oli(self, recursive=True):
+    def get_oli(self, recursive=True, cached=True):
         # returns OLI statistics about formation
+        if cached:
+            return self.get_rollup(recursive).oli.copy()
         oli = FormationOLI()  # Default is all zeros
         for veh in self.vehicles:
             oli += veh.get_oli()
@@ -180,13 +452,57 @@ class Formation:
                 oli += sub.get_oli()
         return oli
 
-    def snapshot(self, datecode: str, location: dict = None):
-        """Capture the current status of the formation."""
+    @property
+    def status_history(self):
+        """Snapshots of the formation by datecode, read from its HistoryStore.
+
+        Each snapshot is a dictionary of the assigned and available
+        'personnel' by rank and 'equipment' by NSN, and the 'location'.
+        Changing the returned dictionary does not change the history.
+        """
+        if self.history is None:
+            return {}
+        return self.history.history(self.id)
+
+    def snapshot(self, datecode: str, location: dict = None, locations: dict = None):
+        """Capture the current status of the formation and all its subunits.
+
+        Every formation in the subtree is counted once. A formation that
+        already has a location on the datecode keeps it.
+
+        Args:
+            datecode (str): Datecode of the snapshot
+            location (dict, optional): Location of the formation
+            locations (dict, optional): Locations of formations in the subtree by id
+
+        Returns:
+            int: Number of elements counted
+        """
+        if self.history is None:
+            # Formations outside a wargame keep their own history
+            HistoryStore().attach(self)
+        history = self.history
+        if locations is None:
+            locations = {}
+        if location is None:
+            location = locations.get(self.id)
         # Preserve existing location if it already exists
-        existing = self.status_history.get(datecode, {})
-        if existing.get('location') is not None:
-            location = existing['location']
-        self.status_history[datecode] = {
+        existing = history.location(self.id, datecode)
+        if existing is not None:
+            location = existing
+        if self.store is not None:
+            # Count the whole subtree at once
+            for formation, entry in self.store.snapshot(self).items():
+                if formation is self:
+                    entry['location'] = location
+                else:
+                    existing = history.location(formation.id, datecode)
+                    entry['location'] = existing if existing is not None else locations.get(formation.id)
+                history.record(formation.id, datecode, entry)
+            # Crew are not counted, as below
+            start, _, end = self.store.ranges[self.store_index]
+            return int(np.count_nonzero(self.store.crew_of[start:end] == -1))
+        snap = {
             'personnel': {},
             'equipment': {},
             'location': location
@@ -195,42 +511,44 @@ class Formation:
         # Capture Personnel status
         for pers in self.personnel:
             type_key = pers.rank
-            if type_key not in self.status_history[datecode]['personnel']:
-                self.status_history[datecode]['personnel'][type_key] = {'assigned': 0, 'available': 0}
+            if type_key not in snap['personnel']:
+                snap['personnel'][type_key] = {'assigned': 0, 'available': 0}
             if pers.status == ElementStatus.ACTIVE:
-                self.status_history[datecode]['personnel'][type_key]['available'] += 1
+                snap['personnel'][type_key]['available'] += 1
             # Assigned include all personnel in the unit, active or not
-            self.status_history[datecode]['personnel'][type_key]['assigned'] += 1
+            snap['personnel'][type_key]['assigned'] += 1
 
         # Capture equipment status
         for pers in self.personnel:
             for eq in pers.assigned_equipment:
-                if eq not in self.status_history[datecode]['equipment']:
-                    self.status_history[datecode]['equipment'][eq] = {'assigned': 0, 'available': 0}
-                # logging.debug(f'{pers} has status {pers.status} and equipment {eq}')
+                if eq not in snap['equipment']:
+                    snap['equipment'][eq] = {'assigned': 0, 'available': 0}
+                # logger.debug(f'{pers} has status {pers.status} and equipment {eq}')
                 if pers.status == ElementStatus.ACTIVE:
-                    self.status_history[datecode]['equipment'][eq]['available'] += 1
-                self.status_history[datecode]['equipment'][eq]['assigned'] += 1
+                    snap['equipment'][eq]['available'] += 1
+                snap['equipment'][eq]['assigned'] += 1
         for veh in self.vehicles:
             for eq in veh.assigned_equipment:
-                if eq not in self.status_history[datecode]['equipment']:
-                    self.status_history[datecode]['equipment'][eq] = {'assigned': 0, 'available': 0}
+                if eq not in snap['equipment']:
+                    snap['equipment'][eq] = {'assigned': 0, 'available': 0}
                 if veh.status == ElementStatus.ACTIVE:
-                    self.status_history[datecode]['equipment'][eq]['available'] += 1
+                    snap['equipment'][eq]['available'] += 1
                 # Assigned includes all vehicles in the unit, active or not
-                self.status_history[datecode]['equipment'][eq]['assigned'] += 1
+                snap['equipment'][eq]['assigned'] += 1
+        history.record(self.id, datecode, snap)
+        touched = len(self.personnel) + len(self.vehicles)
 
         # Recursively capture status for subunits
         for sub in self.subunits:
-            sub.snapshot(datecode)
+            touched += sub.snapshot(datecode, locations=locations)
+        return touched
 
     def get_snapshot(self, datecode: str):
         """Retrieve the status of the formation at a specific datecode."""
-        snap = self.status_history.get(datecode, None)
+        snap = self.history.get(self.id, datecode) if self.history is not None else None
         # Debugging logic
-        if snap is not None:
-            if snap['location'] is not None:
-                logging.debug(f"{self.shortname} is located at {snap['location']} on {datecode}")
+        if snap is not None and snap['location'] is not None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s is located at %s on %s', self.shortname, snap['location'], datecode)
         return snap
 
 
@@ -297,7 +615,7 @@ class TOE_Database:
                 data = yaml.safe_load(f)
             for lin in data:
                 if lin in self.LIN:
-                    logging.error(f"Duplicate LIN ID found: {lin} in {filename}")
+                    logger.error(f"Duplicate LIN ID found: {lin} in {filename}")
                     raise DuplicateIDError(f"Duplicate LIN ID found: {lin} in {filename}")
                 line_item = LIN(lin, data[lin]['name'], data[lin]['items'])
                 self.LIN.update({lin: line_item})
@@ -306,7 +624,7 @@ class TOE_Database:
             with open(filename, 'r') as f:
                 data = yaml.safe_load(f)
             if data['id'] in self.TOE:
-                logging.error(f"Duplicate TO&E ID found: {data['id']} in {filename}")            
+                logger.error(f"Duplicate TO&E ID found: {data['id']} in {filename}")            
                 raise DuplicateIDError(f"Duplicate TO&E ID found: {data['id']} in {filename}")
             toe_entry = TOE(data['name'], data['nation'], data['sidc'], data['id'],
                             data['subunits'], data['personnel'], data['vehicles'],
@@ -374,7 +692,7 @@ class TOE_Database:
                     toe_entry.vehicles.append(vehicle)
 
             # set built flag to TOE entry
-            logging.info('Built {}'.format(toe_entry))
+            logger.info('Built {}'.format(toe_entry))
             toe_entry.is_built = True
 
         chain.pop()
@@ -615,7 +933,7 @@ class TOE_Database:
         }
 
         # set the modified dates
-        logging.info(f'Created OrbatMapper file dated {now}')
+        logger.info(f'Created OrbatMapper file dated {now}')
         
         # add the new equipment types
         equips = []